@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Measures how many events a second a listener subscribed to PROCESS_STATE
+# can read when it is only interested in PROCESS_STATE_EXITED, with
+# childutils.listener.wait and with superlance.events.EventReader.  The
+# events are read from a file of the given number of events, one in ten
+# of them EXITED, with payloads of the given size.
+#
+# python benchmarks/event_reader.py [count [payload_size ...]]
+
+import os
+import sys
+import time
+import tempfile
+
+from supervisor import childutils
+from superlance.events import EventReader
+
+STATES = ['STARTING', 'RUNNING', 'BACKOFF', 'STOPPING', 'STOPPED',
+          'RUNNING', 'STARTING', 'RUNNING', 'STOPPING', 'EXITED']
+
+def write_events(path, count, size):
+    f = open(path, 'w')
+    try:
+        for i in range(count):
+            payload = ('processname:proc%d groupname:group from_state:'
+                       'STARTING pid:%d\n' % (i, i))
+            payload += 'x' * max(size - len(payload), 0)
+            f.write('ver:3.0 server:supervisor serial:%d pool:listener '
+                    'poolserial:%d eventname:PROCESS_STATE_%s len:%d\n%s' %
+                    (i, i, STATES[i % len(STATES)], len(payload), payload))
+    finally:
+        f.close()
+
+def time_wait(wait, path, count):
+    stdin = open(path)
+    stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        for i in range(count):
+            wait(stdin, stdout)
+        return time.time() - start
+    finally:
+        stdin.close()
+        stdout.close()
+
+def main(argv=sys.argv):
+    count = 100000
+    sizes = [100, 1000, 10000]
+    if len(argv) > 1:
+        count = int(argv[1])
+    if len(argv) > 2:
+        sizes = [ int(x) for x in argv[2:] ]
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    readers = [('childutils', childutils.listener.wait),
+               ('EventReader', EventReader(['PROCESS_STATE_EXITED']).wait)]
+    print '%12s %12s %14s' % ('reader', 'payload', 'events/sec')
+    try:
+        for size in sizes:
+            write_events(path, count, size)
+            for name, wait in readers:
+                elapsed = time_wait(wait, path, count)
+                print '%12s %12d %14.0f' % (name, size, count / elapsed)
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Measures the per-tick cost of the memmon RSS samplers as the number
+# of supervised processes grows.  Spawns the given numbers of sleeping
+# children and times one sample() call over all of them per "tick".
+#
+# python benchmarks/memmon_sampler.py [count ...]
+
+import os
+import sys
+import time
+import subprocess
+
+from superlance.memmon import PSSampler, ProcSampler
+
+def spawn(count):
+    return [ subprocess.Popen(['sleep', '600']) for i in range(count) ]
+
+def reap(children):
+    for child in children:
+        child.kill()
+        child.wait()
+
+def best_of(sampler, pids, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        sampler.sample(pids)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(argv=sys.argv):
+    counts = [ int(x) for x in argv[1:] ] or [10, 50, 100, 400]
+    samplers = [('ps', PSSampler(), 1)]
+    if ProcSampler.available():
+        samplers.append(('proc', ProcSampler(), 10))
+
+    print '%8s %10s %14s %14s' % ('sampler', 'processes', 'ms/tick',
+                                  'us/process')
+    for count in counts:
+        children = spawn(count)
+        try:
+            pids = [ child.pid for child in children ]
+            for name, sampler, repeat in samplers:
+                elapsed = best_of(sampler, pids, repeat)
+                print '%8s %10d %14.2f %14.1f' % (
+                    name, count, elapsed * 1000, elapsed * 1e6 / count)
+        finally:
+            reap(children)
+
+if __name__ == '__main__':
+    main()
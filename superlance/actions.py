@@ -0,0 +1,214 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# What a listener does to a process which misbehaves.  An action is
+# written as one of
+#
+#   restart        -- stop and start the process (the default)
+#   signal:NAME    -- send the process the signal NAME (e.g. HUP or USR2),
+#                     so that it can reload without dropping requests
+#   exec:COMMAND   -- run COMMAND with the shell, with the name and pid of
+#                     the process in SUPERLANCE_PROCESS_NAME and
+#                     SUPERLANCE_PROCESS_PID
+#
+# Every action takes a timeout: the number of seconds to wait for the
+# process to be RUNNING afterwards.  None leaves that to supervisord (a
+# restart waits for startsecs, a signal doesn't wait at all, a command is
+# waited for until it exits) and 0 doesn't wait at all.
+
+import os
+import signal
+import subprocess
+import time
+import xmlrpclib
+
+from supervisor.xmlrpc import Faults
+
+from superlance import transport
+
+class ActionError(Exception):
+    pass
+
+def wait_running(rpc, names, deadline, clock=time.time, sleep=time.sleep,
+                 interval=0.5):
+    """ Wait until all of names are RUNNING, or until the deadline.
+    Returns a dict of name -> ActionError or xmlrpclib.Fault for those
+    which aren't. """
+    waiting = list(names)
+    errors = {}
+    while waiting:
+        for name in waiting[:]:
+            try:
+                info = rpc.supervisor.getProcessInfo(name)
+            except xmlrpclib.Fault, why:
+                errors[name] = why
+                waiting.remove(name)
+                continue
+            if info['statename'] == 'RUNNING':
+                waiting.remove(name)
+            elif info['statename'] in ('FATAL', 'EXITED', 'STOPPED'):
+                errors[name] = ActionError('%s is %s' % (name,
+                                                         info['statename']))
+                waiting.remove(name)
+        if not waiting:
+            break
+        now = clock()
+        if now >= deadline:
+            for name in waiting:
+                errors[name] = ActionError('%s is not RUNNING yet' % name)
+            break
+        sleep(min(interval, deadline - now))
+    return errors
+
+class Action:
+    """ The base of the actions.  perform() returns a list with a
+    (name, failures) tuple for each of names, where failures is a list of
+    (stage, error) tuples: the step which failed ('stop', 'start',
+    'signal', 'exec' or 'wait') and an xmlrpclib.Fault or ActionError.
+    It is empty if everything worked. """
+    clock = staticmethod(time.time)
+    sleep = staticmethod(time.sleep)
+
+    def __str__(self):
+        return self.spec
+
+    def perform(self, rpc, names, timeout=None):
+        deadline = None
+        if timeout:
+            deadline = self.clock() + timeout
+        results = []
+        for name in names:
+            try:
+                self.perform_one(rpc, name, deadline)
+            except (xmlrpclib.Fault, ActionError), why:
+                results.append((name, [(self.stage, why)]))
+            else:
+                results.append((name, []))
+        if deadline is not None:
+            results = self.wait(rpc, results, deadline)
+        return results
+
+    def wait(self, rpc, results, deadline):
+        names = [ name for name, failures in results if not failures ]
+        errors = wait_running(rpc, names, deadline, self.clock, self.sleep)
+        for name, failures in results:
+            if name in errors:
+                failures.append(('wait', errors[name]))
+        return results
+
+class Restart(Action):
+    spec = 'restart'
+
+    def perform(self, rpc, names, timeout=None):
+        # one round trip for all of names where possible
+        results = []
+        for name, stopfault, startfault in transport.restart(
+            rpc, names, wait=timeout is None):
+            failures = []
+            # failing to stop a process which isn't running doesn't
+            # matter if it then starts
+            if stopfault is not None and not (
+                stopfault.faultCode == Faults.NOT_RUNNING and
+                startfault is None):
+                failures.append(('stop', stopfault))
+            if startfault is not None:
+                failures.append(('start', startfault))
+            results.append((name, failures))
+        if timeout:
+            results = self.wait(rpc, results, self.clock() + timeout)
+        return results
+
+class Signal(Action):
+    stage = 'signal'
+
+    def __init__(self, signame):
+        signame = signame.upper()
+        if not signame.startswith('SIG'):
+            signame = 'SIG' + signame
+        signum = getattr(signal, signame, None)
+        if not isinstance(signum, int) or signame.startswith('SIG_'):
+            raise ValueError('unknown signal %r' % signame)
+        self.signame = signame[3:]
+        self.signum = signum
+        self.spec = 'signal:%s' % self.signame
+        # whether supervisord has signalProcess (3.2 and later), None
+        # until we know
+        self.native = None
+
+    def perform_one(self, rpc, name, deadline):
+        if self.native is not False:
+            try:
+                rpc.supervisor.signalProcess(name, self.signame)
+                self.native = True
+                return
+            except xmlrpclib.Fault, why:
+                if why.faultCode != Faults.UNKNOWN_METHOD:
+                    raise
+                self.native = False
+        # older supervisords can't do it for us, which only works if we
+        # run on the same host as the process and may signal it
+        pid = rpc.supervisor.getProcessInfo(name)['pid']
+        if not pid:
+            raise ActionError('%s is not running' % name)
+        try:
+            os.kill(pid, self.signum)
+        except OSError, why:
+            raise ActionError('kill %s: %s' % (pid, why))
+
+class Exec(Action):
+    stage = 'exec'
+    popen = subprocess.Popen
+
+    def __init__(self, command):
+        if not command:
+            raise ValueError('no command')
+        self.command = command
+        self.spec = 'exec:%s' % command
+
+    def perform_one(self, rpc, name, deadline):
+        pid = 0
+        try:
+            pid = rpc.supervisor.getProcessInfo(name)['pid']
+        except xmlrpclib.Fault:
+            pass
+        env = os.environ.copy()
+        env['SUPERLANCE_PROCESS_NAME'] = name
+        env['SUPERLANCE_PROCESS_PID'] = str(pid)
+        try:
+            process = self.popen(self.command, shell=True, env=env)
+        except OSError, why:
+            raise ActionError('%s: %s' % (self.command, why))
+        if deadline is None:
+            status = process.wait()
+        else:
+            status = process.poll()
+            while status is None and self.clock() < deadline:
+                self.sleep(0.1)
+                status = process.poll()
+            if status is None:
+                raise ActionError('%s still running' % self.command)
+        if status:
+            raise ActionError('%s exited with status %s' % (self.command,
+                                                           status))
+
+def parse_action(spec):
+    """ Return the action written as spec, or raise ValueError. """
+    kind, sep, arg = spec.partition(':')
+    if kind == 'restart' and not sep:
+        return Restart()
+    if kind == 'signal' and arg:
+        return Signal(arg)
+    if kind == 'exec':
+        return Exec(arg)
+    raise ValueError('unknown action %r' % spec)
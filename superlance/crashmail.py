@@ -28,14 +28,18 @@
 
 doc = """\
 crashmail.py [-p processname] [-a] [-o string] [-m mail_address]
-             [-s sendmail] URL
+             [-s sendmail] [-w seconds] [--notify=sink]
+             [--notify-rate=count] URL
 
 Options:
 
 -p -- specify a supervisor process_name.  Send mail when this process
       transitions to the EXITED state unexpectedly. If this process is
       part of a group, it can be specified using the
-      'process_name:group_name' syntax.
+      'group_name:process_name' syntax.  A name may contain the shell
+      wildcards * and ? (e.g. 'group_name:*'), or be a regular
+      expression between slashes (e.g. '/^web[0-9]+$/'), to select every
+      process whose name or group_name:process_name matches it.
 
 -a -- Send mail when any child of the supervisord transitions
       unexpectedly to the EXITED state unexpectedly.  Overrides any -p
@@ -52,9 +56,25 @@ Options:
       address when crashmail detects a process crash.  If no email
       address is specified, email will not be sent.
 
+-w -- mail about the crashes of any one process at most once every this
+      many seconds.  The first crash is mailed straight away; the crashes
+      which follow within the window are counted and mailed together, with
+      the last one's details, when it is over.  The summary is sent on the
+      next event after that, so subscribe to TICK_60 as well to get it in
+      time.  Default is 0, which mails every crash.
+
+--notify -- send notifications another way than with the -s command:
+      "sendmail:COMMAND", "smtp:HOST[:PORT]", "webhook:URL" to POST them
+      as JSON to an http(s) URL, or "file:PATH" to append them to an mbox
+      file.  Notifications are sent in the background.
+
+--notify-rate -- send at most this many notifications a minute.  Those
+      which come in meanwhile are combined into one for each address.
+      By default there is no limit.
+
 The -p option may be specified more than once, allowing for
 specification of multiple processes.  Specifying -a overrides any
-selection of -p.
+selection of -p.  Without either, mail is sent for every process.
 
 A sample invocation:
 
@@ -63,24 +83,86 @@ crashmail.py -p program1 -p group1:program2 -m dev@example.com
 """
 
 import os
+import re
 import sys
+import time
 
 from supervisor import childutils
 
+from superlance import events
+from superlance import notifier
+
 def usage():
     print doc
     sys.exit(255)
 
+def translate(glob):
+    """ Return a regular expression matching the same strings as glob,
+    which may contain * and ? wildcards. """
+    parts = [ '.'.join([ re.escape(s) for s in part.split('?') ])
+              for part in glob.split('*') ]
+    return '^%s$' % '.*'.join(parts)
+
+class ProgramMatcher:
+    """ Tells whether a process is selected by the -p names given.  Plain
+    names are kept in a set; wildcards and regular expressions are
+    compiled into one regular expression.  The answer for each process is
+    remembered, so each is only matched against the patterns once. """
+    def __init__(self, selectors, any=False):
+        self.any = any or not selectors
+        self.names = set()
+        patterns = []
+        for selector in selectors:
+            if len(selector) > 1 and selector[0] == selector[-1] == '/':
+                patterns.append(selector[1:-1])
+            elif '*' in selector or '?' in selector:
+                patterns.append(translate(selector))
+            else:
+                self.names.add(selector)
+        self.pattern = None
+        if patterns:
+            self.pattern = re.compile('|'.join([ '(?:%s)' % p
+                                                 for p in patterns ]))
+        self.cache = {}
+
+    def matches(self, name, group):
+        if self.any:
+            return True
+        namespec = '%s:%s' % (group, name)
+        result = self.cache.get(namespec)
+        if result is None:
+            # name:group is the order this option was documented in
+            result = (name in self.names or namespec in self.names or
+                      '%s:%s' % (name, group) in self.names)
+            if not result and self.pattern is not None:
+                result = bool(self.pattern.search(namespec) or
+                              self.pattern.search(name))
+            self.cache[namespec] = result
+        return result
+
 class CrashMail:
+    clock = staticmethod(time.time)
 
-    def __init__(self, programs, any, email, sendmail, optionalheader):
+    def __init__(self, programs, any, email, sendmail, optionalheader,
+                 notify=None, window=0):
 
         self.programs = programs
         self.any = any
+        self.matcher = ProgramMatcher(programs, any)
         self.email = email
         self.sendmail = sendmail
         self.optionalheader = optionalheader
+        if notify is None:
+            notify = notifier.Notifier(notifier.SendmailSink(sendmail))
+        self.notifier = notify
+        self.window = window
+        # process -> TokenBucket allowing one email per window
+        self.buckets = {}
+        # process -> [count, first time, last time, last message] of the
+        # crashes not mailed yet
+        self.held = {}
         self.stdin = sys.stdin
+        self.events = events.EventReader(['PROCESS_STATE_EXITED'])
         self.stdout = sys.stdout
         self.stderr = sys.stderr
 
@@ -88,9 +170,11 @@ class CrashMail:
         while 1:
             # we explicitly use self.stdin, self.stdout, and self.stderr
             # instead of sys.* so we can unit test this code
-            headers, payload = childutils.listener.wait(self.stdin, self.stdout)
+            headers, payload = self.events.wait(self.stdin, self.stdout)
+            now = self.clock()
 
             if not headers['eventname'] == 'PROCESS_STATE_EXITED':
+                self.mail_held(now)
                 # do nothing with non-TICK events
                 childutils.listener.ok(self.stdout)
                 if test:
@@ -102,6 +186,7 @@ class CrashMail:
             pheaders, pdata = childutils.eventdata(payload+'\n')
 
             if int(pheaders['expected']):
+                self.mail_held(now)
                 childutils.listener.ok(self.stdout)
                 if test:
                     self.stderr.write('expected exit\n')
@@ -109,38 +194,93 @@ class CrashMail:
                     break
                 continue
 
+            if not self.matcher.matches(pheaders['processname'],
+                                        pheaders['groupname']):
+                self.mail_held(now)
+                childutils.listener.ok(self.stdout)
+                if test:
+                    self.stderr.write('unselected process\n')
+                    self.stderr.flush()
+                    break
+                continue
+
             msg = ('Process %(processname)s in group %(groupname)s exited '
                    'unexpectedly (pid %(pid)s) from state %(from_state)s' %
                    pheaders)
 
-            subject = ' %s crashed at %s' % (pheaders['processname'],
-                                             childutils.get_asctime())
-            if self.optionalheader:
-                subject = self.optionalheader + ':' + subject
+            key = '%(groupname)s:%(processname)s' % pheaders
+            if self.hold(key, now, msg):
+                self.stderr.write('unexpected exit, coalescing\n')
+                self.stderr.flush()
+            else:
+                subject = ' %s crashed at %s' % (pheaders['processname'],
+                                                 childutils.get_asctime(now))
+                if self.optionalheader:
+                    subject = self.optionalheader + ':' + subject
 
-            self.stderr.write('unexpected exit, mailing\n')
-            self.stderr.flush()
+                self.stderr.write('unexpected exit, mailing\n')
+                self.stderr.flush()
 
-            self.mail(self.email, subject, msg)
+                self.mail(self.email, subject, msg)
+            self.mail_held(now)
 
             childutils.listener.ok(self.stdout)
             if test:
                 break
 
+    def hold(self, key, now, msg):
+        """ Return whether the crash of key can't be mailed now, in which
+        case it is counted for the next summary instead. """
+        if not self.window:
+            return False
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = notifier.TokenBucket(1, self.window)
+            self.buckets[key] = bucket
+        if key not in self.held and bucket.take(now):
+            return False
+        held = self.held.get(key)
+        if held is None:
+            held = [0, now, now, msg]
+            self.held[key] = held
+        held[0] += 1
+        held[2] = now
+        held[3] = msg
+        return True
+
+    def mail_held(self, now):
+        """ Mail a summary of the crashes held back for each process
+        whose window is over. """
+        for key in sorted(self.held.keys()):
+            if not self.buckets[key].take(now):
+                continue
+            count, first, last, msg = self.held.pop(key)
+            group, name = key.split(':', 1)
+            subject = ' %s crashed %s more times since %s' % (
+                name, count, childutils.get_asctime(first))
+            if self.optionalheader:
+                subject = self.optionalheader + ':' + subject
+            body = ('Process %s in group %s exited unexpectedly %s more '
+                    'times between %s and %s.  The last time:\n\n%s' % (
+                    name, group, count, childutils.get_asctime(first),
+                    childutils.get_asctime(last), msg))
+            self.stderr.write('mailing %s held crashes of %s\n' % (count,
+                                                                    key))
+            self.stderr.flush()
+            self.mail(self.email, subject, body)
+
     def mail(self, email, subject, msg):
         body =  'To: %s\n' % self.email
         body += 'Subject: %s\n' % subject
         body += '\n'
         body += msg
-        m = os.popen(self.sendmail, 'w')
-        m.write(body)
-        m.close()
+        self.notifier.sendtext(body)
         self.stderr.write('Mailed:\n\n%s' % body)
         self.mailed = body
 
 def main(argv=sys.argv):
     import getopt
-    short_args="hp:ao:s:m:"
+    short_args="hp:ao:s:m:w:"
     long_args=[
         "help",
         "program=",
@@ -148,6 +288,9 @@ def main(argv=sys.argv):
         "optionalheader="
         "sendmail_program=",
         "email=",
+        "window=",
+        "notify=",
+        "notify-rate=",
         ]
     arguments = argv[1:]
     try:
@@ -163,6 +306,9 @@ def main(argv=sys.argv):
     status = '200'
     inbody = None
     optionalheader = None
+    window = 0
+    sink = None
+    notifyrate = None
 
     for option, value in opts:
 
@@ -170,6 +316,13 @@ def main(argv=sys.argv):
             usage()
 
         if option in ('-p', '--program'):
+            if len(value) > 1 and value[0] == value[-1] == '/':
+                try:
+                    re.compile(value[1:-1])
+                except re.error, why:
+                    print 'Bad regular expression %r for %r: %s' % (
+                        value, option, why)
+                    usage()
             programs.append(value)
 
         if option in ('-a', '--any'):
@@ -184,14 +337,36 @@ def main(argv=sys.argv):
         if option in ('-o', '--optionalheader'):
             optionalheader = value
 
+        if option in ('-w', '--window'):
+            window = int(value)
+
+        if option == '--notify':
+            try:
+                sink = notifier.make_sink(value)
+            except ValueError, why:
+                print 'Unparseable notifier %r for %r: %s' % (value, option,
+                                                              why)
+                usage()
+
+        if option == '--notify-rate':
+            notifyrate = int(value)
+
     if not 'SUPERVISOR_SERVER_URL' in os.environ:
         sys.stderr.write('crashmail must be run as a supervisor event '
                          'listener\n')
         sys.stderr.flush()
         return
 
-    prog = CrashMail(programs, any, email, sendmail, optionalheader)
-    prog.runforever()
+    if sink is None:
+        sink = notifier.SendmailSink(sendmail)
+    notify = notifier.Notifier(sink, rate=notifyrate)
+    prog = CrashMail(programs, any, email, sendmail, optionalheader, notify,
+                     window)
+    notify.start()
+    try:
+        prog.runforever()
+    finally:
+        notify.stop(30)
 
 if __name__ == '__main__':
     main()
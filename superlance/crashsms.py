@@ -36,6 +36,14 @@ crashsms.py [--interval=<batch interval in minutes>]
         [--toEmail=<email address>]
         [--fromEmail=<email address>]
         [--subject=<email subject>]
+        [--batchLines=<count>]
+        [--batchKeys=<count>]
+        [--flushSize=<count>]
+        [--urgentEvent=<event name>]
+        [--smtpStartTLS]
+        [--sendQueue=<count>]
+        [--spoolDir=<directory>]
+        [--notifyRate=<count>]
 
 Options:
 
@@ -53,6 +61,23 @@ Options:
 
 -e, --tickEvent - specify which TICK event to use (e.g. TICK_5, TICK_60, TICK_3600)
 
+--batchLines   - the number of messages kept for each process in a batch;
+                 older ones are only counted (defaults to 10)
+
+--batchKeys    - the number of processes kept in a batch (defaults to 100)
+
+--flushSize    - send a batch as soon as it holds this many messages
+
+--urgentEvent  - send a batch as soon as it holds a message about this event
+
+--smtpStartTLS - use STARTTLS with the SMTP server
+
+--sendQueue    - emails waiting to be sent kept in memory (defaults to 100)
+
+--spoolDir     - directory keeping emails which can't be sent yet
+
+--notifyRate   - send at most this many emails a minute, combining the rest
+
 A sample invocation:
 
 crashsms.py -t <mobile phone>@<mobile provider> -f me@bar.com -e TICK_5
@@ -0,0 +1,106 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Reading events from supervisord.  Listeners are often subscribed to
+# more events than they act on (PROCESS_STATE for the EXITED ones, say),
+# and childutils.listener.wait reads every payload into a string which
+# is then thrown away.  An EventReader is told which events its listener
+# is interested in.  It only picks the name and length out of the header
+# line of the others, and skips over their payloads through a buffer it
+# reuses rather than making strings of them.
+
+import sys
+
+from supervisor import childutils
+
+def get_name_and_len(line):
+    """ Return the eventname and len of a header line, or None if they
+    can't be found. """
+    start = line.find(' eventname:')
+    if start == -1:
+        return None
+    start += 11
+    end = line.find(' ', start)
+    length = line.find(' len:', start)
+    if end == -1 or length == -1:
+        return None
+    try:
+        return line[start:end], int(line[length + 5:])
+    except ValueError:
+        return None
+
+class EventReader:
+    """ Reads events, returning the payload of those in interest only.
+    interest is a list of event names, any of which may end with '*' to
+    stand for all the names starting with what comes before it (e.g.
+    'TICK_*').  Whether an event name is of interest is worked out the
+    first time it is seen and kept in a table.
+
+    Payloads up to smallpayload bytes are skipped by reading them, which
+    is cheaper than filling a slice of the buffer. """
+    smallpayload = 512
+
+    def __init__(self, interest, bufsize=65536):
+        self.names = set()
+        self.prefixes = []
+        for name in interest:
+            if name.endswith('*'):
+                self.prefixes.append(name[:-1])
+            else:
+                self.names.add(name)
+        self.table = {}
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+
+    def wants(self, eventname):
+        wanted = self.table.get(eventname)
+        if wanted is None:
+            wanted = eventname in self.names
+            for prefix in self.prefixes:
+                if eventname.startswith(prefix):
+                    wanted = True
+            self.table[eventname] = wanted
+        return wanted
+
+    def wait(self, stdin=sys.stdin, stdout=sys.stdout):
+        """ Like childutils.listener.wait, but for an event which isn't
+        of interest the payload returned is None and the headers only
+        have eventname and len. """
+        childutils.listener.ready(stdout)
+        line = stdin.readline()
+        if not line:
+            raise EOFError('supervisord closed stdin')
+        found = get_name_and_len(line)
+        if found is None or self.wants(found[0]):
+            headers = childutils.get_headers(line)
+            return headers, stdin.read(int(headers['len']))
+        eventname, length = found
+        self.skip(stdin, length)
+        return {'eventname': eventname, 'len': str(length)}, None
+
+    def skip(self, stdin, length):
+        readinto = getattr(stdin, 'readinto', None)
+        if readinto is None or length <= self.smallpayload:
+            # readinto is missing from e.g. a StringIO in the tests
+            stdin.read(length)
+            return
+        size = len(self.buffer)
+        while length > 0:
+            if length < size:
+                count = readinto(self.view[:length])
+            else:
+                count = readinto(self.buffer)
+            if not count:
+                raise EOFError('supervisord closed stdin')
+            length -= count
@@ -29,6 +29,14 @@ fatalmailbatch.py [--interval=<batch interval in minutes>]
         [--toEmail=<email address>]
         [--fromEmail=<email address>]
         [--subject=<email subject>]
+        [--batchLines=<count>]
+        [--batchKeys=<count>]
+        [--flushSize=<count>]
+        [--urgentEvent=<event name>]
+        [--smtpStartTLS]
+        [--sendQueue=<count>]
+        [--spoolDir=<directory>]
+        [--notifyRate=<count>]
 
 Options:
 
@@ -42,6 +50,31 @@ Options:
 
 --subject - the email subject line
 
+--batchLines - the number of messages kept for each process in a batch.
+                  Older ones are counted instead, and the email says how
+                  many there were and when.  The default is 10.
+
+--batchKeys - the number of processes kept in a batch.  Events of any
+                  others are only counted.  The default is 100.
+
+--flushSize - send a batch as soon as it holds this many messages, without
+                  waiting for the end of the interval.
+
+--urgentEvent - send a batch as soon as it holds a message about this
+                  event (e.g. PROCESS_STATE_FATAL).  May be given more than once.
+
+--smtpStartTLS - use STARTTLS with the SMTP server
+
+--sendQueue - the number of emails waiting to be sent kept in memory.
+                  When it is full, new ones are spooled (see --spoolDir) or
+                  dropped.  The default is 100.
+
+--spoolDir  - a directory where emails which can't be sent yet are kept
+                  until the SMTP server takes them, even across restarts.
+
+--notifyRate - send at most this many emails a minute.  Those which come
+                  in meanwhile are combined.
+
 A sample invocation:
 
 fatalmailbatch.py --toEmail="you@bar.com" --fromEmail="me@bar.com"
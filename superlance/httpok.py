@@ -15,7 +15,8 @@
 
 # A event listener meant to be subscribed to TICK_60 (or TICK_5)
 # events, which restarts processes that are children of
-# supervisord based on the response from an HTTP port.
+# supervisord based on the response from an HTTP port, or from a
+# plain TCP port.
 
 # A supervisor config snippet that tells supervisor to use this script
 # as a listener is below.
@@ -26,7 +27,16 @@
 
 doc = """\
 httpok.py [-p processname] [-a] [-g] [-t timeout] [-c status_code] [-b inbody]
-          [-m mail_address] [-s sendmail] URL
+          [--body-regex] [--max-body=bytes] [-m mail_address] [-s sendmail]
+          [-f config] [--workers=count] [--keep-alive] [--latency=seconds]
+          [--latency-percentile=percent]
+          [--latency-window=count] [--failures=count] [--checks=count]
+          [--cooldown=seconds] [--max-cooldown=seconds] [--gcore-background]
+          [--gcore-jobs=count] [--gcore-defer] [--gcore-compress]
+          [--coredir-max=bytes] [--dns-ttl=seconds] [--action=action]
+          [--action-timeout=seconds] [--snapshot=path]
+          [--snapshot-age=seconds] [--notify=sink] [--notify-rate=count]
+          [URL]
 
 Options:
 
@@ -50,10 +60,28 @@ Options:
       file into this directory against each hung process before we
       restart it.  Append gcore stdout output to email.
 
+--gcore-background -- run gcore in the background instead of waiting
+      for it before restarting the process and acknowledging the
+      event.  Its output is mailed when it finishes.
+
+--gcore-jobs -- the maximum number of gcore programs run in the
+      background at a time.  Processes restarted while this many are
+      running are not dumped.  Default is 1.
+
+--gcore-defer -- with --gcore-background, restart a process when its
+      core dump has finished instead of straight away.
+
+--gcore-compress -- gzip core files once they are written.
+
+--coredir-max -- after each core dump, delete the oldest core files in
+      the core directory until they take up no more than this many bytes.
+
 -t -- The number of seconds that httpok should wait for a response
       before timing out.  If this timeout is exceeded, httpok will
       attempt to restart processes in the RUNNING state specified by
-      -p or -a.  This defaults to 10 seconds.
+      -p or -a.  This defaults to 10 seconds.  It covers the whole
+      check: looking up the host, connecting to each of its addresses,
+      and reading the response.
 
 -c -- specify an expected HTTP status code from a GET request to the
       URL.  If this status code is not the status code provided by the
@@ -65,7 +93,15 @@ Options:
       from the GET request.  If this string is not present in the
       response, the processes in the RUNNING state specified by -p
       or -a will be restarted.  The default is to ignore the
-      body.
+      body.  The body is read in pieces and only until the string is
+      found.
+
+--body-regex -- treat the -b string as a regular expression.  A match
+      must be shorter than 64KB.
+
+--max-body -- stop reading a response body after this many bytes.  If
+      the -b string has not been found by then, the check fails.  By
+      default the whole body is read.
 
 -s -- the sendmail command to use to send email
       (e.g. "/usr/sbin/sendmail -t -i").  Must be a command which accepts
@@ -82,7 +118,87 @@ Options:
 -E -- not "eager":  do not check URL / emit mail if no process we are
       monitoring is in the RUNNING state.
 
-URL -- The URL to which to issue a GET request.
+-f -- a file listing more URLs to check, one per line, each followed by
+      the names of the processes to restart when that URL fails.  A
+      name of '*' restarts any running process, like -a.  A URL with
+      no names restarts the processes given with -p or -a.  A word
+      action=ACTION among the names acts on them as for --action
+      instead; quote it if ACTION contains spaces.  Blank lines and
+      lines starting with '#' are ignored.  All URLs are checked at
+      the same time on each tick.
+
+--workers -- the maximum number of URLs checked at the same time when
+      more than one is configured.  Default is 10.
+
+--keep-alive -- keep the connection to each URL open between ticks
+      instead of connecting again every time.  A connection the server
+      has closed in the meantime is reopened and the request retried
+      once.
+
+--latency -- act as if the URL had failed when responses are slow:
+      when the --latency-percentile percentile of the total time taken
+      by the last --latency-window responses is more than this number
+      of seconds.  Not checked by default.
+
+--latency-percentile -- the percentile compared with --latency.
+      Default is 95.
+
+--latency-window -- the number of responses the percentile is taken
+      over.  Default is 10.
+
+--failures -- only restart a process when this many of the last --checks
+      checks of its URLs have failed.  Default is 1.
+
+--checks -- the number of recent checks --failures counts failures in.
+      Default is 1.
+
+--cooldown -- after restarting a process, do not restart it again for
+      this many seconds.  Each time a process is restarted again just
+      after its cooldown ends, the cooldown doubles, up to
+      --max-cooldown.  Default is 0.
+
+--max-cooldown -- the longest cooldown.  Default is 3600.
+
+--dns-ttl -- the number of seconds the addresses of a host are cached
+      for.  Default is 60.
+
+--action -- what to do to the processes of a URL which fails instead of
+      restarting them: "restart" (the default), "signal:NAME" to send
+      them the signal NAME (e.g. "signal:HUP" for processes which reload
+      on SIGHUP), or "exec:COMMAND" to run COMMAND with the shell, with
+      the name and pid of the process in $SUPERLANCE_PROCESS_NAME and
+      $SUPERLANCE_PROCESS_PID.  Signals are sent by supervisord 3.2 and
+      later, and by httpok itself for older versions.
+
+--action-timeout -- wait this many seconds for a process to be RUNNING
+      after acting on it, and report it if it isn't.  By default,
+      restarts wait as long as supervisord does, signals don't wait and
+      commands are waited for until they exit.
+
+--notify -- send notifications another way than with the -s command:
+      "sendmail:COMMAND", "smtp:HOST[:PORT]", "webhook:URL" to POST them
+      as JSON to an http(s) URL, or "file:PATH" to append them to an mbox
+      file.  Notifications are sent in the background.
+
+--notify-rate -- send at most this many notifications a minute.  Those
+      which come in meanwhile are combined into one for each address.
+      By default there is no limit.
+
+--snapshot -- share the process information fetched from supervisord on
+      each tick with other listeners through the file at this path, so
+      that only one of them needs to ask supervisord for it.  Give every
+      listener of the same supervisord the same path.
+
+--snapshot-age -- the number of seconds a snapshot may be reused for.
+      Default is 2.
+
+URL -- The URL to which to issue a GET request.  Optional if -f is
+      given.  A tcp://host:port URL checks that a connection to the
+      port can be made instead.  With ?send=data, the data is sent once
+      connected, and with ?expect=data, the check fails unless the data
+      is received within -t seconds (and --max-body bytes, or 64KB).
+      Both are URL-encoded, e.g.
+      tcp://localhost:6379/?send=PING%0D%0A&expect=%2BPONG.
 
 The -p option may be specified more than once, allowing for
 specification of multiple processes.  Specifying -a overrides any
@@ -92,72 +208,701 @@ A sample invocation:
 
 httpok.py -p program1 -p group1:program2 http://localhost:8080/tasty
 
+A sample config file for -f:
+
+http://localhost:8080/tasty program1 group1:program2
+http://localhost:8081/ *
+http://localhost:8082/ gunicorn action=signal:HUP
+
 """
 
 import os
+import re
 import sys
 import time
+import math
 import urlparse
-import xmlrpclib
+import threading
+import Queue
+import gzip
+import subprocess
+import socket
+import httplib
+import shlex
+from collections import deque
 
 from supervisor import childutils
 from supervisor.states import ProcessStates
 from supervisor.options import make_namespec
 
+import actions
+import events
+import notifier
 import timeoutconn
+import snapshot
+import transport
 
 def usage():
     print doc
     sys.exit(255)
 
+class Target:
+    """A URL to check and the processes to restart when it fails.  An
+    action of None is the listener's --action."""
+    def __init__(self, url, programs, any, action=None):
+        self.url = url
+        self.programs = programs
+        self.any = any
+        self.action = action
+
+        parsed = urlparse.urlsplit(url)
+        self.scheme = parsed[0].lower()
+        self.hostport = parsed[1]
+        self.path = parsed[2]
+        query = parsed[3]
+
+        if query:
+            self.path += '?' + query
+
+        self.connclass = None
+        if self.scheme == 'http':
+            self.connclass = timeoutconn.TimeoutHTTPConnection
+        elif self.scheme == 'https':
+            self.connclass = timeoutconn.TimeoutHTTPSConnection
+        elif self.scheme == 'tcp':
+            self.host, self.port = split_hostport(self.hostport)
+            if self.port is None:
+                raise ValueError('No port in %s' % url)
+            args = urlparse.parse_qs(query)
+            self.send = args.get('send', [None])[0]
+            self.matcher = None
+            expect = args.get('expect', [None])[0]
+            if expect:
+                self.matcher = BodyMatcher(expect)
+        else:
+            raise ValueError('Bad scheme %s' % self.scheme)
+
+        # the connection kept open between ticks with --keep-alive, and a
+        # lock held by the probe using it: a probe abandoned at the end of
+        # a sweep may still be using it on the next tick
+        self.conn = None
+        self.lock = threading.Lock()
+        # total times of the most recent responses, for --latency
+        self.latencies = deque()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def matches(self, info):
+        if self.any:
+            return True
+        namespec = make_namespec(info['group'], info['name'])
+        return info['name'] in self.programs or namespec in self.programs
+
+def split_hostport(hostport):
+    """Split 'host:port' or '[v6 address]:port' into host and integer
+    port, which is None if there isn't one."""
+    if hostport.startswith('['):
+        host, rest = hostport[1:].split(']', 1)
+        port = rest[1:]
+    elif ':' in hostport:
+        host, port = hostport.rsplit(':', 1)
+    else:
+        host, port = hostport, ''
+    if not port:
+        return host, None
+    return host, int(port)
+
+class SocketReader:
+    """Reads from a socket the way read_body reads a response, and notes
+    when the first data arrived."""
+    def __init__(self, sock, clock):
+        self.sock = sock
+        self.clock = clock
+        self.closed = False
+        self.first = None
+
+    def read(self, amt):
+        data = self.sock.recv(amt)
+        if self.first is None:
+            self.first = self.clock()
+        if not data:
+            self.closed = True
+        return data
+
+    def isclosed(self):
+        return self.closed
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a sequence of numbers."""
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+class BodyMatcher:
+    """A string, or with regex a regular expression, to look for in a
+    response body."""
+    def __init__(self, pattern, regex=False):
+        self.pattern = pattern
+        if regex:
+            self.regex = re.compile(pattern)
+            # how much of the body read so far is searched again with
+            # each new chunk, so matches across chunks aren't missed
+            self.overlap = 65536
+        else:
+            self.regex = None
+            self.overlap = len(pattern) - 1
+
+    def search(self, text):
+        if self.regex is None:
+            return self.pattern in text
+        return self.regex.search(text) is not None
+
+def read_body(res, matcher, maxbytes=None, chunksize=8192):
+    """Read the body of the response res in chunks until matcher finds
+    what it is looking for, the body ends, or maxbytes have been read.
+    Only the end of the body needed by matcher is kept.  Return (found,
+    complete): found is None if matcher is None, and complete is whether
+    the whole body was read."""
+    notfound = None
+    if matcher is not None:
+        notfound = False
+    tail = ''
+    count = 0
+    while 1:
+        size = chunksize
+        if maxbytes is not None:
+            size = min(size, maxbytes - count)
+            if size <= 0:
+                return notfound, False
+        chunk = res.read(size)
+        if not chunk:
+            return notfound, True
+        count += len(chunk)
+        if matcher is not None:
+            text = tail + chunk
+            if matcher.search(text):
+                return True, res.isclosed()
+            if matcher.overlap:
+                tail = text[-matcher.overlap:]
+
+def format_timings(timings):
+    return 'connect %.3fs, first byte %.3fs, total %.3fs' % timings
+
+class Damper:
+    """Decides whether a process whose check failed is restarted yet.
+    A process is held back until `failures` of its last `checks` checks
+    have failed, and for `cooldown` seconds after being restarted.  The
+    cooldown doubles, up to `maxcooldown`, each time the process fails
+    again straight after it; a check passed once the cooldown is over
+    resets it."""
+    def __init__(self, failures=1, checks=1, cooldown=0, maxcooldown=3600):
+        self.failures = failures
+        self.checks = max(checks, failures)
+        self.cooldown = cooldown
+        self.maxcooldown = maxcooldown
+        # namespec -> [recent results (True is a failure), restarts in a
+        # row, time before which it isn't restarted]
+        self.state = {}
+
+    def enabled(self):
+        return self.failures > 1 or self.cooldown > 0
+
+    def get(self, name):
+        state = self.state.get(name)
+        if state is None:
+            state = self.state[name] = [deque(), 0, 0]
+        return state
+
+    def record(self, name, failed, now):
+        results, restarts, until = state = self.get(name)
+        results.append(failed)
+        while len(results) > self.checks:
+            results.popleft()
+        if not failed and now >= until:
+            state[1] = 0
+
+    def ready(self, name, now):
+        """Return None if name may be restarted now, else the reason
+        it may not."""
+        if not self.enabled():
+            return None
+        results, restarts, until = self.get(name)
+        if now < until:
+            return 'restarted recently, not restarting for %d seconds' % (
+                until - now)
+        failed = len([x for x in results if x])
+        if failed < self.failures:
+            return '%d of the last %d checks failed, restarting after %d' % (
+                failed, len(results), self.failures)
+        return None
+
+    def restarted(self, name, now):
+        state = self.get(name)
+        state[0].clear()
+        state[1] += 1
+        delay = min(self.cooldown * 2 ** (state[1] - 1), self.maxcooldown)
+        state[2] = now + delay
+
+# the name gcore gives a core file: the name it was told to use (the
+# namespec), usually followed by the pid, and .gz once compressed
+CORE_NAME = re.compile(r'^(.+?)(\.\d+)?(\.gz)?$')
+
+class CoreDumper:
+    """Runs the gcore program against a process, optionally in one of at
+    most `jobs` background threads, then compresses the core file and
+    prunes the core directory as configured."""
+    def __init__(self, gcore, coredir, jobs=1, compress=False,
+                 maxsize=None):
+        self.gcore = gcore
+        self.coredir = coredir
+        self.jobs = jobs
+        self.compress = compress
+        self.maxsize = maxsize
+        # namespec -> thread of each background dump
+        self.running = {}
+        # the namespecs dumped so far
+        self.dumped = set()
+        self.done = Queue.Queue()
+
+    def dump(self, namespec, pid):
+        """Dump the core of pid and return the output to report."""
+        corename = os.path.join(self.coredir, namespec)
+        self.dumped.add(namespec)
+        started = time.time()
+        try:
+            p = subprocess.Popen(self.gcore + ' "%s" %s' % (corename, pid),
+                                 shell=True, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            output = p.communicate()[0]
+            if self.compress:
+                output += self.compressCores(corename, started)
+            if self.maxsize is not None:
+                output += self.prune(namespec)
+        except (OSError, IOError), why:
+            output = 'gcore failed: %s' % why
+        return output
+
+    def compressCores(self, corename, started):
+        """gzip the files gcore wrote for corename, whatever suffix it
+        gave them."""
+        output = ''
+        prefix = os.path.basename(corename)
+        for name in os.listdir(self.coredir):
+            path = os.path.join(self.coredir, name)
+            if not (name == prefix or name.startswith(prefix + '.')):
+                continue
+            if name.endswith('.gz') or os.path.getmtime(path) < started - 1:
+                continue
+            src = open(path, 'rb')
+            try:
+                dst = gzip.open(path + '.gz', 'wb')
+                try:
+                    while 1:
+                        chunk = src.read(1 << 20)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
+            os.remove(path)
+            output += '\n compressed %s to %s.gz' % (path, path)
+        return output
+
+    def prune(self, namespec=None):
+        """Delete the oldest core files in the core directory until they
+        take up no more than maxsize bytes.  Only files named like a core
+        (namespec.pid, or the namespec of one we dumped, either maybe
+        .gz) count, and those of dumps still running in the background,
+        other than that of namespec, are left alone."""
+        busy = [ name for name in self.running.keys() if name != namespec ]
+        output = ''
+        files = []
+        total = 0
+        for name in os.listdir(self.coredir):
+            path = os.path.join(self.coredir, name)
+            prefix, pid, gz = CORE_NAME.match(name).groups()
+            if pid is None and prefix not in self.dumped:
+                continue
+            if prefix in busy:
+                continue
+            if os.path.isfile(path):
+                size = os.path.getsize(path)
+                files.append((os.path.getmtime(path), size, path))
+                total += size
+        files.sort()
+        while total > self.maxsize and files:
+            mtime, size, path = files.pop(0)
+            os.remove(path)
+            total -= size
+            output += '\n removed %s to keep %s under %s bytes' % (
+                path, self.coredir, self.maxsize)
+        return output
+
+    def busy(self, namespec):
+        return namespec in self.running
+
+    def full(self):
+        return len(self.running) >= self.jobs
+
+    def start(self, namespec, pid):
+        """Dump the core of pid in the background.  The result is returned
+        by a later call to finished."""
+        thread = threading.Thread(target=self.run, args=(namespec, pid))
+        thread.setDaemon(True)
+        self.running[namespec] = thread
+        thread.start()
+
+    def run(self, namespec, pid):
+        self.done.put((namespec, self.dump(namespec, pid)))
+
+    def finished(self):
+        """Return a (namespec, output) pair for each background dump which
+        has finished since the last call."""
+        result = []
+        while 1:
+            try:
+                namespec, output = self.done.get_nowait()
+            except Queue.Empty:
+                break
+            del self.running[namespec]
+            result.append((namespec, output))
+        return result
+
+    def wait(self):
+        for thread in self.running.values():
+            thread.join()
+
+def parse_config(f, programs, any):
+    """Read 'URL [name ...] [action=ACTION]' lines from the file object f
+    into a list of Targets.  A name of '*' means any process; a URL
+    without names uses programs and any."""
+    targets = []
+    for line in f:
+        words = shlex.split(line)
+        if not words or words[0].startswith('#'):
+            continue
+        url, names = words[0], []
+        action = None
+        for word in words[1:]:
+            if word.startswith('action='):
+                action = actions.parse_action(word[len('action='):])
+            else:
+                names.append(word)
+        if not names:
+            targets.append(Target(url, programs, any, action))
+        elif '*' in names:
+            targets.append(Target(url, [], True, action))
+        else:
+            targets.append(Target(url, names, False, action))
+    return targets
+
+class ProbePool:
+    """A fixed number of daemon threads which run probes.  A probe that
+    has not finished by the deadline given to map() is abandoned: its
+    thread finishes it in the background and its result is dropped."""
+    def __init__(self, size):
+        self.size = size
+        self.requests = Queue.Queue()
+        self.threads = []
+
+    def start(self):
+        self.threads = [t for t in self.threads if t.isAlive()]
+        while len(self.threads) < self.size:
+            thread = threading.Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while 1:
+            func, index, arg, deadline, results = self.requests.get()
+            if time.time() < deadline:
+                results.put((index, func(arg)))
+
+    def map(self, func, args, timeout):
+        """Return a list with func(arg) for each of args, or None in place
+        of those which did not return within timeout seconds."""
+        self.start()
+        deadline = time.time() + timeout
+        # a queue per call, so late results from abandoned probes can't
+        # be mistaken for results of a later call
+        results = Queue.Queue()
+        for index, arg in enumerate(args):
+            self.requests.put((func, index, arg, deadline, results))
+        done = [None] * len(args)
+        for i in range(len(args)):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                index, result = results.get(True, remaining)
+            except Queue.Empty:
+                break
+            done[index] = result
+        return done
+
 class HTTPOk:
     connclass = None
+    clock = time.time
     def __init__(self, rpc, programs, any, url, timeout, status, inbody,
-                 email, sendmail, coredir, gcore, eager):
+                 email, sendmail, coredir, gcore, eager, targets=None,
+                 workers=10, keepalive=False, latency=None,
+                 latencypercentile=95, latencywindow=10, bodyregex=False,
+                 maxbody=None, damper=None, dumper=None,
+                 gcorebackground=False, gcoredefer=False, action=None,
+                 actiontimeout=None, notify=None):
         self.rpc = rpc
         self.programs = programs
         self.any = any
         self.url = url
+        if targets is None:
+            targets = [Target(url, programs, any)]
+        self.targets = targets
+        self.pool = ProbePool(workers)
+        self.keepalive = keepalive
+        self.latency = latency
+        self.latencypercentile = latencypercentile
+        self.latencywindow = latencywindow
         self.timeout = timeout
         self.status = status
         self.inbody = inbody
+        self.matcher = None
+        if inbody:
+            self.matcher = BodyMatcher(inbody, bodyregex)
+        self.maxbody = maxbody
+        if damper is None:
+            damper = Damper()
+        self.damper = damper
+        if dumper is None:
+            dumper = CoreDumper(gcore, coredir)
+        self.dumper = dumper
+        self.gcorebackground = gcorebackground
+        self.gcoredefer = gcoredefer
+        # namespecs to restart when their background core dump finishes,
+        # and the actions to restart them with
+        self.pending = []
+        self.pendingactions = {}
+        if action is None:
+            action = actions.Restart()
+        self.action = action
+        self.actiontimeout = actiontimeout
         self.email = email
         self.sendmail = sendmail
+        if notify is None:
+            notify = notifier.Notifier(notifier.SendmailSink(sendmail))
+        self.notifier = notify
         self.coredir = coredir
         self.gcore = gcore
         self.eager = eager
         self.stdin = sys.stdin
+        self.events = events.EventReader(['TICK_*'])
         self.stdout = sys.stdout
         self.stderr = sys.stderr
 
-    def listProcesses(self, state=None):
-        return [x for x in self.rpc.supervisor.getAllProcessInfo()
-                   if x['name'] in self.programs and
-                      (state is None or x['state'] == state)]
-
-    def runforever(self, test=False):
-        parsed = urlparse.urlsplit(self.url)
-        scheme = parsed[0].lower()
-        hostport = parsed[1]
-        path = parsed[2]
-        query = parsed[3]
-
-        if query:
-            path += '?' + query
-
-        if self.connclass:
-            ConnClass = self.connclass
-        elif scheme == 'http':
-            ConnClass = timeoutconn.TimeoutHTTPConnection
-        elif scheme == 'https':
-            ConnClass = timeoutconn.TimeoutHTTPSConnection
+    def activeTargets(self):
+        """Return the targets to check on this tick: all of them when
+        eager, otherwise those with at least one RUNNING process."""
+        if self.eager:
+            return self.targets
+        running = [x for x in self.rpc.supervisor.getAllProcessInfo()
+                      if x['state'] == ProcessStates.RUNNING]
+        return [t for t in self.targets
+                   if [x for x in running if t.matches(x)]]
+
+    def connect(self, target):
+        ConnClass = self.connclass or target.connclass
+        conn = ConnClass(target.hostport)
+        conn.timeout = self.timeout
+        return conn
+
+    def get(self, conn, path, deadline=None):
+        """Make a GET request and return the response, whether the -b
+        string was found in its body (None without -b), and the
+        (connect, first byte, total) seconds it took.  connect is 0 when
+        conn was already connected.  The request must be over by the
+        deadline, or -t seconds from now."""
+        if deadline is None:
+            deadline = time.time() + self.timeout
+        conn.deadline = deadline
+        start = self.clock()
+        if conn.sock is None:
+            conn.connect()
+        connected = self.clock()
+        conn.request('GET', path)
+        res = conn.getresponse()
+        firstbyte = self.clock()
+        found, complete = read_body(res, self.matcher, self.maxbody)
+        done = self.clock()
+        if not complete:
+            # the rest of the body is still on its way, so the connection
+            # can't be used for another request
+            conn.close()
+        return res, found, (connected - start, firstbyte - start, done - start)
+
+    def probe(self, target):
+        """GET the target's URL and return (status, found, msg, timings).
+        found is as returned by get; status and timings are None if the
+        request failed."""
+        if target.scheme == 'tcp':
+            return self.probeTCP(target)
+        if self.keepalive and target.lock.acquire(False):
+            try:
+                return self.probeKeepAlive(target)
+            finally:
+                target.lock.release()
+        conn = self.connect(target)
+        try:
+            try:
+                res, found, timings = self.get(conn, target.path)
+            finally:
+                conn.close()
+            status = res.status
+            msg = 'status contacting %s: %s %s\n\n %s' % (
+                target.url, res.status, res.reason, format_timings(timings))
+        except Exception, why:
+            found = None
+            status = None
+            timings = None
+            msg = 'error contacting %s:\n\n %s' % (target.url, why)
+        return status, found, msg, timings
+
+    def probeKeepAlive(self, target):
+        """Like probe, but reuse the connection left open by the previous
+        probe of target, and leave this one open for the next."""
+        # the retry has to fit in the same -t as the first attempt
+        deadline = time.time() + self.timeout
+        # httplib reconnects by itself after a response which said the
+        # server would close the connection
+        try:
+            if target.conn is None:
+                target.conn = self.connect(target)
+                res, found, timings = self.get(target.conn, target.path,
+                                               deadline)
+            else:
+                try:
+                    res, found, timings = self.get(target.conn, target.path,
+                                                   deadline)
+                except socket.timeout:
+                    raise
+                except (socket.error, httplib.HTTPException):
+                    # the server may have closed the connection since the
+                    # last tick; retry once on a new one
+                    target.close()
+                    target.conn = self.connect(target)
+                    res, found, timings = self.get(target.conn, target.path,
+                                                   deadline)
+        except Exception, why:
+            target.close()
+            return None, None, 'error contacting %s:\n\n %s' % (
+                target.url, why), None
+        msg = 'status contacting %s: %s %s\n\n %s' % (
+            target.url, res.status, res.reason, format_timings(timings))
+        return res.status, found, msg, timings
+
+    def probeTCP(self, target):
+        """Connect to a tcp:// target, send and expect its data if any,
+        and return (status, found, msg, timings) like probe.  status is
+        True if the connection was made."""
+        deadline = time.time() + self.timeout
+        start = self.clock()
+        try:
+            sock = timeoutconn.connect(target.host, target.port,
+                                       deadline=deadline)
+        except Exception, why:
+            return None, None, 'error connecting to %s:\n\n %s' % (
+                target.url, why), None
+        sock = timeoutconn.DeadlineSocket(sock, lambda: deadline)
+        connected = self.clock()
+        try:
+            try:
+                if target.send:
+                    sock.sendall(target.send)
+                reader = SocketReader(sock, self.clock)
+                found = None
+                if target.matcher is not None:
+                    maxbytes = self.maxbody
+                    if maxbytes is None:
+                        maxbytes = 65536
+                    try:
+                        found = read_body(reader, target.matcher, maxbytes)[0]
+                    except socket.timeout:
+                        found = False
+            except Exception, why:
+                return None, None, 'error talking to %s:\n\n %s' % (
+                    target.url, why), None
+        finally:
+            sock.close()
+        done = self.clock()
+        firstbyte = reader.first or done
+        timings = (connected - start, firstbyte - start, done - start)
+        if found is False:
+            msg = 'connected to %s, but did not receive %r' % (
+                target.url, target.matcher.pattern)
         else:
-            raise ValueError('Bad scheme %s' % scheme)
+            msg = 'connected to %s' % target.url
+        return True, found, '%s\n\n %s' % (msg, format_timings(timings)), \
+               timings
+
+    def failed(self, target, status, found):
+        """Return the subject of the mail about a failed check, or None if
+        it passed."""
+        if target.scheme == 'tcp':
+            if status is None:
+                return 'httpok for %s: connection failed' % target.url
+            if target.matcher is not None and not found:
+                return 'httpok for %s: bad response returned' % target.url
+        elif str(status) != str(self.status):
+            return 'httpok for %s: bad status returned' % target.url
+        elif self.matcher and not found:
+            return 'httpok for %s: bad body returned' % target.url
+        return None
+
+    def slow(self, target, timings):
+        """Record the total time of a response to target, and return a
+        message if the --latency percentile of the recent ones is over
+        the limit, else None."""
+        if self.latency is None or timings is None:
+            return None
+        latencies = target.latencies
+        latencies.append(timings[2])
+        while len(latencies) > self.latencywindow:
+            latencies.popleft()
+        if len(latencies) < self.latencywindow:
+            return None
+        value = percentile(latencies, self.latencypercentile)
+        if value <= self.latency:
+            return None
+        return ('p%g latency of the last %s responses from %s was %.3fs, '
+                'over the limit of %.3fs' % (
+                    self.latencypercentile, len(latencies), target.url,
+                    value, self.latency))
+
+    def sweep(self, targets):
+        """Probe targets and return a list of (target, result) pairs.
+        More than one target is probed concurrently, and the sweep
+        finishes within one timeout however many there are."""
+        if len(targets) == 1:
+            return [(targets[0], self.probe(targets[0]))]
+        results = self.pool.map(self.probe, targets, self.timeout)
+        for i in range(len(targets)):
+            if results[i] is None:
+                why = 'no response within %s seconds' % self.timeout
+                msg = 'error contacting %s:\n\n %s' % (targets[i].url, why)
+                results[i] = (None, None, msg, None)
+        return zip(targets, results)
 
+    def runforever(self, test=False):
         while 1:
             # we explicitly use self.stdin, self.stdout, and self.stderr
             # instead of sys.* so we can unit test this code
-            headers, payload = childutils.listener.wait(self.stdin, self.stdout)
+            headers, payload = self.events.wait(self.stdin, self.stdout)
+
+            self.collectDumps()
 
             if not headers['eventname'].startswith('TICK'):
                 # do nothing with non-TICK events
@@ -166,41 +911,115 @@ class HTTPOk:
                     break
                 continue
 
-            conn = ConnClass(hostport)
-            conn.timeout = self.timeout
-
-            act = False
-
-            specs = self.listProcesses(ProcessStates.RUNNING)
-            if self.eager or len(specs) > 0:
-
-                try:
-                    conn.request('GET', path)
-                    res = conn.getresponse()
-                    body = res.read()
-                    status = res.status
-                    msg = 'status contacting %s: %s %s' % (self.url,
-                                                           res.status,
-                                                           res.reason)
-                except Exception, why:
-                    body = ''
-                    status = None
-                    msg = 'error contacting %s:\n\n %s' % (self.url, why)
-
-                if str(status) != str(self.status):
-                    subject = 'httpok for %s: bad status returned' % self.url
-                    self.act(subject, msg)
-                elif self.inbody and self.inbody not in body:
-                    act = True
-                    subject = 'httpok for %s: bad body returned' % self.url
-                    self.act(subject, msg)
+            snapshot.set_tick(self.rpc, payload)
+            targets = self.activeTargets()
+            failing = []
+            for target, (status, found, msg, timings) in self.sweep(targets):
+                slow = self.slow(target, timings)
+                subject = self.failed(target, status, found)
+                if subject is None and slow:
+                    subject = 'httpok for %s: slow responses' % target.url
+                    msg = '%s\n\n%s' % (slow, msg)
+                if subject is None:
+                    continue
+                failing.append((target, subject, msg))
+
+            if self.damper.enabled():
+                # passing checks count too: they break up failures
+                failing = self.damp(targets, failing)
+
+            restarted = []
+            for target, subject, msg in failing:
+                # don't hold responses from before a restart against the
+                # restarted processes
+                target.latencies.clear()
+                self.act(subject, msg, target.programs, target.any,
+                         restarted, target.action)
 
             childutils.listener.ok(self.stdout)
             if test:
                 break
 
-    def act(self, subject, msg):
+    def damp(self, targets, failing):
+        """Record the result of this tick's checks for each RUNNING process
+        and return the failing targets with at least one process the
+        damper lets us restart."""
+        try:
+            infos = self.rpc.supervisor.getAllProcessInfo()
+        except Exception, why:
+            # act() will report it
+            return failing
+        now = self.clock()
+        failed = [x[0] for x in failing]
+        running = [x for x in infos if x['state'] == ProcessStates.RUNNING]
+        for info in running:
+            matched = [t for t in targets if t.matches(info)]
+            if matched:
+                name = make_namespec(info['group'], info['name'])
+                isfailed = len([t for t in matched if t in failed]) > 0
+                self.damper.record(name, isfailed, now)
+
+        ready = []
+        for target, subject, msg in failing:
+            names = [make_namespec(x['group'], x['name'])
+                        for x in running if target.matches(x)]
+            held = []
+            for name in names:
+                reason = self.damper.ready(name, now)
+                if reason is not None:
+                    held.append('%s: %s' % (name, reason))
+            if names and len(held) == len(names):
+                self.stderr.write('%s, not restarting yet\n %s\n' % (
+                    subject, '\n '.join(held)))
+                self.stderr.flush()
+                continue
+            ready.append((target, subject, msg))
+        return ready
+
+    def collectDumps(self):
+        """Report the background core dumps which have finished, and make
+        the restarts deferred until they did."""
+        for namespec, output in self.dumper.finished():
+            messages = []
+
+            def write(msg):
+                self.stderr.write('%s\n' % msg)
+                self.stderr.flush()
+                messages.append(msg)
+
+            write('gcore output for %s:\n\n %s' % (namespec, output))
+            if namespec in self.pending:
+                self.pending.remove(namespec)
+                write('%s dumped, restarting' % namespec)
+                self.restartNow([namespec], write,
+                                self.pendingactions.pop(namespec, None))
+
+            if self.email:
+                subject = 'httpok: gcore of %s finished' % namespec
+                self.mail(self.email, subject, '\n'.join(messages))
+
+    def act(self, subject, msg, programs=None, any=None, restarted=None,
+            action=None):
+        """Restart the RUNNING processes among programs (or all of them if
+        any) and mail about it.  Processes named in restarted, a list of
+        those already restarted on this tick, are skipped.  action is
+        what to do to them instead, if not the --action one."""
+        if programs is None:
+            programs = self.programs
+        if any is None:
+            any = self.any
+        if restarted is None:
+            restarted = []
+        if action is None:
+            action = self.action
+        if isinstance(action, actions.Restart):
+            doing = 'Restarting'
+        else:
+            doing = 'Running %s on' % action
+
         messages = [msg]
+        # the processes to act on, all with one call to perform
+        due = []
 
         def write(msg):
             self.stderr.write('%s\n' % msg)
@@ -213,39 +1032,41 @@ class HTTPOk:
             write('Exception retrieving process info %s, not acting' % why)
             return
             
-        waiting = list(self.programs)
+        waiting = list(programs)
             
-        if self.any:
-            write('Restarting all running processes')
+        if any:
+            write('%s all running processes' % doing)
             for spec in specs:
                 name = spec['name']
                 group = spec['group']
-                self.restart(spec, write)
+                self.restart(spec, write, restarted, action, due)
                 namespec = make_namespec(group, name)
                 if name in waiting:
                     waiting.remove(name)
                 if namespec in waiting:
                     waiting.remove(namespec)
         else:
-            write('Restarting selected processes %s' % self.programs)
+            write('%s selected processes %s' % (doing, programs))
             for spec in specs:
                 name = spec['name']
                 group = spec['group']
                 namespec = make_namespec(group, name)
-                if (name in self.programs) or (namespec in self.programs):
-                    self.restart(spec, write)
+                if (name in programs) or (namespec in programs):
+                    self.restart(spec, write, restarted, action, due)
                     if name in waiting:
                         waiting.remove(name)
                     if namespec in waiting:
                         waiting.remove(namespec)
 
+        if due:
+            self.restartNow(due, write, action)
+
         if waiting:
             write(
                 'Programs not restarted because they did not exist: %s' %
                 waiting)
 
         if self.email:
-            now = time.asctime()
             message = '\n'.join(messages)
             self.mail(self.email, subject, message)
 
@@ -254,42 +1075,96 @@ class HTTPOk:
         body += 'Subject: %s\n' % subject
         body += '\n'
         body += msg
-        m = os.popen(self.sendmail, 'w')
-        m.write(body)
-        m.close()
+        self.notifier.sendtext(body)
         self.stderr.write('Mailed:\n\n%s' % body)
         self.mailed = body
 
-    def restart(self, spec, write):
+    def restart(self, spec, write, restarted=None, action=None, due=None):
+        """Act on the process of spec if it is RUNNING.  With due, a list,
+        its namespec is added to it for the caller to act on instead."""
         namespec = make_namespec(spec['group'], spec['name'])
+        if action is None:
+            action = self.action
+        if isinstance(action, actions.Restart):
+            doing = 'restarting'
+        else:
+            doing = 'running %s' % action
+        held = None
         if spec['state'] is ProcessStates.RUNNING:
+            held = self.damper.ready(namespec, self.clock())
+        if restarted is not None and namespec in restarted:
+            write('%s already restarted' % namespec)
+        elif held is not None:
+            write('%s is in RUNNING state, not restarting yet: %s' % (
+                namespec, held))
+        elif spec['state'] is ProcessStates.RUNNING:
+            if restarted is not None:
+                restarted.append(namespec)
+            if self.damper.enabled():
+                self.damper.restarted(namespec, self.clock())
             if self.coredir and self.gcore:
-                corename = os.path.join(self.coredir, namespec)
-                m = os.popen(self.gcore + ' "%s" %s' % (corename, spec['pid']))
-                write('gcore output for %s:\n\n %s' % (namespec, m.read()))
-                m.close()
-            write('%s is in RUNNING state, restarting' % namespec)
-            try:
-                self.rpc.supervisor.stopProcess(namespec)
-            except xmlrpclib.Fault, what:
-                write('Failed to stop process %s: %s' % (
-                    namespec, what))
-
-            try:
-                self.rpc.supervisor.startProcess(namespec)
-            except xmlrpclib.Fault, what:
-                write('Failed to start process %s: %s' % (
-                    namespec, what))
+                if not self.gcorebackground:
+                    output = self.dumper.dump(namespec, spec['pid'])
+                    write('gcore output for %s:\n\n %s' % (namespec, output))
+                elif namespec in self.pending:
+                    write('%s is in RUNNING state, restarting when its gcore '
+                          'finishes' % namespec)
+                    return
+                elif self.dumper.busy(namespec):
+                    write('gcore of %s is still running, not dumping it '
+                          'again' % namespec)
+                elif self.dumper.full():
+                    write('%d gcore programs are already running, not '
+                          'dumping %s' % (len(self.dumper.running),
+                                          namespec))
+                elif self.gcoredefer:
+                    self.dumper.start(namespec, spec['pid'])
+                    self.pending.append(namespec)
+                    self.pendingactions[namespec] = action
+                    write('%s is in RUNNING state, running gcore, '
+                          '%s when it finishes' % (namespec, doing))
+                    return
+                else:
+                    self.dumper.start(namespec, spec['pid'])
+                    write('gcore of %s started in the background' % namespec)
+            write('%s is in RUNNING state, %s' % (namespec, doing))
+            if due is None:
+                self.restartNow([namespec], write, action)
             else:
-                write('%s restarted' % namespec)
+                due.append(namespec)
 
         else:
             write('%s not in RUNNING state, NOT restarting' % namespec)
+
+    def restartNow(self, namespecs, write, action=None):
+        if action is None:
+            action = self.action
+        for namespec, failures in action.perform(self.rpc, namespecs,
+                                                 self.actiontimeout):
+            for stage, error in failures:
+                if stage in ('stop', 'start'):
+                    write('Failed to %s process %s: %s' % (stage, namespec,
+                                                           error))
+                elif stage == 'wait':
+                    write('%s is not RUNNING after %s: %s' % (
+                        namespec, action, error))
+                else:
+                    write('Failed to run %s on %s: %s' % (action, namespec,
+                                                          error))
+
+            # a process which wasn't running to be stopped has still been
+            # started
+            if [stage for stage, error in failures if stage != 'stop']:
+                continue
+            if isinstance(action, actions.Restart):
+                write('%s restarted' % namespec)
+            else:
+                write('ran %s on %s' % (action, namespec))
             
 
 def main(argv=sys.argv):
     import getopt
-    short_args="hp:at:c:b:s:m:g:d:eE"
+    short_args="hp:at:c:b:s:m:g:d:eEf:"
     long_args=[
         "help",
         "program=",
@@ -297,12 +1172,36 @@ def main(argv=sys.argv):
         "timeout=",
         "code=",
         "body=",
+        "body-regex",
+        "max-body=",
         "sendmail_program=",
         "email=",
         "gcore=",
         "coredir=",
         "eager",
         "not-eager",
+        "config=",
+        "workers=",
+        "keep-alive",
+        "latency=",
+        "latency-percentile=",
+        "latency-window=",
+        "failures=",
+        "checks=",
+        "cooldown=",
+        "max-cooldown=",
+        "gcore-background",
+        "gcore-jobs=",
+        "gcore-defer",
+        "gcore-compress",
+        "coredir-max=",
+        "dns-ttl=",
+        "action=",
+        "action-timeout=",
+        "snapshot=",
+        "snapshot-age=",
+        "notify=",
+        "notify-rate=",
         ]
     arguments = argv[1:]
     try:
@@ -310,8 +1209,6 @@ def main(argv=sys.argv):
     except:
         usage()
 
-    if not args:
-        usage()
     if len(args) > 1:
         usage()
 
@@ -325,6 +1222,29 @@ def main(argv=sys.argv):
     timeout = 10
     status = '200'
     inbody = None
+    bodyregex = False
+    maxbody = None
+    config = None
+    workers = 10
+    keepalive = False
+    latency = None
+    latencypercentile = 95
+    latencywindow = 10
+    failures = 1
+    checks = 1
+    cooldown = 0
+    maxcooldown = 3600
+    gcorebackground = False
+    gcorejobs = 1
+    gcoredefer = False
+    gcorecompress = False
+    coredirmax = None
+    action = None
+    actiontimeout = None
+    snapshotpath = None
+    snapshotage = 2
+    sink = None
+    notifyrate = None
 
     for option, value in opts:
 
@@ -352,6 +1272,12 @@ def main(argv=sys.argv):
         if option in ('-b', '--body'):
             inbody = value
 
+        if option == '--body-regex':
+            bodyregex = True
+
+        if option == '--max-body':
+            maxbody = int(value)
+
         if option in ('-g', '--gcore'):
             gcore = value
 
@@ -364,10 +1290,99 @@ def main(argv=sys.argv):
         if option in ('-E', '--not-eager'):
             eager = False
 
-    url = arguments[-1]
+        if option in ('-f', '--config'):
+            config = value
+
+        if option == '--workers':
+            workers = int(value)
+
+        if option == '--keep-alive':
+            keepalive = True
+
+        if option == '--latency':
+            latency = float(value)
+
+        if option == '--latency-percentile':
+            latencypercentile = float(value)
+
+        if option == '--latency-window':
+            latencywindow = int(value)
+
+        if option == '--failures':
+            failures = int(value)
+
+        if option == '--checks':
+            checks = int(value)
+
+        if option == '--cooldown':
+            cooldown = int(value)
+
+        if option == '--max-cooldown':
+            maxcooldown = int(value)
+
+        if option == '--gcore-background':
+            gcorebackground = True
+
+        if option == '--gcore-jobs':
+            gcorejobs = int(value)
+
+        if option == '--gcore-defer':
+            gcoredefer = True
+
+        if option == '--gcore-compress':
+            gcorecompress = True
+
+        if option == '--coredir-max':
+            coredirmax = int(value)
+
+        if option == '--dns-ttl':
+            timeoutconn.resolver.ttl = int(value)
+
+        if option == '--action':
+            try:
+                action = actions.parse_action(value)
+            except ValueError, why:
+                print 'Unparseable action %r for %r: %s' % (value, option,
+                                                            why)
+                usage()
+
+        if option == '--action-timeout':
+            actiontimeout = int(value)
+
+        if option == '--snapshot':
+            snapshotpath = value
+
+        if option == '--snapshot-age':
+            snapshotage = int(value)
+
+        if option == '--notify':
+            try:
+                sink = notifier.make_sink(value)
+            except ValueError, why:
+                print 'Unparseable notifier %r for %r: %s' % (value, option,
+                                                              why)
+                usage()
+
+        if option == '--notify-rate':
+            notifyrate = int(value)
+
+    if not args and not config:
+        usage()
+
+    url = None
+    targets = []
+    if args:
+        url = args[0]
+        targets.append(Target(url, programs, any))
+    if config:
+        f = open(config)
+        try:
+            targets.extend(parse_config(f, programs, any))
+        finally:
+            f.close()
 
     try:
-        rpc = childutils.getRPCInterface(os.environ)
+        rpc = transport.getRPCInterface(os.environ)
     except KeyError, why:
         if why[0] != 'SUPERVISOR_SERVER_URL':
             raise
@@ -376,9 +1391,26 @@ def main(argv=sys.argv):
         sys.stderr.flush()
         return
 
+    if snapshotpath:
+        rpc = snapshot.wrap(rpc, snapshotpath, snapshotage)
+
+    if sink is None:
+        sink = notifier.SendmailSink(sendmail)
+    notify = notifier.Notifier(sink, rate=notifyrate)
     prog = HTTPOk(rpc, programs, any, url, timeout, status, inbody, email,
-                  sendmail, coredir, gcore, eager)
-    prog.runforever()
+                  sendmail, coredir, gcore, eager, targets, workers,
+                  keepalive, latency, latencypercentile, latencywindow,
+                  bodyregex, maxbody,
+                  Damper(failures, checks, cooldown, maxcooldown),
+                  CoreDumper(gcore, coredir, gcorejobs, gcorecompress,
+                             coredirmax),
+                  gcorebackground, gcoredefer, action, actiontimeout, notify)
+    notify.start()
+    try:
+        prog.runforever()
+    finally:
+        # httpok exits after mailing that it couldn't restart a process
+        notify.stop(30)
 
 if __name__ == '__main__':
     main()
@@ -15,9 +15,10 @@
 
 # A event listener meant to be subscribed to TICK_60 (or TICK_5)
 # events, which restarts any processes that are children of
-# supervisord that consume "too much" memory.  Performs horrendous
-# screenscrapes of ps output.  Works on Linux and OS X (Tiger/Leopard)
-# as far as I know.
+# supervisord that consume "too much" memory.  On Linux, RSS is read
+# straight out of /proc; elsewhere it performs horrendous screenscrapes
+# of ps output.  Works on Linux and OS X (Tiger/Leopard) as far as I
+# know.
 
 # A supervisor config snippet that tells supervisor to use this script
 # as a listener is below.
@@ -28,7 +29,11 @@
 
 doc = """\
 memmon.py [-p processname=byte_size]  [-g groupname=byte_size] 
-          [-a byte_size] [-s sendmail] [-m email_address]
+          [-a byte_size] [-s sendmail] [-m email_address] [-S sampler]
+          [-l byte_size] [-w samples] [-L action] [-n max_restarts]
+          [-k keep_running] [--action=action] [--action-timeout=seconds]
+          [--snapshot=path] [--snapshot-age=seconds] [--notify=sink]
+          [--notify-rate=count]
 
 Options:
 
@@ -52,6 +57,62 @@ Options:
       address when any process is restarted.  If no email address is
       specified, email will not be sent.
 
+-S -- the method used to sample the RSS of processes: "proc" reads
+      /proc/<pid>/statm for every process in a single pass without
+      spawning anything (Linux only), "ps" runs the ps command once
+      per process.  Default is "auto", which uses "proc" where /proc
+      is available and "ps" elsewhere.
+
+-l -- specify a byte_size per minute.  Act on any child of the supervisord
+      under which this runs whose RSS is growing faster than this,
+      measured as the slope of a line fitted to its last -w samples.
+      Leak detection is off by default.
+
+-w -- the number of samples (one per TICK event) to fit the growth rate
+      used by -l to.  Default is 10.
+
+-L -- what to do when a process grows faster than -l: "restart" it
+      (the default) or just "mail" the -m address about it.
+
+-n -- restart at most this many processes in any one group per TICK
+      event.  Processes over their limit are restarted in order of how
+      far over it they are; the rest are checked again on the next TICK.
+      By default there is no limit.
+
+-k -- never restart a process if that would leave fewer than this many
+      processes of its group in the RUNNING state.  By default there is
+      no minimum.
+
+--action -- what to do to a process instead of restarting it:
+      "restart" (the default), "signal:NAME" to send it the signal NAME
+      (e.g. "signal:HUP" for processes which reload on SIGHUP), or
+      "exec:COMMAND" to run COMMAND with the shell, with the name and pid
+      of the process in $SUPERLANCE_PROCESS_NAME and
+      $SUPERLANCE_PROCESS_PID.  Signals are sent by supervisord 3.2 and
+      later, and by memmon itself for older versions.
+
+--action-timeout -- wait this many seconds for a process to be RUNNING
+      after acting on it, and count it as a failure if it isn't.  By
+      default, restarts wait as long as supervisord does, signals don't
+      wait and commands are waited for until they exit.
+
+--notify -- send notifications another way than with the -s command:
+      "sendmail:COMMAND", "smtp:HOST[:PORT]", "webhook:URL" to POST them
+      as JSON to an http(s) URL, or "file:PATH" to append them to an mbox
+      file.  Notifications are sent in the background.
+
+--notify-rate -- send at most this many notifications a minute.  Those
+      which come in meanwhile are combined into one for each address.
+      By default there is no limit.
+
+--snapshot -- share the process information fetched from supervisord on
+      each tick with other listeners through the file at this path, so
+      that only one of them needs to ask supervisord for it.  Give every
+      listener of the same supervisord the same path.
+
+--snapshot-age -- the number of seconds a snapshot may be reused for.
+      Default is 2.
+
 The -p and -g options may be specified more than once, allowing for
 specification of multiple groups and processes.
 
@@ -59,18 +120,44 @@ Any byte_size can be specified as a plain integer (10000) or a
 suffix-multiplied integer (e.g. 1GB).  Valid suffixes are 'KB', 'MB'
 and 'GB'.
 
+Any byte_size may be followed by comma-separated modifiers which
+change how the -p, -g or -a rule it belongs to is applied:
+
+  tree   -- compare the total memory of the process and all of its
+            descendants (e.g. forked workers) against byte_size
+  leader -- compare only the memory of the process itself (the default)
+  rss    -- measure resident set size (the default)
+  pss    -- measure proportional set size, which splits pages shared
+            between processes evenly among them (Linux only)
+  uss    -- measure unique set size, the memory private to the process
+            (Linux only)
+  restart, signal:NAME, exec:COMMAND
+         -- what to do to processes over byte_size, as for --action (a
+            COMMAND given here can't contain commas)
+
 A sample invocation:
 
 memmon.py -p program1=200MB -p theprog:thegroup=100MB -g thegroup=100MB -a 1GB -s "/usr/sbin/sendmail -t -i" -m chrism@plope.com
+
+memmon.py -p gunicorn=4GB,tree -g thegroup=100MB,pss
+
+memmon.py -p gunicorn=4GB,tree,signal:HUP --action-timeout=30
 """
 
 import os
 import sys
 import time
-import xmlrpclib
+import array
 
 from supervisor import childutils
 from supervisor.datatypes import byte_size
+from supervisor.states import ProcessStates
+
+from superlance import actions
+from superlance import events
+from superlance import notifier
+from superlance import snapshot
+from superlance import transport
 
 def usage():
     print doc
@@ -79,8 +166,199 @@ def usage():
 def shell(cmd):
     return os.popen(cmd).read()
 
+class ProcessTree:
+    """ A parent pid -> child pids index of every process on the
+    host, built from a single scan. """
+    def __init__(self, children):
+        self.children = children
+
+    def descendants(self, pid):
+        found = []
+        stack = [pid]
+        while stack:
+            children = self.children.get(stack.pop(), ())
+            found.extend(children)
+            stack.extend(children)
+        return found
+
+class PSSampler:
+    """ Samples RSS by running the ps command once per pid.  Portable,
+    but forks a shell and ps for every process on every tick. """
+    def __init__(self, pscommand='ps -orss= -p %s'):
+        self.pscommand = pscommand
+        self.pstreecommand = 'ps -A -o pid= -o ppid='
+
+    def sample(self, pids):
+        rsses = {}
+        for pid in pids:
+            data = shell(self.pscommand % pid)
+            if not data:
+                # no such pid (deal with race conditions)
+                continue
+
+            try:
+                rss = data.lstrip().rstrip()
+                rss = int(rss) * 1024 # rss is in KB
+            except ValueError:
+                # line doesn't contain any data, or rss cant be intified
+                continue
+
+            rsses[pid] = rss
+        return rsses
+
+    def smaps(self, pid):
+        # ps knows nothing about PSS or USS
+        return None
+
+    def tree(self):
+        children = {}
+        for line in shell(self.pstreecommand).splitlines():
+            try:
+                pid, ppid = [ int(x) for x in line.split() ]
+            except ValueError:
+                continue
+            children.setdefault(ppid, []).append(pid)
+        return ProcessTree(children)
+
+class ProcSampler:
+    """ Samples RSS by reading /proc/<pid>/statm for every pid in a
+    single pass, without spawning any processes.  Linux only. """
+    def __init__(self, procdir='/proc'):
+        self.procdir = procdir
+        self.pagesize = os.sysconf('SC_PAGE_SIZE')
+
+    def available(cls, procdir='/proc'):
+        return os.path.exists(os.path.join(procdir, 'self', 'statm'))
+    available = classmethod(available)
+
+    def sample(self, pids):
+        rsses = {}
+        for pid in pids:
+            data = read_proc_file(self.procdir, pid, 'statm')
+            if not data:
+                # no such pid (deal with race conditions)
+                continue
+
+            # statm is "size resident shared text lib data dt", in pages
+            try:
+                rss = int(data.split()[1]) * self.pagesize
+            except (IndexError, ValueError):
+                continue
+
+            rsses[pid] = rss
+        return rsses
+
+    def tree(self):
+        children = {}
+        for entry in os.listdir(self.procdir):
+            if not entry.isdigit():
+                continue
+            data = read_proc_file(self.procdir, entry, 'stat')
+            if not data:
+                continue
+
+            # stat is "pid (comm) state ppid ...", and comm may itself
+            # contain spaces and parens
+            fields = data[data.rfind(')') + 1:].split()
+            try:
+                ppid = int(fields[1])
+            except (IndexError, ValueError):
+                continue
+
+            children.setdefault(ppid, []).append(int(entry))
+        return ProcessTree(children)
+
+    def smaps(self, pid):
+        """ Return a dict of the 'rss', 'pss' and 'uss' of pid in bytes,
+        or None if it can't be read.  This is much more expensive than
+        statm for processes with large address spaces. """
+        data = read_proc_file(self.procdir, pid, 'smaps_rollup')
+        if not data:
+            # kernels before 4.14 only have the per-mapping smaps
+            data = read_proc_file(self.procdir, pid, 'smaps')
+            if not data:
+                return None
+
+        totals = {'Rss':0, 'Pss':0, 'Private_Clean':0, 'Private_Dirty':0,
+                  'Private_Hugetlb':0}
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                key = fields[0][:-1]
+                if key in totals:
+                    totals[key] += int(fields[1])
+
+        uss = (totals['Private_Clean'] + totals['Private_Dirty'] +
+               totals['Private_Hugetlb'])
+        return {'rss':totals['Rss'] * 1024, 'pss':totals['Pss'] * 1024,
+                'uss':uss * 1024}
+
+def read_proc_file(procdir, pid, name):
+    try:
+        f = open(os.path.join(procdir, str(pid), name))
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+DEFAULT_MODES = {'scope':'leader', 'metric':'rss', 'action':None}
+
+class History:
+    """ A fixed-size ring buffer of (time, size) samples of one
+    process. """
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.values = array.array('d', [0.0]) * size
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def full(self):
+        return self.count >= self.size
+
+    def append(self, when, value):
+        index = self.count % self.size
+        self.times[index] = when
+        self.values[index] = value
+        self.count += 1
+
+    def slope(self):
+        """ Return the least-squares growth rate of the samples, in
+        units per second. """
+        n = len(self)
+        if n < 2:
+            return 0.0
+        # relative to the first sample to keep the sums small
+        t0 = min(self.times[:n])
+        sum_t = sum_v = sum_tt = sum_tv = 0.0
+        for i in range(n):
+            t = self.times[i] - t0
+            v = self.values[i]
+            sum_t += t
+            sum_v += v
+            sum_tt += t * t
+            sum_tv += t * v
+        denominator = n * sum_tt - sum_t * sum_t
+        if not denominator:
+            return 0.0
+        return (n * sum_tv - sum_t * sum_v) / denominator
+
+def make_sampler(name):
+    """ Return a sampler for 'auto', 'proc' or 'ps'.  None means the
+    ps sampler built from Memmon.pscommand. """
+    if name == 'proc' or (name == 'auto' and ProcSampler.available()):
+        return ProcSampler()
+    return None
+
 class Memmon:
-    def __init__(self, programs, groups, any, sendmail, email, rpc):
+    def __init__(self, programs, groups, any, sendmail, email, rpc,
+                 sampler=None, modes=None, leak=None, window=10,
+                 leakaction='restart', maxrestarts=None, keeprunning=None,
+                 action=None, actiontimeout=None, notify=None):
         self.programs = programs
         self.groups = groups
         self.any = any
@@ -88,16 +366,182 @@ class Memmon:
         self.email = email
         self.rpc = rpc
         self.stdin = sys.stdin
+        self.events = events.EventReader(['TICK_*'])
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         self.pscommand = 'ps -orss= -p %s'
+        self.sampler = sampler
+        # rule -> modifiers, where rule is one of ('program', name),
+        # ('group', name) or ('any', None)
+        if modes is None:
+            modes = {}
+        self.modes = modes
+        self.leak = leak
+        self.window = window
+        self.leakaction = leakaction
+        # process name -> (pid, History)
+        self.histories = {}
+        self.maxrestarts = maxrestarts
+        self.keeprunning = keeprunning
+        # restarts waiting for the end of the tick when staggered
+        self.queue = []
+        if action is None:
+            action = actions.Restart()
+        self.action = action
+        self.actiontimeout = actiontimeout
+        if notify is None:
+            notify = notifier.Notifier(notifier.SendmailSink(sendmail))
+        self.notifier = notify
         self.mailed = False # for unit tests
 
+    def get_sampler(self):
+        if self.sampler is None:
+            return PSSampler(self.pscommand)
+        return self.sampler
+
+    def rules(self, name, pname, group):
+        rules = []
+        for n in name, pname:
+            if n in self.programs:
+                rules.append((('program', n), self.programs[n]))
+        if group in self.groups:
+            rules.append((('group', group), self.groups[group]))
+        if self.any is not None:
+            rules.append((('any', None), self.any))
+        return rules
+
+    def get_mode(self, rule, mode):
+        return self.modes.get(rule, {}).get(mode, DEFAULT_MODES[mode])
+
+    def get_action(self, rule):
+        return self.get_mode(rule, 'action') or self.action
+
+    def measure(self, rule, limit, pid, pname, rsses, families, smaps):
+        """ Return (metric, description, size) for the memory of pid that
+        rule applies to.  smaps caches expensive smaps reads for this
+        tick. """
+        pids = [pid]
+        desc = pname
+        if self.get_mode(rule, 'scope') == 'tree':
+            pids.extend(families[pid])
+            desc = '%s and %s descendants' % (pname, len(families[pid]))
+
+        size = 0
+        for p in pids:
+            size += rsses.get(p, 0)
+
+        metric = self.get_mode(rule, 'metric')
+        if metric == 'rss' or size <= limit:
+            # PSS and USS are never larger than RSS, so smaps is only
+            # worth reading for processes whose RSS is over the limit
+            return 'RSS', desc, size
+
+        sampler = self.get_sampler()
+        detailed = 0
+        for p in pids:
+            if p not in smaps:
+                smaps[p] = sampler.smaps(p)
+            if smaps[p] is None:
+                if p == pid:
+                    # can't read smaps at all, RSS will have to do
+                    return 'RSS', desc, size
+                # probably exited since we sampled it
+                continue
+            detailed += smaps[p][metric]
+        return metric.upper(), desc, detailed
+
+    def wants_tree(self):
+        for modes in self.modes.values():
+            if modes.get('scope') == 'tree':
+                return True
+        return False
+
+    def check_growth(self, pname, group, pid, rss, now):
+        """ Record a sample of pname, and act if it is growing faster
+        than self.leak bytes per minute.  Return True if we acted. """
+        entry = self.histories.get(pname)
+        if entry is None or entry[0] != pid:
+            entry = self.histories[pname] = (pid, History(self.window))
+        history = entry[1]
+        history.append(now, rss)
+        if not history.full():
+            return False
+
+        rate = int(history.slope() * 60)
+        if rate <= self.leak:
+            return False
+
+        self.stderr.write('RSS of %s is growing by %s bytes/minute\n' % (
+            pname, rate))
+        reason = 'its memory was growing by %s bytes/minute (%s bytes RSS)' % (
+            rate, rss)
+        if self.leakaction == 'restart':
+            # the history goes once it is restarted (see restart_many): a
+            # deferred restart is requested again on the next tick
+            self.request_restart(pname, group, float(rate) / self.leak, rss,
+                                 reason=reason)
+            return True
+        # start over, so we don't mail again until we have a fresh window
+        del self.histories[pname]
+        if self.email:
+            msg = 'memmon.py found that the process named %s at %s: %s' % (
+                pname, time.asctime(), reason)
+            subject = 'memmon: process %s is leaking memory' % pname
+            self.mail(self.email, subject, msg)
+        return True
+
+    def staggered(self):
+        return self.maxrestarts is not None or self.keeprunning is not None
+
+    def request_restart(self, pname, group, overshoot, rss, metric='RSS',
+                        reason=None, action=None):
+        """ Restart pname now, or queue it until the end of the tick if
+        restarts are staggered.  overshoot is how many times over its
+        limit the process is. """
+        if self.staggered():
+            self.queue.append((overshoot, pname, group, rss, metric, reason,
+                               action))
+        else:
+            self.restart(pname, rss, metric, reason, action)
+
+    def restart_queued(self, infos):
+        """ Restart the queued processes worst first, within the
+        per-group limits.  Anything left over is checked again next
+        tick. """
+        running = {}
+        for info in infos:
+            if info['state'] == ProcessStates.RUNNING:
+                running[info['group']] = running.get(info['group'], 0) + 1
+
+        self.queue.sort(key=lambda entry: entry[0], reverse=True)
+        restarted = {}
+        entries = []
+        for overshoot, pname, group, rss, metric, reason, action in self.queue:
+            count = restarted.get(group, 0)
+            if self.maxrestarts is not None and count >= self.maxrestarts:
+                self.stderr.write(
+                    'Deferring restart of %s, already restarted %s in group '
+                    '%s this tick\n' % (pname, count, group))
+                continue
+            if (self.keeprunning is not None and
+                running.get(group, 0) <= self.keeprunning):
+                self.stderr.write(
+                    'Deferring restart of %s, only %s in group %s are '
+                    'RUNNING\n' % (pname, running.get(group, 0), group))
+                continue
+            restarted[group] = count + 1
+            # it is down (or about to be) for the rest of this tick
+            running[group] = running.get(group, 0) - 1
+            entries.append((pname, rss, metric, reason, action))
+        self.queue = []
+        if entries:
+            self.restart_many(entries)
+
     def runforever(self, test=False):
         while 1:
             # we explicitly use self.stdin, self.stdout, and self.stderr
             # instead of sys.* so we can unit test this code
-            headers, payload = childutils.listener.wait(self.stdin, self.stdout)
+            headers, payload = self.events.wait(self.stdin, self.stdout)
 
             if not headers['eventname'].startswith('TICK'):
                 # do nothing with non-TICK events
@@ -106,6 +550,7 @@ class Memmon:
                     break
                 continue
 
+            snapshot.set_tick(self.rpc, payload)
             status = []
             if self.programs:
                 status.append(
@@ -125,96 +570,161 @@ class Memmon:
 
             infos = self.rpc.supervisor.getAllProcessInfo()
 
+            # processes in standby mode (non-auto-started) have pid 0,
+            # which ps throws an error for
+            pids = [ info['pid'] for info in infos if info['pid'] ]
+            sampler = self.get_sampler()
+            tree = None
+            families = {}
+            if self.wants_tree():
+                # one scan of the process table per tick, however many
+                # processes we are watching
+                tree = sampler.tree()
+                for pid in pids[:]:
+                    families[pid] = tree.descendants(pid)
+                    pids.extend(families[pid])
+            rsses = sampler.sample(pids)
+            smaps = {}
+            now = time.time()
+            seen = {}
+
             for info in infos:
                 pid = info['pid']
                 name = info['name']
                 group = info['group']
                 pname = '%s:%s' % (group, name)
 
-                if not pid:
-                    # ps throws an error in this case (for processes
-                    # in standby mode, non-auto-started).
-                    continue
-
-                data = shell(self.pscommand % pid)
-                if not data:
-                    # no such pid (deal with race conditions)
+                rss = rsses.get(pid)
+                if rss is None:
+                    # no pid, or no such pid (deal with race conditions)
                     continue
 
-                try:
-                    rss = data.lstrip().rstrip()
-                    rss = int(rss) * 1024 # rss is in KB
-                except ValueError:
-                    # line doesn't contain any data, or rss cant be intified
-                    continue
-
-                for n in name, pname:
-                    if n in self.programs:
-                        self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                        if  rss > self.programs[name]:
-                            self.restart(pname, rss)
-                            continue
-
-                if group in self.groups:
-                    self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                    if rss > self.groups[group]:
-                        self.restart(pname, rss)
-                        continue
-
-                if self.any is not None:
-                    self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                    if rss > self.any:
-                        self.restart(pname, rss)
-                        continue
+                restarted = False
+                for rule, limit in self.rules(name, pname, group):
+                    metric, desc, size = self.measure(rule, limit, pid, pname,
+                                                      rsses, families, smaps)
+                    self.stderr.write('%s of %s is %s\n' % (metric, desc,
+                                                             size))
+                    if size > limit:
+                        self.request_restart(pname, group,
+                                             float(size) / max(limit, 1),
+                                             size, metric,
+                                             action=self.get_action(rule))
+                        restarted = True
+                        break
+
+                if self.leak is not None and not restarted:
+                    seen[pname] = True
+                    self.check_growth(pname, group, pid, rss, now)
+
+            if self.queue:
+                self.restart_queued(infos)
+
+            for pname in self.histories.keys():
+                if pname not in seen:
+                    # stopped, or restarted above
+                    del self.histories[pname]
 
             self.stderr.flush()
             childutils.listener.ok(self.stdout)
             if test:
                 break
 
-    def restart(self, name, rss):
-        self.stderr.write('Restarting %s\n' % name)
+    def restart(self, name, rss, metric='RSS', reason=None, action=None):
+        self.restart_many([(name, rss, metric, reason, action)])
+
+    def restart_many(self, entries):
+        """ Restart (or otherwise act on) the processes of a list of
+        (name, rss, metric, reason, action) entries, in a single round trip
+        to supervisord for each action where possible.  An action of None
+        is the --action one. """
+        names = {}
+        order = []
+        for name, rss, metric, reason, action in entries:
+            action = action or self.action
+            # start over, so we don't act again until we have a fresh
+            # window of samples
+            self.histories.pop(name, None)
+            if isinstance(action, actions.Restart):
+                self.stderr.write('Restarting %s\n' % name)
+            else:
+                self.stderr.write('Running %s on %s\n' % (action, name))
+            if action not in names:
+                names[action] = []
+                order.append(action)
+            names[action].append(name)
+
+        results = {}
+        for action in order:
+            for name, failures in action.perform(self.rpc, names[action],
+                                                 self.actiontimeout):
+                results[name] = dict(failures)
+
+        for name, rss, metric, reason, action in entries:
+            action = action or self.action
+            failures = results[name]
+            stopfault = failures.pop('stop', None)
+            startfault = failures.pop('start', None)
+
+            if stopfault is not None:
+                msg = ('Failed to stop process %s (%s %s), exiting: %s' %
+                       (name, metric, rss, stopfault))
+                self.stderr.write(str(msg))
+                if self.email:
+                    subject = ('memmon: failed to stop process %s, exiting' %
+                               name)
+                    self.mail(self.email, subject, msg)
+                raise stopfault
+
+            if startfault is not None:
+                msg = ('Failed to start process %s after stopping it, '
+                       'exiting: %s' % (name, startfault))
+                self.stderr.write(str(msg))
+                if self.email:
+                    subject = ('memmon: failed to start process %s, exiting' %
+                               name)
+                    self.mail(self.email, subject, msg)
+                raise startfault
+
+            for stage, error in failures.items():
+                if stage == 'wait':
+                    msg = ('Process %s (%s %s) is not running after %s, '
+                           'exiting: %s' % (name, metric, rss, action, error))
+                else:
+                    msg = ('Failed to run %s on process %s (%s %s), '
+                           'exiting: %s' % (action, name, metric, rss, error))
+                self.stderr.write(str(msg))
+                if self.email:
+                    subject = ('memmon: %s of process %s failed, exiting' % (
+                               action, name))
+                    self.mail(self.email, subject, msg)
+                raise error
 
-        try:
-            self.rpc.supervisor.stopProcess(name)
-        except xmlrpclib.Fault, what:
-            msg = ('Failed to stop process %s (RSS %s), exiting: %s' %
-                   (name, rss, what))
-            self.stderr.write(str(msg))
             if self.email:
-                subject = 'memmon: failed to stop process %s, exiting' % name
+                now = time.asctime()
+                if reason is None:
+                    reason = ('it was consuming too much memory '
+                              '(%s bytes %s)' % (rss, metric))
+                if isinstance(action, actions.Restart):
+                    msg = (
+                        'memmon.py restarted the process named %s at %s '
+                        'because %s' % (name, now, reason)
+                        )
+                    subject = 'memmon: process %s restarted' % name
+                else:
+                    msg = (
+                        'memmon.py ran %s on the process named %s at %s '
+                        'because %s' % (action, name, now, reason)
+                        )
+                    subject = 'memmon: ran %s on process %s' % (action, name)
                 self.mail(self.email, subject, msg)
-            raise
-
-        try:
-            self.rpc.supervisor.startProcess(name)
-        except xmlrpclib.Fault, what:
-            msg = ('Failed to start process %s after stopping it, '
-                   'exiting: %s' % (name, what))
-            self.stderr.write(str(msg))
-            if self.email:
-                subject = 'memmon: failed to start process %s, exiting' % name
-                self.mail(self.email, subject, msg)
-            raise
-
-        if self.email:
-            now = time.asctime()
-            msg = (
-                'memmon.py restarted the process named %s at %s because '
-                'it was consuming too much memory (%s bytes RSS)' % (
-                name, now, rss)
-                )
-            subject = 'memmon: process %s restarted' % name
-            self.mail(self.email, subject, msg)
 
     def mail(self, email, subject, msg):
         body =  'To: %s\n' % self.email
         body += 'Subject: %s\n' % subject
         body += '\n'
         body += msg
-        m = os.popen(self.sendmail, 'w')
-        m.write(body)
-        m.close()
+        self.notifier.sendtext(body)
         self.mailed = body
         
 def parse_namesize(option, value):
@@ -223,8 +733,25 @@ def parse_namesize(option, value):
     except ValueError:
         print 'Unparseable value %r for %r' % (value, option)
         usage()
-    size = parse_size(option, size)
-    return name, size
+    size, modes = parse_limit(option, size)
+    return name, size, modes
+
+def parse_limit(option, value):
+    modifiers = value.split(',')
+    size = parse_size(option, modifiers.pop(0))
+    modes = {}
+    for modifier in modifiers:
+        if modifier in ('tree', 'leader'):
+            modes['scope'] = modifier
+        elif modifier in ('rss', 'pss', 'uss'):
+            modes['metric'] = modifier
+        elif modifier.split(':')[0] in ('restart', 'signal', 'exec'):
+            modes['action'] = parse_action(option, modifier)
+        else:
+            print 'Unknown modifier %r in %r for %r' % (modifier, value,
+                                                        option)
+            usage()
+    return size, modes
 
 def parse_size(option, value):
     try:
@@ -235,9 +762,34 @@ def parse_size(option, value):
         
     return size
 
+def parse_action(option, value):
+    try:
+        return actions.parse_action(value)
+    except ValueError, why:
+        print 'Unparseable action %r for %r: %s' % (value, option, why)
+        usage()
+
+def parse_notify(option, value):
+    try:
+        return notifier.make_sink(value)
+    except ValueError, why:
+        print 'Unparseable notifier %r for %r: %s' % (value, option, why)
+        usage()
+
+def parse_count(option, value, minimum):
+    try:
+        count = int(value)
+    except ValueError:
+        print 'Unparseable number %r for %r' % (value, option)
+        usage()
+    if count < minimum:
+        print 'Value %r for %r must be at least %s' % (value, option, minimum)
+        usage()
+    return count
+
 def main():
     import getopt
-    short_args="hp:g:a:s:m:"
+    short_args="hp:g:a:s:m:S:l:w:L:n:k:"
     long_args=[
         "help",
         "program=",
@@ -245,6 +797,18 @@ def main():
         "any=",
         "sendmail_program=",
         "email=",
+        "sampler=",
+        "leak=",
+        "window=",
+        "leak-action=",
+        "max-restarts=",
+        "keep-running=",
+        "action=",
+        "action-timeout=",
+        "snapshot=",
+        "snapshot-age=",
+        "notify=",
+        "notify-rate=",
         ]
     arguments = sys.argv[1:]
     if not arguments:
@@ -258,8 +822,21 @@ def main():
     programs = {}
     groups = {}
     any = None
+    modes = {}
     sendmail = '/usr/sbin/sendmail -t -i'
     email = None
+    sampler = 'auto'
+    leak = None
+    window = 10
+    leakaction = 'restart'
+    maxrestarts = None
+    keeprunning = None
+    action = None
+    actiontimeout = None
+    snapshotpath = None
+    snapshotage = 2
+    sink = None
+    notifyrate = None
 
     for option, value in opts:
 
@@ -267,16 +844,19 @@ def main():
             usage()
 
         if option in ('-p', '--program'):
-            name, size = parse_namesize(option, value)
+            name, size, rulemodes = parse_namesize(option, value)
             programs[name] = size
+            modes[('program', name)] = rulemodes
 
         if option in ('-g', '--group'):
-            name, size = parse_namesize(option, value)
+            name, size, rulemodes = parse_namesize(option, value)
             groups[name] = size
+            modes[('group', name)] = rulemodes
 
         if option in ('-a', '--any'):
-            size = parse_size(option, value)
+            size, rulemodes = parse_limit(option, value)
             any = size
+            modes[('any', None)] = rulemodes
 
         if option in ('-s', '--sendmail_program'):
             sendmail = value
@@ -284,9 +864,63 @@ def main():
         if option in ('-m', '--email'):
             email = value
 
-    rpc = childutils.getRPCInterface(os.environ)
-    memmon = Memmon(programs, groups, any, sendmail, email, rpc)
-    memmon.runforever()
+        if option in ('-S', '--sampler'):
+            if value not in ('auto', 'proc', 'ps'):
+                print 'Unknown sampler %r for %r' % (value, option)
+                usage()
+            sampler = value
+
+        if option in ('-l', '--leak'):
+            leak = parse_size(option, value)
+
+        if option in ('-w', '--window'):
+            window = parse_count(option, value, 2)
+
+        if option in ('-L', '--leak-action'):
+            if value not in ('restart', 'mail'):
+                print 'Unknown action %r for %r' % (value, option)
+                usage()
+            leakaction = value
+
+        if option in ('-n', '--max-restarts'):
+            maxrestarts = parse_count(option, value, 1)
+
+        if option in ('-k', '--keep-running'):
+            keeprunning = parse_count(option, value, 0)
+
+        if option == '--action':
+            action = parse_action(option, value)
+
+        if option == '--action-timeout':
+            actiontimeout = parse_count(option, value, 0)
+
+        if option == '--snapshot':
+            snapshotpath = value
+
+        if option == '--snapshot-age':
+            snapshotage = parse_count(option, value, 0)
+
+        if option == '--notify':
+            sink = parse_notify(option, value)
+
+        if option == '--notify-rate':
+            notifyrate = parse_count(option, value, 1)
+
+    if sink is None:
+        sink = notifier.SendmailSink(sendmail)
+    notify = notifier.Notifier(sink, rate=notifyrate)
+    rpc = transport.getRPCInterface(os.environ)
+    if snapshotpath:
+        rpc = snapshot.wrap(rpc, snapshotpath, snapshotage)
+    memmon = Memmon(programs, groups, any, sendmail, email, rpc,
+                    make_sampler(sampler), modes, leak, window, leakaction,
+                    maxrestarts, keeprunning, action, actiontimeout, notify)
+    notify.start()
+    try:
+        memmon.runforever()
+    finally:
+        # memmon exits after mailing that it couldn't restart a process
+        notify.stop(30)
 
 if __name__ == '__main__':
     main()
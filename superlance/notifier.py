@@ -0,0 +1,571 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Delivery of notifications off the event loop.  A Notifier hands
+# messages (email.Message instances) to a sink from a background thread
+# through a bounded queue, so that a listener never waits for a slow or
+# unreachable mail server before acknowledging an event.  Messages which
+# can't be delivered are retried with exponential backoff, and kept in a
+# spool directory meanwhile if one is given, so they survive a restart of
+# the listener.  Messages which pile up, because they come faster than
+# the sink takes them or than the rate limit allows, are combined into
+# one message for each recipient.
+#
+# A sink is written as one of
+#
+#   sendmail:COMMAND  -- pipe each message to COMMAND, e.g.
+#                        "sendmail:/usr/sbin/sendmail -t -i"
+#   smtp:HOST[:PORT]  -- send it to an SMTP server
+#   webhook:URL       -- POST it as JSON (to, from, subject and body) to
+#                        an http or https URL
+#   file:PATH         -- append it to the mbox file PATH
+
+import os
+import sys
+import time
+import email
+import getpass
+import httplib
+import socket
+import smtplib
+import threading
+import urlparse
+import Queue
+from cStringIO import StringIO
+from email.Generator import Generator
+from email.MIMEText import MIMEText
+from email.Utils import getaddresses
+from email.Utils import parseaddr
+
+try:
+    import json
+except ImportError:
+    json = None
+
+_STOP = object()
+
+class NotifierError(Exception):
+    pass
+
+class PermanentError(NotifierError):
+    """ A delivery error which retrying won't get past. """
+
+# the sendmail exit status (from sysexits.h) for a temporary failure
+EX_TEMPFAIL = 75
+
+def permanent(why):
+    """ Return whether the delivery error why will happen again however
+    often the message is retried: a 5xx SMTP reply, or a PermanentError
+    from one of the other sinks. """
+    if isinstance(why, smtplib.SMTPRecipientsRefused):
+        codes = [ code for code, reply in why.recipients.values() ]
+        return bool(codes) and min(codes) >= 500
+    if isinstance(why, smtplib.SMTPResponseException):
+        return why.smtp_code >= 500
+    return isinstance(why, PermanentError)
+
+def flatten(msg, mangle=False):
+    """ Return msg as a string, its headers unfolded as they were set. """
+    f = StringIO()
+    Generator(f, mangle_from_=mangle, maxheaderlen=0).flatten(msg)
+    return f.getvalue()
+
+class TokenBucket:
+    """ Allows rate events every per seconds on average, and bursts of up
+    to burst of them (rate by default). """
+    def __init__(self, rate, per=60, burst=None):
+        self.interval = float(per) / rate
+        if burst is None:
+            burst = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) / self.interval)
+        self.updated = now
+
+    def wait(self, now):
+        """ Return the number of seconds until take() can succeed. """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.interval
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class SendmailSink:
+    """ Pipes each message to a sendmail-like command, which must read
+    the headers and body on stdin. """
+    def __init__(self, command='/usr/sbin/sendmail -t -i'):
+        self.command = command
+
+    def deliver(self, msg):
+        m = os.popen(self.command, 'w')
+        m.write(flatten(msg))
+        status = m.close()
+        if status:
+            # close() gives the wait status
+            error = PermanentError
+            if status >> 8 == EX_TEMPFAIL:
+                error = NotifierError
+            raise error('%s exited with status %s' % (self.command,
+                                                      status >> 8))
+
+    def close(self):
+        pass
+
+def default_sender():
+    """ The envelope sender sendmail would use: user@fqdn. """
+    try:
+        user = getpass.getuser()
+    except Exception:
+        # no login name to be found in the environment or passwd
+        user = 'supervisor'
+    return '%s@%s' % (user, socket.getfqdn())
+
+class SMTPSink:
+    """ Sends messages over one SMTP connection, kept open between them.
+    EHLO (and STARTTLS) happen once per connection.  A connection the
+    server has closed in the meantime is reopened and the message sent
+    again once.  The envelope sender is the From address of a message,
+    or sender (default_sender() by default) when it has none. """
+    smtpclass = smtplib.SMTP
+
+    def __init__(self, host='localhost', port=None, starttls=False,
+                 timeout=30, sender=None):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.timeout = timeout
+        if sender is None:
+            sender = default_sender()
+        self.sender = sender
+        self.conn = None
+
+    def connect(self):
+        conn = self.smtpclass(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.ehlo()
+            if self.starttls:
+                conn.starttls()
+                conn.ehlo()
+        except:
+            conn.close()
+            raise
+        self.conn = conn
+
+    def envelope(self, msg):
+        """ Return the envelope sender and recipients of msg.  -m takes
+        comma separated addresses, which end up in one To header. """
+        sender = parseaddr(msg.get('From', ''))[1] or self.sender
+        recipients = [ addr for name, addr in
+                       getaddresses(msg.get_all('To', [])) if addr ]
+        return sender, recipients
+
+    def deliver(self, msg):
+        sender, recipients = self.envelope(msg)
+        while 1:
+            fresh = self.conn is None
+            if fresh:
+                self.connect()
+            try:
+                self.conn.sendmail(sender, recipients, msg.as_string())
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self.close()
+                if fresh:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.quit()
+            except (smtplib.SMTPException, socket.error):
+                self.conn.close()
+            self.conn = None
+
+class WebhookSink:
+    """ POSTs each message to an HTTP endpoint as a JSON object with
+    "to", "from", "subject" and "body" keys.  Any response but a 2xx one
+    is an error. """
+    def __init__(self, url, timeout=30):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if scheme == 'http':
+            self.connclass = httplib.HTTPConnection
+        elif scheme == 'https':
+            self.connclass = httplib.HTTPSConnection
+        else:
+            raise ValueError('bad webhook url %r' % url)
+        self.url = url
+        self.netloc = netloc
+        self.path = path or '/'
+        if query:
+            self.path += '?' + query
+        self.timeout = timeout
+
+    def deliver(self, msg):
+        body = json.dumps({'to': msg['To'], 'from': msg['From'],
+                           'subject': msg['Subject'],
+                           'body': msg.get_payload()})
+        conn = self.connclass(self.netloc, timeout=self.timeout)
+        try:
+            conn.request('POST', self.path, body,
+                         {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+        finally:
+            conn.close()
+        if not 200 <= response.status < 300:
+            error = NotifierError
+            # other than timeouts and "too many requests", a 4xx response
+            # will be the same next time
+            if (400 <= response.status < 500 and
+                response.status not in (408, 429)):
+                error = PermanentError
+            raise error('%s: %s %s' % (self.url, response.status,
+                                       response.reason))
+
+    def close(self):
+        pass
+
+class FileSink:
+    """ Appends each message to a file in mbox format. """
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, msg):
+        f = open(self.path, 'a')
+        try:
+            f.write('From superlance %s\n' % time.asctime())
+            f.write(flatten(msg, mangle=True))
+            f.write('\n\n')
+        finally:
+            f.close()
+
+    def close(self):
+        pass
+
+def make_sink(spec):
+    """ Return the sink written as spec, or raise ValueError. """
+    kind, sep, arg = spec.partition(':')
+    if kind == 'sendmail' and arg:
+        return SendmailSink(arg)
+    if kind == 'smtp':
+        host, sep, port = arg.partition(':')
+        if port:
+            try:
+                port = int(port)
+            except ValueError:
+                raise ValueError('bad port in %r' % spec)
+        return SMTPSink(host or 'localhost', port or None)
+    if kind == 'webhook':
+        if json is None:
+            raise ValueError('webhooks need the json module')
+        return WebhookSink(arg)
+    if kind == 'file' and arg:
+        return FileSink(arg)
+    raise ValueError('unknown notifier %r' % spec)
+
+def combine(msgs):
+    """ Return msgs with those to the same recipient made into one. """
+    order = []
+    byto = {}
+    for msg in msgs:
+        to = msg['To']
+        if to not in byto:
+            order.append(to)
+            byto[to] = []
+        byto[to].append(msg)
+    result = []
+    for to in order:
+        group = byto[to]
+        if len(group) == 1:
+            result.append(group[0])
+            continue
+        parts = [ 'Subject: %s\n\n%s' % (msg['Subject'], msg.get_payload())
+                  for msg in group ]
+        digest = MIMEText('\n\n'.join(parts))
+        first = group[0]
+        if first['From'] is not None:
+            digest['From'] = first['From']
+        digest['To'] = to
+        digest['Subject'] = '%s (and %s more)' % (first['Subject'],
+                                                  len(group) - 1)
+        result.append(digest)
+    return result
+
+class Notifier:
+    """ Delivers messages to sink in a background thread once started.
+    Until then, send() delivers straight away and raises any error.
+    With a rate, at most rate deliveries are made a minute, and the
+    messages which come in meanwhile are combined. """
+    clock = staticmethod(time.time)
+
+    def __init__(self, sink, maxqueue=100, spooldir=None, stderr=None,
+                 backoff=1, maxbackoff=300, rate=None):
+        self.sink = sink
+        self.maxqueue = maxqueue
+        self.queue = Queue.Queue(maxqueue)
+        self.spooldir = spooldir
+        if stderr is None:
+            stderr = sys.stderr
+        self.stderr = stderr
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        # messages waiting to be retried when there is no spool directory
+        self.held = []
+        self.failures = 0
+        self.retry = 0
+        self.seq = 0
+        self.thread = None
+        # spool files which can't be read or removed, left out of the spool
+        # so that they are neither retried for ever nor sent again
+        self.skipped = set()
+        self.limiter = None
+        if rate:
+            self.limiter = TokenBucket(rate)
+        # combined messages waiting for the rate limit to allow them
+        self.deferred = []
+
+    def log(self, msg):
+        self.stderr.write('%s\n' % msg)
+        self.stderr.flush()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop the background thread once it has tried to deliver the
+        messages queued so far, waiting at most timeout seconds for it.
+        Listeners call this before exiting, as the thread dies with them
+        and anything still queued would be lost. """
+        if self.thread is not None:
+            try:
+                self.queue.put(_STOP, True, timeout)
+            except Queue.Full:
+                self.log('Notification queue still full, not waiting for it')
+            else:
+                self.thread.join(timeout)
+            self.thread = None
+
+    def send(self, msg):
+        if self.thread is None:
+            self.sink.deliver(msg)
+            return
+        try:
+            self.queue.put_nowait(msg)
+        except Queue.Full:
+            if self.spooldir:
+                self.spool(msg)
+            else:
+                self.log('Notification queue full, dropping message to %s' %
+                         msg['To'])
+
+    def sendtext(self, text):
+        """ Send the message written as text: headers, a blank line and
+        the body. """
+        self.send(email.message_from_string(text))
+
+    def run(self):
+        while 1:
+            msgs, stop = self.collect()
+            self.dispatch(msgs, stop)
+            if stop:
+                self.sink.close()
+                return
+
+    def dispatch(self, msgs, stop=False):
+        """ Combine msgs with those deferred before and deliver as many
+        as the rate limit allows, deferring the rest.  When stopping,
+        everything is delivered: the listener is about to exit, and late
+        is better than never. """
+        if not msgs and not self.deferred:
+            self.process(None)
+            return
+        combined = combine(self.deferred + msgs)
+        self.deferred = []
+        for i in range(len(combined)):
+            if (self.limiter is not None and
+                not self.limiter.take(self.clock()) and not stop):
+                self.deferred = combined[i:]
+                return
+            try:
+                self.process(combined[i])
+            except Exception, why:
+                # the thread must outlive anything unexpected, or
+                # every later message is lost
+                self.log('Error in notifier: %s' % why)
+
+    def ratewait(self):
+        if self.limiter is None:
+            return 0
+        return self.limiter.wait(self.clock())
+
+    def collect(self):
+        """ Wait for messages, then keep taking them until the queue is
+        empty and the rate limit allows a delivery, or until there are
+        maxqueue of them.  Returns them and whether to stop.  Returns no
+        messages when it's time to retry the held ones or to send the
+        deferred ones. """
+        timeout = None
+        if self.has_held():
+            timeout = max(self.retry - self.clock(), 0)
+        if self.deferred:
+            wait = self.ratewait()
+            if timeout is None or wait < timeout:
+                timeout = wait
+        msgs = []
+        while 1:
+            try:
+                msg = self.queue.get(True, timeout)
+            except Queue.Empty:
+                if not msgs:
+                    return msgs, False
+                timeout = self.ratewait()
+                if timeout <= 0:
+                    return msgs, False
+                continue
+            if msg is _STOP:
+                return msgs, True
+            msgs.append(msg)
+            if len(msgs) >= self.maxqueue:
+                return msgs, False
+            timeout = self.ratewait()
+
+    def process(self, msg):
+        """ Deliver the held messages and then msg, unless we are backing
+        off after a failure, in which case msg is held too. """
+        pending = []
+        if msg is not None:
+            pending.append((None, msg))
+        if self.clock() < self.retry:
+            for path, msg in pending:
+                self.hold(msg)
+            return
+
+        pending = self.get_held() + pending
+        for i in range(len(pending)):
+            path, msg = pending[i]
+            try:
+                self.sink.deliver(msg)
+            except Exception, why:
+                if permanent(why):
+                    self.log('Error sending email to %s: %s, giving up' % (
+                        msg['To'], why))
+                    if path is not None:
+                        self.set_aside(path)
+                    continue
+                self.failures += 1
+                delay = min(self.backoff * 2 ** (self.failures - 1),
+                            self.maxbackoff)
+                self.retry = self.clock() + delay
+                self.log('Error sending email: %s, retrying in %s seconds' % (
+                    why, delay))
+                for path, msg in pending[i:]:
+                    if path is None:
+                        self.hold(msg)
+                return
+            self.failures = 0
+            if path is not None:
+                try:
+                    os.remove(path)
+                except OSError, why:
+                    self.log('Error removing spooled message %s: %s' % (
+                        path, why))
+                    self.skipped.add(path)
+
+    def set_aside(self, path):
+        """ Rename a spooled message which can't be delivered, so that it
+        is kept for someone to look at but not tried again. """
+        try:
+            os.rename(path, path + '.failed')
+        except OSError, why:
+            self.log('Error setting aside spooled message %s: %s' % (path,
+                                                                     why))
+            self.skipped.add(path)
+
+    def hold(self, msg):
+        if self.spooldir:
+            self.spool(msg)
+        else:
+            self.held.append(msg)
+            if len(self.held) > self.maxqueue:
+                dropped = self.held.pop(0)
+                self.log('Dropping undeliverable message to %s' %
+                         dropped['To'])
+
+    def has_held(self):
+        if self.held:
+            return True
+        return bool(self.spooled())
+
+    def get_held(self):
+        """ Return (path, message) for each held message, oldest first.
+        The path of spooled messages is that of their file, which is
+        removed once they are delivered. """
+        held = [ (None, msg) for msg in self.held ]
+        self.held = []
+        for path in self.spooled():
+            try:
+                f = open(path)
+                try:
+                    msg = email.message_from_file(f)
+                finally:
+                    f.close()
+            except (IOError, OSError), why:
+                self.log('Error reading spooled message %s: %s' % (path,
+                                                                   why))
+                self.set_aside(path)
+                continue
+            held.append((path, msg))
+        return held
+
+    def spooled(self):
+        if not self.spooldir:
+            return []
+        try:
+            names = os.listdir(self.spooldir)
+        except OSError:
+            return []
+        paths = [ os.path.join(self.spooldir, name)
+                  for name in sorted(names) if name.endswith('.eml') ]
+        return [ path for path in paths if path not in self.skipped ]
+
+    def spool(self, msg):
+        self.seq += 1
+        name = '%.6f-%d-%d.eml' % (time.time(), os.getpid(), self.seq)
+        path = os.path.join(self.spooldir, name)
+        # written under another name first so that a half written message
+        # is never picked up
+        tmp = path + '.tmp'
+        try:
+            f = open(tmp, 'w')
+            try:
+                f.write(msg.as_string())
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError), why:
+            self.log('Error spooling message to %s: %s' % (msg['To'], why))
@@ -14,12 +14,12 @@
 ##############################################################################
 import os
 import sys
-import smtplib
 import copy
 # Using old reference for Python 2.4
 from email.MIMEText import MIMEText
 # from email.mime.text import MIMEText
 from superlance.process_state_monitor import ProcessStateMonitor
+from superlance import notifier
 
 doc = """\
 Base class for common functionality when monitoring process state changes
@@ -43,8 +43,36 @@ class ProcessStateEmailMonitor(ProcessStateMonitor):
                           help="email subject")
         parser.add_option("-H", "--smtpHost", dest="smtp_host", default="localhost",
                           help="SMTP server hostname or address")
+        parser.add_option("--smtpStartTLS", dest="smtp_starttls",
+                          action="store_true", default=False,
+                          help="use STARTTLS with the SMTP server")
+        parser.add_option("--sendQueue", dest="send_queue", type="int",
+                          default=100,
+                          help="emails waiting to be sent kept in memory "
+                               "(defaults to 100)")
+        parser.add_option("--spoolDir", dest="spool_dir",
+                          help="directory keeping emails which can't be sent "
+                               "yet, or don't fit in the queue")
+        parser.add_option("--notifyRate", dest="notify_rate", type="int",
+                          help="send at most this many emails a minute, "
+                               "combining the rest")
         parser.add_option("-e", "--tickEvent", dest="eventname", default="TICK_60",
                           help="TICK event name (defaults to TICK_60)")
+        parser.add_option("--batchLines", dest="batch_lines", type="int",
+                          default=10,
+                          help="messages kept per process and event in a "
+                               "batch (defaults to 10)")
+        parser.add_option("--batchKeys", dest="batch_keys", type="int",
+                          default=100,
+                          help="processes and events kept in a batch "
+                               "(defaults to 100)")
+        parser.add_option("--flushSize", dest="flush_size", type="int",
+                          help="send the batch as soon as it holds this many "
+                               "messages")
+        parser.add_option("--urgentEvent", dest="urgent_events",
+                          action="append",
+                          help="send the batch as soon as it holds a message "
+                               "about this event (may be given more than once)")
         
         (options, args) = parser.parse_args()
 
@@ -69,6 +97,23 @@ class ProcessStateEmailMonitor(ProcessStateMonitor):
         self.subject = kwargs.get('subject')
         self.smtp_host = kwargs.get('smtp_host', 'localhost')
         self.digest_len = 76
+        sink = notifier.SMTPSink(self.smtp_host,
+                                 starttls=kwargs.get('smtp_starttls', False),
+                                 sender=self.from_email)
+        self.notifier = notifier.Notifier(sink,
+                                          kwargs.get('send_queue') or 100,
+                                          kwargs.get('spool_dir'),
+                                          self.stderr,
+                                          rate=kwargs.get('notify_rate'))
+
+    def run(self):
+        # emails are sent in the background from now on
+        self.notifier.start()
+        try:
+            ProcessStateMonitor.run(self)
+        finally:
+            # don't lose the emails still queued when we exit
+            self.notifier.stop(30)
 
     def send_batch_notification(self):
         email = self.get_batch_email()
@@ -106,11 +151,5 @@ From: %(from)s\nSubject: %(subject)s\nBody:\n%(body)s\n" % email_for_log)
             self.write_stderr("Error sending email: %s\n" % e)
 
     def send_smtp(self, mimeMsg):
-        s = smtplib.SMTP(self.smtp_host)
-        try:
-            s.sendmail(mimeMsg['From'], [mimeMsg['To']], mimeMsg.as_string())
-        except:
-            s.quit()
-            raise
-        s.quit()
+        self.notifier.send(mimeMsg)
 
@@ -18,9 +18,99 @@ Base class for common functionality when monitoring process state changes
 
 import os
 import sys
+import time
+from collections import deque
 
 from supervisor import childutils
 
+from superlance import events
+
+def monotonic():
+    """
+    Seconds since a fixed point in the past, which doesn't jump when the
+    system clock is set.
+    """
+    # the elapsed real time of times(2)
+    return os.times()[4]
+
+class BatchBuffer:
+    """
+    The messages of one batch, grouped by (group, process, event name).
+    Each key counts its messages and remembers when the first and last
+    arrived, but only keeps its last `lines` messages, and only the first
+    `keys` keys are kept at all, so a crash loop can't make the batch (or
+    the notification) grow without bound.  Iterating over it gives the
+    lines of the notification.
+    """
+
+    def __init__(self, lines=10, keys=100):
+        self.lines = lines
+        self.keys = keys
+        # key -> [count, first time, last time, deque of (seq, msg)]
+        self.entries = {}
+        self.order = []
+        self.dropped = 0
+        self.seq = 0
+
+    def append(self, msg, key=None, when=None):
+        if when is None:
+            when = time.time()
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.order) >= self.keys:
+                self.dropped += 1
+                return
+            entry = self.entries[key] = [0, when, when,
+                                         deque(maxlen=self.lines)]
+            self.order.append(key)
+        entry[0] += 1
+        entry[2] = when
+        entry[3].append((self.seq, msg))
+        self.seq += 1
+
+    def __len__(self):
+        return self.seq + self.dropped
+
+    def rolled_up(self):
+        if self.dropped:
+            return True
+        for key in self.order:
+            entry = self.entries[key]
+            if entry[0] > len(entry[3]):
+                return True
+        return False
+
+    def __iter__(self):
+        if not self.rolled_up():
+            # everything is still there, in the order it came in
+            kept = []
+            for key in self.order:
+                kept.extend(self.entries[key][3])
+            kept.sort()
+            return iter([msg for seq, msg in kept])
+
+        lines = []
+        for key in self.order:
+            count, first, last, kept = self.entries[key]
+            if count > len(kept):
+                lines.append('%s: %s events from %s to %s, the last %s:' % (
+                    self.describe(key), count, self.format_time(first),
+                    self.format_time(last), len(kept)))
+            lines.extend([msg for seq, msg in kept])
+        if self.dropped:
+            lines.append('... and %s more events for other processes' %
+                         self.dropped)
+        return iter(lines)
+
+    def describe(self, key):
+        if key is None:
+            return 'Other'
+        group, process, eventname = key
+        return '%s:%s %s' % (group, process, eventname)
+
+    def format_time(self, when):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+
 class ProcessStateMonitor:
 
     # In child class, define a list of events to monitor
@@ -35,9 +125,20 @@ class ProcessStateMonitor:
         self.stderr = kwargs.get('stderr', sys.stderr)
         self.eventname = kwargs.get('eventname', 'TICK_60')
         self.tickmins = self._get_tick_mins(self.eventname)
-        
-        self.batchmsgs = []
-        self.batchmins = 0.0
+        self.batch_lines = kwargs.get('batch_lines') or 10
+        self.batch_keys = kwargs.get('batch_keys') or 100
+        # send the batch straight away once it holds this many messages,
+        # or holds a message about one of these events
+        self.flush_size = kwargs.get('flush_size')
+        self.urgent_events = kwargs.get('urgent_events') or []
+        self.clock = kwargs.get('clock', monotonic)
+
+        self.batchmsgs = self.make_batch()
+        # when the first message of the batch came in, by self.clock
+        self.batchstart = None
+
+    def make_batch(self):
+        return BatchBuffer(self.batch_lines, self.batch_keys)
 
     def _get_tick_mins(self, eventname):
         return float(self._get_tick_secs(eventname))/60.0
@@ -51,8 +152,10 @@ class ProcessStateMonitor:
             raise ValueError("Invalid TICK event name: %s" % eventname)
  
     def run(self):
+        reader = events.EventReader(self.process_state_events +
+                                    [self.eventname])
         while 1:
-            hdrs, payload = childutils.listener.wait(self.stdin, self.stdout)
+            hdrs, payload = reader.wait(self.stdin, self.stdout)
             self.handle_event(hdrs, payload)
             childutils.listener.ok(self.stdout)
     
@@ -66,7 +169,20 @@ class ProcessStateMonitor:
         msg = self.get_process_state_change_msg(headers, payload)
         if msg:
             self.write_stderr('%s\n' % msg)
-            self.batchmsgs.append(msg)
+            if self.batchstart is None:
+                self.batchstart = self.clock()
+            self.batchmsgs.append(msg, self.get_batch_key(headers, payload))
+            if (headers['eventname'] in self.urgent_events or
+                (self.flush_size and len(self.batchmsgs) >= self.flush_size)):
+                self.flush_batch()
+            else:
+                # ticks may come late, don't wait for one if it's time
+                self.check_batch()
+
+    def get_batch_key(self, headers, payload):
+        pheaders = childutils.get_headers(payload.split('\n', 1)[0])
+        return (pheaders.get('groupname'), pheaders.get('processname'),
+                headers['eventname'])
 
     """
     Override this method in child classes to customize messaging
@@ -75,10 +191,21 @@ class ProcessStateMonitor:
         return None
 
     def handle_tick_event(self, headers, payload):
-        self.batchmins += self.tickmins
-        if self.batchmins >= self.interval:
-            self.send_batch_notification()
-            self.clear_batch()
+        self.check_batch()
+
+    def check_batch(self):
+        """
+        Send the batch if its first message came in at least interval
+        minutes ago.  Ticks only say when to look, so it makes no
+        difference how late they are or how many supervisord merged.
+        """
+        if self.batchstart is not None and \
+                self.get_batch_minutes() >= self.interval:
+            self.flush_batch()
+
+    def flush_batch(self):
+        self.send_batch_notification()
+        self.clear_batch()
             
     """
     Override this method in child classes to send notification
@@ -87,14 +214,16 @@ class ProcessStateMonitor:
         pass
     
     def get_batch_minutes(self):
-        return self.batchmins
+        if self.batchstart is None:
+            return 0.0
+        return (self.clock() - self.batchstart) / 60.0
     
     def get_batch_msgs(self):
-        return self.batchmsgs
+        return list(self.batchmsgs)
         
     def clear_batch(self):
-        self.batchmins = 0.0;
-        self.batchmsgs = [];
+        self.batchstart = None
+        self.batchmsgs = self.make_batch();
 
     def write_stderr(self, msg):
         self.stderr.write(msg)
@@ -0,0 +1,154 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# A process info snapshot shared between all of the superlance listeners
+# of one supervisord.  Every listener subscribed to TICK events asks
+# supervisord for getAllProcessInfo() on every tick, and each of those
+# calls serializes the whole process table on supervisord's single
+# threaded event loop.  With a snapshot file, the first listener to
+# handle a tick refreshes it and the others read it instead, so the RPC
+# load on supervisord stays the same however many listeners there are.
+#
+# supervisord sends every listener the same TICK event, so a snapshot is
+# marked with the "when" of the tick it was taken on, and a listener
+# handling a tick only takes a snapshot of that tick: one left over from
+# the tick before is refreshed however young it is.
+
+import os
+import time
+import tempfile
+import xmlrpclib
+
+from supervisor import childutils
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class ProcessInfoSnapshot:
+    """ getAllProcessInfo() results cached in a file at path for up to
+    maxage seconds.  When tick is set (to the "when" of the TICK event
+    being handled), only results taken on that tick are used. """
+    def __init__(self, rpc, path, maxage=2):
+        self.rpc = rpc
+        self.path = path
+        self.maxage = maxage
+        self.clock = time.time
+        self.tick = None
+
+    def getAllProcessInfo(self):
+        infos = self.read()
+        if infos is not None:
+            return infos
+
+        lock = self.lock()
+        try:
+            # another listener may have refreshed it while we waited
+            infos = self.read()
+            if infos is None:
+                infos = self.rpc.supervisor.getAllProcessInfo()
+                self.write(infos)
+            return infos
+        finally:
+            self.unlock(lock)
+
+    def read(self):
+        """ Return the cached infos, or None if there are none or they
+        are too old. """
+        try:
+            f = open(self.path)
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+
+        try:
+            (stamp, tick, infos), method = xmlrpclib.loads(data)
+        except Exception:
+            # a mangled file: expat and xmlrpclib raise all sorts
+            return None
+
+        if self.tick is not None and tick != self.tick:
+            # taken on another tick
+            return None
+
+        age = self.clock() - stamp
+        if age < 0 or age > self.maxage:
+            # too old, or the clock went backwards
+            return None
+        return infos
+
+    def write(self, infos):
+        data = xmlrpclib.dumps((self.clock(), self.tick or '', infos))
+        dirname, basename = os.path.split(os.path.abspath(self.path))
+        fd, tmpname = tempfile.mkstemp(prefix=basename, dir=dirname)
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            # readers see either the old snapshot or the new one
+            os.rename(tmpname, self.path)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+
+    def lock(self):
+        if fcntl is None:
+            return None
+        try:
+            fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0600)
+        except OSError:
+            return None
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def unlock(self, fd):
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+class SnapshotNamespace:
+    """ The supervisor namespace of an RPC interface, with
+    getAllProcessInfo() answered from a snapshot. """
+    def __init__(self, namespace, snapshot):
+        self.namespace = namespace
+        self.getAllProcessInfo = snapshot.getAllProcessInfo
+
+    def __getattr__(self, name):
+        return getattr(self.namespace, name)
+
+class SnapshotRPCInterface:
+    def __init__(self, rpc, snapshot):
+        self.rpc = rpc
+        self.snapshot = snapshot
+        self.supervisor = SnapshotNamespace(rpc.supervisor, snapshot)
+
+    def __getattr__(self, name):
+        return getattr(self.rpc, name)
+
+def wrap(rpc, path, maxage=2):
+    """ Return an RPC interface which behaves like rpc, but shares
+    getAllProcessInfo() results with other listeners through the
+    snapshot file at path. """
+    return SnapshotRPCInterface(rpc, ProcessInfoSnapshot(rpc, path, maxage))
+
+def set_tick(rpc, payload):
+    """ Tell the snapshot behind rpc, if it is a wrapped one, which tick is
+    being handled, given the payload of the TICK event. """
+    if isinstance(rpc, SnapshotRPCInterface):
+        rpc.snapshot.tick = childutils.get_headers(payload).get('when')
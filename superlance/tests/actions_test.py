@@ -0,0 +1,196 @@
+import os
+import signal
+import subprocess
+import unittest
+import xmlrpclib
+
+from supervisor.xmlrpc import Faults
+
+class DummySupervisor:
+    def __init__(self, infos, signalfault=None):
+        self.infos = infos
+        self.signalfault = signalfault
+        self.signalled = []
+
+    def getProcessInfo(self, name):
+        info = self.infos[name]
+        if isinstance(info, list):
+            info = info.pop(0)
+        return info
+
+    def signalProcess(self, name, signame):
+        if self.signalfault is not None:
+            raise xmlrpclib.Fault(self.signalfault, 'nope')
+        self.signalled.append((name, signame))
+        return True
+
+class DummyRPC:
+    def __init__(self, infos=None, signalfault=None):
+        self.supervisor = DummySupervisor(infos or {}, signalfault)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class ParseActionTests(unittest.TestCase):
+    def _callFUT(self, spec):
+        from superlance.actions import parse_action
+        return parse_action(spec)
+
+    def test_restart(self):
+        from superlance.actions import Restart
+        self.failUnless(isinstance(self._callFUT('restart'), Restart))
+
+    def test_signal(self):
+        action = self._callFUT('signal:hup')
+        self.assertEqual(action.signame, 'HUP')
+        self.assertEqual(action.signum, signal.SIGHUP)
+        self.assertEqual(str(action), 'signal:HUP')
+
+    def test_signal_prefixed(self):
+        self.assertEqual(self._callFUT('signal:SIGUSR2').signum,
+                         signal.SIGUSR2)
+
+    def test_exec(self):
+        self.assertEqual(self._callFUT('exec:reload --now').command,
+                         'reload --now')
+
+    def test_bad(self):
+        for spec in ('restart:now', 'signal:', 'signal:NOPE', 'signal:_DFL',
+                     'exec:', 'kill'):
+            self.assertRaises(ValueError, self._callFUT, spec)
+
+class WaitRunningTests(unittest.TestCase):
+    def _callFUT(self, rpc, names, deadline, clock):
+        from superlance.actions import wait_running
+        return wait_running(rpc, names, deadline, clock.clock, clock.sleep)
+
+    def test_running(self):
+        clock = FakeClock()
+        rpc = DummyRPC({'foo': [{'statename': 'STARTING'},
+                                {'statename': 'RUNNING'}]})
+        self.assertEqual(self._callFUT(rpc, ['foo'], 1010, clock), {})
+        self.assertEqual(clock.now, 1000.5)
+
+    def test_fatal(self):
+        clock = FakeClock()
+        rpc = DummyRPC({'foo': [{'statename': 'FATAL'}]})
+        errors = self._callFUT(rpc, ['foo'], 1010, clock)
+        self.assertEqual(str(errors['foo']), 'foo is FATAL')
+        self.assertEqual(clock.now, 1000)
+
+    def test_deadline(self):
+        clock = FakeClock()
+        rpc = DummyRPC({'foo': {'statename': 'BACKOFF'},
+                        'bar': {'statename': 'RUNNING'}})
+        errors = self._callFUT(rpc, ['foo', 'bar'], 1002, clock)
+        self.assertEqual(errors.keys(), ['foo'])
+        self.assertEqual(clock.now, 1002)
+
+class RestartTests(unittest.TestCase):
+    def _makeOne(self):
+        from superlance.actions import Restart
+        return Restart()
+
+    def test_perform(self):
+        from superlance.tests.dummy import DummyRPCServer
+        results = self._makeOne().perform(DummyRPCServer(),
+                                          ['foo:foo', 'foo:FAILED'])
+        self.assertEqual(results[0], ('foo:foo', []))
+        self.assertEqual(results[1][1][0][0], 'stop')
+        self.assertEqual(len(results[1][1]), 1)
+
+    def test_perform_not_running(self):
+        from superlance.tests.dummy import DummyRPCServer
+        # it wasn't running, but it has been started
+        results = self._makeOne().perform(DummyRPCServer(),
+                                          ['foo:NOT_RUNNING'])
+        self.assertEqual(results, [('foo:NOT_RUNNING', [])])
+
+class SignalTests(unittest.TestCase):
+    def _makeOne(self, signame='HUP'):
+        from superlance.actions import Signal
+        return Signal(signame)
+
+    def test_signalProcess(self):
+        rpc = DummyRPC()
+        action = self._makeOne()
+        self.assertEqual(action.perform(rpc, ['foo:foo']), [('foo:foo', [])])
+        self.assertEqual(rpc.supervisor.signalled, [('foo:foo', 'HUP')])
+        self.assertEqual(action.native, True)
+
+    def test_signalProcess_fault(self):
+        rpc = DummyRPC(signalfault=Faults.BAD_NAME)
+        [(name, failures)] = self._makeOne().perform(rpc, ['foo:foo'])
+        self.assertEqual(failures[0][0], 'signal')
+        self.assertEqual(failures[0][1].faultCode, Faults.BAD_NAME)
+
+    def test_kill_without_signalProcess(self):
+        child = subprocess.Popen(['sleep', '10'])
+        try:
+            rpc = DummyRPC({'foo:foo': {'pid': child.pid}},
+                           signalfault=Faults.UNKNOWN_METHOD)
+            action = self._makeOne('TERM')
+            self.assertEqual(action.perform(rpc, ['foo:foo']),
+                             [('foo:foo', [])])
+            self.assertEqual(child.wait(), -signal.SIGTERM)
+            self.assertEqual(action.native, False)
+        finally:
+            if child.returncode is None:
+                child.kill()
+                child.wait()
+
+    def test_kill_not_running(self):
+        rpc = DummyRPC({'foo:foo': {'pid': 0}},
+                       signalfault=Faults.UNKNOWN_METHOD)
+        [(name, failures)] = self._makeOne().perform(rpc, ['foo:foo'])
+        self.assertEqual(str(failures[0][1]), 'foo:foo is not running')
+
+    def test_wait(self):
+        rpc = DummyRPC({'foo:foo': {'statename': 'STOPPED'}})
+        [(name, failures)] = self._makeOne().perform(rpc, ['foo:foo'], 5)
+        self.assertEqual(failures[0][0], 'wait')
+
+class ExecTests(unittest.TestCase):
+    def _makeOne(self, command):
+        from superlance.actions import Exec
+        return Exec(command)
+
+    def test_environment(self):
+        rpc = DummyRPC({'foo:foo': {'pid': 11}})
+        action = self._makeOne('test "$SUPERLANCE_PROCESS_NAME" = foo:foo && '
+                               'test "$SUPERLANCE_PROCESS_PID" = 11')
+        self.assertEqual(action.perform(rpc, ['foo:foo']), [('foo:foo', [])])
+
+    def test_status(self):
+        rpc = DummyRPC({'foo:foo': {'pid': 11}})
+        [(name, failures)] = self._makeOne('exit 3').perform(rpc, ['foo:foo'])
+        self.assertEqual(failures[0][0], 'exec')
+        self.assertEqual(str(failures[0][1]), 'exit 3 exited with status 3')
+
+    def test_deadline(self):
+        rpc = DummyRPC({'foo:foo': {'pid': 11}})
+        action = self._makeOne('sleep 10')
+        clock = FakeClock()
+        action.clock = clock.clock
+        action.sleep = clock.sleep
+        processes = []
+        def popen(*arg, **kw):
+            processes.append(subprocess.Popen(*arg, **kw))
+            return processes[-1]
+        action.popen = popen
+        try:
+            [(name, failures)] = action.perform(rpc, ['foo:foo'], 1)
+        finally:
+            processes[0].kill()
+            processes[0].wait()
+        self.assertEqual(str(failures[0][1]), 'sleep 10 still running')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -79,5 +79,115 @@ class CrashMailTests(unittest.TestCase):
         self.failUnless(
             'Process foo in group bar exited unexpectedly' in mail)
 
+    def test_runforever_unselected_process(self):
+        prog = self._makeOnePopulated(['foo'], None)
+        self.assertEqual(self._crash(prog, 1000, 'baz'),
+                         'unselected process\n')
+        self.failIf('mailed' in prog.__dict__)
+
+    def _crash(self, prog, now, name='foo', eventname='PROCESS_STATE_EXITED'):
+        payload=('expected:0 processname:%s groupname:bar '
+                 'from_state:RUNNING pid:1' % name)
+        prog.stdin = StringIO(
+            'eventname:%s len:%s\n%s' % (eventname, len(payload), payload))
+        prog.stderr = StringIO()
+        prog.clock = lambda: now
+        prog.runforever(test=True)
+        return prog.stderr.getvalue()
+
+    def test_runforever_window_coalesces(self):
+        prog = self._makeOnePopulated(['foo', 'baz'], None)
+        prog.window = 60
+        mailed = []
+        prog.mail = lambda email, subject, msg: mailed.append((subject, msg))
+        self.assertEqual(self._crash(prog, 1000), 'unexpected exit, mailing\n')
+        self.assertEqual(len(mailed), 1)
+        self.failUnless(mailed[0][0].startswith('[foo]: foo crashed at'))
+        self.assertEqual(self._crash(prog, 1010),
+                         'unexpected exit, coalescing\n')
+        self.assertEqual(self._crash(prog, 1020),
+                         'unexpected exit, coalescing\n')
+        # other processes have their own window
+        self.assertEqual(self._crash(prog, 1030, 'baz'),
+                         'unexpected exit, mailing\n')
+        self.assertEqual(len(mailed), 2)
+        self.assertEqual(prog.held['bar:foo'][0], 2)
+        # any event after the window sends the summary
+        self.assertEqual(self._crash(prog, 1060, eventname='TICK_60'),
+                         'mailing 2 held crashes of bar:foo\nnon-exited event\n')
+        self.assertEqual(len(mailed), 3)
+        subject, msg = mailed[2]
+        self.failUnless(subject.startswith('[foo]: foo crashed 2 more times '
+                                           'since'))
+        self.failUnless(msg.startswith('Process foo in group bar exited '
+                                       'unexpectedly 2 more times between'))
+        self.failUnless(msg.endswith('Process foo in group bar exited '
+                                     'unexpectedly (pid 1) from state '
+                                     'RUNNING'))
+        self.assertEqual(prog.held, {})
+        # still within the window started by the summary
+        self._crash(prog, 1100)
+        self.assertEqual(len(mailed), 3)
+        # a crash after the window is mailed with the held one
+        self.assertEqual(self._crash(prog, 1200),
+                         'unexpected exit, coalescing\n'
+                         'mailing 2 held crashes of bar:foo\n')
+        self.assertEqual(len(mailed), 4)
+
+    def test_runforever_no_window(self):
+        prog = self._makeOnePopulated(['foo'], None)
+        mailed = []
+        prog.mail = lambda email, subject, msg: mailed.append(subject)
+        self._crash(prog, 1000)
+        self._crash(prog, 1001)
+        self.assertEqual(len(mailed), 2)
+        self.assertEqual(prog.buckets, {})
+
+class ProgramMatcherTests(unittest.TestCase):
+    def _makeOne(self, selectors, any=False):
+        from superlance.crashmail import ProgramMatcher
+        return ProgramMatcher(selectors, any)
+
+    def test_exact(self):
+        matcher = self._makeOne(['foo', 'grp:bar', 'baz:grp2'])
+        self.failUnless(matcher.matches('foo', 'foo'))
+        self.failUnless(matcher.matches('foo', 'other'))
+        self.failUnless(matcher.matches('bar', 'grp'))
+        self.failIf(matcher.matches('bar', 'other'))
+        self.failUnless(matcher.matches('baz', 'grp2'))
+        self.failIf(matcher.matches('qux', 'qux'))
+        self.assertEqual(matcher.pattern, None)
+
+    def test_glob(self):
+        matcher = self._makeOne(['web:*', 'worker_??'])
+        self.failUnless(matcher.matches('web_01', 'web'))
+        self.failUnless(matcher.matches('worker_01', 'workers'))
+        self.failIf(matcher.matches('worker_001', 'workers'))
+        self.failIf(matcher.matches('web', 'webs'))
+
+    def test_glob_escapes(self):
+        matcher = self._makeOne(['a.b*'])
+        self.failUnless(matcher.matches('a.bc', 'g'))
+        self.failIf(matcher.matches('axbc', 'g'))
+
+    def test_regex(self):
+        matcher = self._makeOne(['/^api[0-9]+$/', '/:celery/'])
+        self.failUnless(matcher.matches('api12', 'api'))
+        self.failIf(matcher.matches('api12x', 'api'))
+        self.failUnless(matcher.matches('celery', 'tasks'))
+        self.failIf(matcher.matches('web', 'web'))
+
+    def test_cached(self):
+        matcher = self._makeOne(['web:*'])
+        matcher.matches('web_01', 'web')
+        matcher.matches('db', 'db')
+        self.assertEqual(matcher.cache, {'web:web_01': True, 'db:db': False})
+        matcher.pattern = None
+        self.failUnless(matcher.matches('web_01', 'web'))
+
+    def test_any(self):
+        self.failUnless(self._makeOne(['foo'], True).matches('bar', 'bar'))
+        self.failUnless(self._makeOne([]).matches('bar', 'bar'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -3,16 +3,54 @@ class DummyRPCServer:
         self.supervisor = DummySupervisorRPCNamespace()
         self.system = DummySystemRPCNamespace()
 
+class DummyMulticallRPCServer(DummyRPCServer):
+    """ Looks like an interface from superlance.transport.getRPCInterface,
+    so calls are batched through system.multicall """
+    def __init__(self, results):
+        from superlance.transport import KeepAliveTransport
+        DummyRPCServer.__init__(self)
+        self.system = DummyMulticallSystemRPCNamespace(results)
+        self._ServerProxy__transport = KeepAliveTransport(
+            '', '', 'http://localhost:9001')
+
+class DummyConnection:
+    sock = None
+    def __init__(self, hostport):
+        self.hostport = hostport
+
+    def connect(self):
+        self.sock = True
+
+    def close(self):
+        self.sock = None
+
 class DummyResponse:
     status = 200
     reason = 'OK'
     body = 'OK'
-    def read(self):
-        return self.body 
+    pos = 0
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self.body) - self.pos
+        chunk = self.body[self.pos:self.pos + amt]
+        self.pos += len(chunk)
+        return chunk
+
+    def isclosed(self):
+        return self.pos >= len(self.body)
         
 class DummySystemRPCNamespace:
     pass
 
+class DummyMulticallSystemRPCNamespace:
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def multicall(self, calls):
+        self.calls.append(calls)
+        return self.results
+
 
 import time
 from supervisor.process import ProcessStates
@@ -75,6 +113,10 @@ class DummySupervisorRPCNamespace:
             raise Fault(xmlrpc.Faults.SPAWN_ERROR, 'SPAWN_ERROR')
         return True
 
+    def signalProcess(self, name, signal):
+        self._signalled = (name, signal)
+        return True
+
     def stopProcess(self, name):
         from supervisor import xmlrpc
         from xmlrpclib import Fault
@@ -82,5 +124,7 @@ class DummySupervisorRPCNamespace:
             raise Fault(xmlrpc.Faults.BAD_NAME, 'BAD_NAME:BAD_NAME') 
         if name.endswith('FAILED'):
             raise Fault(xmlrpc.Faults.FAILED, 'FAILED')
+        if name.endswith('NOT_RUNNING'):
+            raise Fault(xmlrpc.Faults.NOT_RUNNING, 'NOT_RUNNING')
         return True
 
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+def make_event(eventname, payload):
+    return ('ver:3.0 server:supervisor serial:1 pool:listener '
+            'poolserial:1 eventname:%s len:%s\n%s' % (eventname,
+                                                      len(payload), payload))
+
+class EventReaderTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _getTargetClass(self):
+        from superlance.events import EventReader
+        return EventReader
+
+    def _makeOne(self, interest, **kw):
+        return self._getTargetClass()(interest, **kw)
+
+    def _file(self, data):
+        path = os.path.join(self.tempdir, 'events')
+        f = open(path, 'w')
+        f.write(data)
+        f.close()
+        return open(path)
+
+    def test_wants(self):
+        reader = self._makeOne(['TICK_*', 'PROCESS_STATE_EXITED'])
+        self.failUnless(reader.wants('TICK_60'))
+        self.failUnless(reader.wants('PROCESS_STATE_EXITED'))
+        self.failIf(reader.wants('PROCESS_STATE_RUNNING'))
+        self.assertEqual(reader.table, {'TICK_60': True,
+                                        'PROCESS_STATE_EXITED': True,
+                                        'PROCESS_STATE_RUNNING': False})
+
+    def test_wait(self):
+        reader = self._makeOne(['PROCESS_STATE_EXITED'])
+        stdin = StringIO(make_event('PROCESS_STATE_RUNNING', 'x' * 10) +
+                         make_event('PROCESS_STATE_EXITED', 'y' * 10))
+        stdout = StringIO()
+        headers, payload = reader.wait(stdin, stdout)
+        self.assertEqual(headers, {'eventname': 'PROCESS_STATE_RUNNING',
+                                   'len': '10'})
+        self.assertEqual(payload, None)
+        headers, payload = reader.wait(stdin, stdout)
+        self.assertEqual(headers['eventname'], 'PROCESS_STATE_EXITED')
+        self.assertEqual(headers['serial'], '1')
+        self.assertEqual(payload, 'y' * 10)
+        self.assertEqual(stdout.getvalue(), 'READY\nREADY\n')
+
+    def test_skip_through_buffer(self):
+        reader = self._makeOne(['TICK_*'], bufsize=4)
+        reader.smallpayload = 0
+        stdin = self._file(make_event('PROCESS_STATE_RUNNING', 'x' * 10) +
+                           make_event('TICK_5', 'when:1'))
+        try:
+            headers, payload = reader.wait(stdin, StringIO())
+            self.assertEqual(payload, None)
+            headers, payload = reader.wait(stdin, StringIO())
+            self.assertEqual(headers['eventname'], 'TICK_5')
+            self.assertEqual(payload, 'when:1')
+        finally:
+            stdin.close()
+
+    def test_unusual_header(self):
+        reader = self._makeOne(['TICK_*'])
+        # fully parsed when the fast way can't make sense of it
+        stdin = StringIO('len:3 eventname:PROCESS_STATE\nabc')
+        headers, payload = reader.wait(stdin, StringIO())
+        self.assertEqual(payload, 'abc')
+
+    def test_eof(self):
+        reader = self._makeOne([])
+        self.assertRaises(EOFError, reader.wait, StringIO(), StringIO())
+        reader.smallpayload = 0
+        stdin = self._file(make_event('TICK_5', 'when:1')[:-3])
+        try:
+            self.assertRaises(EOFError, reader.wait, stdin, StringIO())
+        finally:
+            stdin.close()
+
+class GetNameAndLenTests(unittest.TestCase):
+    def _callFUT(self, line):
+        from superlance.events import get_name_and_len
+        return get_name_and_len(line)
+
+    def test_found(self):
+        line = make_event('TICK_60', 'when:1').split('\n')[0] + '\n'
+        self.assertEqual(self._callFUT(line), ('TICK_60', 6))
+
+    def test_not_found(self):
+        self.assertEqual(self._callFUT('ver:3.0 len:3\n'), None)
+        self.assertEqual(self._callFUT('eventname:X len:3\n'), None)
+        self.assertEqual(self._callFUT('a:b eventname:X len:x\n'), None)
+
+if __name__ == '__main__':
+    unittest.main()
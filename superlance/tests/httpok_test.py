@@ -1,4 +1,6 @@
+import os
 import sys
+import copy
 import time
 import unittest
 from StringIO import StringIO
@@ -33,10 +35,7 @@ _FAIL = [ {
         },]
 
 def make_connection(response, exc=None):
-    class TestConnection:
-        def __init__(self, hostport):
-            self.hostport = hostport
-
+    class TestConnection(DummyConnection):
         def request(self, method, path):
             if exc:
                 raise ValueError('foo')
@@ -44,7 +43,7 @@ def make_connection(response, exc=None):
             self.path = path
 
         def getresponse(self):
-            return response
+            return copy.copy(response)
 
     return TestConnection
 
@@ -77,38 +76,6 @@ class HTTPOkTests(unittest.TestCase):
         prog.connclass = make_connection(response, exc=exc)
         return prog
 
-    def test_listProcesses_no_programs(self):
-        programs = []
-        any = None
-        prog = self._makeOnePopulated(programs, any)
-        specs = list(prog.listProcesses())
-        self.assertEqual(len(specs), 0)
-
-    def test_listProcesses_w_RUNNING_programs_default_state(self):
-        programs = ['foo']
-        any = None
-        prog = self._makeOnePopulated(programs, any)
-        specs = list(prog.listProcesses())
-        self.assertEqual(len(specs), 1)
-        self.assertEqual(specs[0],
-                         DummySupervisorRPCNamespace.all_process_info[0])
-
-    def test_listProcesses_w_nonRUNNING_programs_default_state(self):
-        programs = ['bar']
-        any = None
-        prog = self._makeOnePopulated(programs, any)
-        specs = list(prog.listProcesses())
-        self.assertEqual(len(specs), 1)
-        self.assertEqual(specs[0],
-                         DummySupervisorRPCNamespace.all_process_info[1])
-
-    def test_listProcesses_w_nonRUNNING_programs_RUNNING_state(self):
-        programs = ['bar']
-        any = None
-        prog = self._makeOnePopulated(programs, any)
-        specs = list(prog.listProcesses(ProcessStates.RUNNING))
-        self.assertEqual(len(specs), 0, (prog.programs, specs))
-
     def test_runforever_eager_notatick(self):
         programs = {'foo':0, 'bar':0, 'baz_01':0 }
         groups = {}
@@ -133,10 +100,10 @@ class HTTPOkTests(unittest.TestCase):
                           "'baz_01', 'notexisting']")
                          )
         self.assertEqual(lines[1], 'foo is in RUNNING state, restarting')
-        self.assertEqual(lines[2], 'foo restarted')
-        self.assertEqual(lines[3], 'bar not in RUNNING state, NOT restarting')
-        self.assertEqual(lines[4],
+        self.assertEqual(lines[2], 'bar not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[3],
                          'baz:baz_01 not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[4], 'foo restarted')
         self.assertEqual(lines[5],
           "Programs not restarted because they did not exist: ['notexisting']")
         mailed = prog.mailed.split('\n')
@@ -156,10 +123,10 @@ class HTTPOkTests(unittest.TestCase):
         #self.assertEqual(len(lines), 6)
         self.assertEqual(lines[0], 'Restarting all running processes')
         self.assertEqual(lines[1], 'foo is in RUNNING state, restarting')
-        self.assertEqual(lines[2], 'foo restarted')
-        self.assertEqual(lines[3], 'bar not in RUNNING state, NOT restarting')
-        self.assertEqual(lines[4],
+        self.assertEqual(lines[2], 'bar not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[3],
                          'baz:baz_01 not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[4], 'foo restarted')
         mailed = prog.mailed.split('\n')
         self.assertEqual(len(mailed), 11)
         self.assertEqual(mailed[0], 'To: chrism@plope.com')
@@ -209,6 +176,50 @@ class HTTPOkTests(unittest.TestCase):
         self.assertEqual(mailed[1],
                     'Subject: httpok for http://foo/bar: bad status returned')
 
+    def test_runforever_one_perform(self):
+        from supervisor.process import ProcessStates
+        from superlance.actions import Signal
+        programs = []
+        any = True
+        prog = self._makeOnePopulated(programs, any, exc=True)
+        specs = []
+        for info in DummySupervisorRPCNamespace.all_process_info:
+            info = info.copy()
+            info['state'] = ProcessStates.RUNNING
+            specs.append(info)
+        prog.rpc.supervisor.getAllProcessInfo = lambda: specs
+        calls = []
+        class RecordingSignal(Signal):
+            def perform(self, rpc, names, timeout=None):
+                calls.append(names)
+                return [ (name, []) for name in names ]
+        prog.action = RecordingSignal('USR2')
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(calls, [['foo', 'bar', 'baz:baz_01']])
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[4:7], ['ran signal:USR2 on foo',
+                                      'ran signal:USR2 on bar',
+                                      'ran signal:USR2 on baz:baz_01'])
+
+    def test_runforever_signal(self):
+        from superlance.actions import Signal
+        programs = ['foo']
+        any = False
+        prog = self._makeOnePopulated(programs, any, exc=True)
+        prog.action = Signal('USR2')
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0],
+                         "Running signal:USR2 on selected processes ['foo']")
+        self.assertEqual(lines[1],
+                         'foo is in RUNNING state, running signal:USR2')
+        self.assertEqual(lines[2], 'ran signal:USR2 on foo')
+        self.assertEqual(prog.rpc.supervisor._signalled, ('foo', 'USR2'))
+
     def test_runforever_eager_gcore(self):
         programs = ['foo', 'bar', 'baz_01', 'notexisting']
         any = None
@@ -226,10 +237,10 @@ class HTTPOkTests(unittest.TestCase):
         self.assertEqual(lines[2], '')
         self.assertEqual(lines[3], ' ')
         self.assertEqual(lines[4], 'foo is in RUNNING state, restarting')
-        self.assertEqual(lines[5], 'foo restarted')
-        self.assertEqual(lines[6], 'bar not in RUNNING state, NOT restarting')
-        self.assertEqual(lines[7],
+        self.assertEqual(lines[5], 'bar not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[6],
                          'baz:baz_01 not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[7], 'foo restarted')
         self.assertEqual(lines[8],
           "Programs not restarted because they did not exist: ['notexisting']")
         mailed = prog.mailed.split('\n')
@@ -262,13 +273,731 @@ class HTTPOkTests(unittest.TestCase):
                          ("Restarting selected processes ['foo', 'bar']")
                          )
         self.assertEqual(lines[1], 'foo is in RUNNING state, restarting')
-        self.assertEqual(lines[2], 'foo restarted')
-        self.assertEqual(lines[3], 'bar not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[2], 'bar not in RUNNING state, NOT restarting')
+        self.assertEqual(lines[3], 'foo restarted')
         mailed = prog.mailed.split('\n')
         self.assertEqual(len(mailed), 10)
         self.assertEqual(mailed[0], 'To: chrism@plope.com')
         self.assertEqual(mailed[1],
                     'Subject: httpok for http://foo/bar: bad status returned')
 
+    def _makeMultiTarget(self, failing):
+        from superlance.httpok import Target
+        targets = [Target('http://foo/bar', ['foo'], False),
+                   Target('http://baz/bar', ['baz_01'], False),
+                   Target('http://bar/bar', ['bar', 'foo'], False)]
+        prog = self._makeOnePopulated([], None)
+        prog.targets = targets
+        response = DummyResponse()
+        class TestConnection(DummyConnection):
+            def request(self, method, path):
+                if self.hostport in failing:
+                    raise ValueError('foo')
+            def getresponse(self):
+                return copy.copy(response)
+        prog.connclass = TestConnection
+        return prog
+
+    def test_runforever_multiple_targets_restarts_only_mapped(self):
+        prog = self._makeMultiTarget(['foo'])
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = filter(None, prog.stderr.getvalue().split('\n'))
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+        self.assertEqual(lines[1], 'foo is in RUNNING state, restarting')
+        self.assertEqual(lines[2], 'foo restarted')
+        self.failIf([x for x in lines if 'baz_01' in x], lines)
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                    'Subject: httpok for http://foo/bar: bad status returned')
+
+    def test_runforever_multiple_targets_restart_once_per_tick(self):
+        prog = self._makeMultiTarget(['foo', 'bar'])
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = filter(None, prog.stderr.getvalue().split('\n'))
+        self.assertEqual(len([x for x in lines if x == 'foo restarted']), 1)
+        self.failUnless('foo already restarted' in lines, lines)
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                    'Subject: httpok for http://bar/bar: bad status returned')
+
+    def test_runforever_not_eager_skips_targets_not_running(self):
+        prog = self._makeMultiTarget(['baz'])
+        prog.eager = False
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(prog.stderr.getvalue(), '')
+        self.failIf('mailed' in prog.__dict__)
+
+    def test_sweep_times_out_slow_targets(self):
+        from superlance.httpok import Target
+        import threading
+        prog = self._makeOnePopulated([], None)
+        prog.timeout = 0.2
+        targets = [Target('http://foo/bar', ['foo'], False),
+                   Target('http://slow/bar', ['bar'], False)]
+        release = threading.Event()
+        def probe(target):
+            if target.hostport == 'slow':
+                release.wait(5)
+            return (200, None, 'ok', None)
+        prog.probe = probe
+        try:
+            results = prog.sweep(targets)
+        finally:
+            release.set()
+        self.assertEqual(results[0], (targets[0], (200, None, 'ok', None)))
+        self.assertEqual(results[1][1][0], None)
+        self.assertEqual(results[1][1][2],
+            'error contacting http://slow/bar:\n\n '
+            'no response within 0.2 seconds')
+
+    def _makeKeepAlive(self, errors):
+        prog = self._makeOnePopulated(['foo'], None)
+        prog.keepalive = True
+        response = DummyResponse()
+        conns = []
+        class TestConnection(DummyConnection):
+            def __init__(self, hostport):
+                self.hostport = hostport
+                self.closed = False
+                self.requests = 0
+                conns.append(self)
+            def request(self, method, path):
+                self.requests += 1
+                if errors:
+                    raise errors.pop(0)
+            def getresponse(self):
+                return copy.copy(response)
+            def close(self):
+                self.sock = None
+                self.closed = True
+        prog.connclass = TestConnection
+        prog.stdin.write('eventname:TICK len:0\n' * 2)
+        prog.stdin.seek(0)
+        return prog, conns
+
+    def test_runforever_keepalive_reuses_connection(self):
+        prog, conns = self._makeKeepAlive([])
+        prog.runforever(test=True)
+        prog.runforever(test=True)
+        self.assertEqual(len(conns), 1)
+        self.assertEqual(conns[0].requests, 2)
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def test_runforever_keepalive_reconnects(self):
+        import httplib
+        prog, conns = self._makeKeepAlive([])
+        prog.runforever(test=True)
+        conns[0].request = lambda *arg: self._raise(httplib.BadStatusLine(''))
+        prog.runforever(test=True)
+        self.assertEqual(len(conns), 2)
+        self.failUnless(conns[0].closed)
+        self.failIf(conns[1].closed)
+        self.assertEqual(prog.targets[0].conn, conns[1])
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def test_runforever_keepalive_timeout_not_retried(self):
+        import socket
+        prog, conns = self._makeKeepAlive([])
+        prog.runforever(test=True)
+        conns[0].request = lambda *arg: self._raise(socket.timeout('slow'))
+        prog.runforever(test=True)
+        self.assertEqual(len(conns), 1)
+        self.failUnless(conns[0].closed)
+        self.assertEqual(prog.targets[0].conn, None)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+
+    def _raise(self, exc):
+        raise exc
+
+    def test_get_timings(self):
+        prog = self._makeOnePopulated([], None)
+        times = [10.0, 10.5, 11.0, 11.25]
+        prog.clock = lambda: times.pop(0)
+        conn = prog.connect(prog.targets[0])
+        res, body, timings = prog.get(conn, '/bar')
+        self.assertEqual(body, None)
+        self.assertEqual(timings, (0.5, 1.0, 1.25))
+        self.assertEqual(conn.sock, True)
+
+    def test_get_timings_already_connected(self):
+        prog = self._makeOnePopulated([], None)
+        times = [10.0, 10.0, 11.0, 11.25]
+        prog.clock = lambda: times.pop(0)
+        conn = prog.connect(prog.targets[0])
+        conn.sock = 'connected'
+        res, body, timings = prog.get(conn, '/bar')
+        self.assertEqual(timings, (0.0, 1.0, 1.25))
+        self.assertEqual(conn.sock, 'connected')
+
+    def _makeSlow(self, totals):
+        prog = self._makeOnePopulated(['foo'], None)
+        prog.latency = 2.0
+        prog.latencywindow = 4
+        prog.latencypercentile = 75
+        def probe(target):
+            timings = (0.01, totals[0] - 0.01, totals.pop(0))
+            return (200, None, 'status contacting %s: 200 OK' % target.url,
+                    timings)
+        prog.probe = probe
+        prog.stdin.write('eventname:TICK len:0\n' * 4)
+        prog.stdin.seek(0)
+        return prog
+
+    def test_runforever_latency_under_limit(self):
+        prog = self._makeSlow([0.5, 3.0, 0.5, 2.0])
+        for i in range(4):
+            prog.runforever(test=True)
+        self.assertEqual(prog.stderr.getvalue(), '')
+        self.assertEqual(list(prog.targets[0].latencies), [0.5, 3.0, 0.5, 2.0])
+
+    def test_runforever_latency_over_limit(self):
+        prog = self._makeSlow([0.5, 3.0, 0.5, 2.5])
+        for i in range(3):
+            prog.runforever(test=True)
+        self.assertEqual(prog.stderr.getvalue(), '')
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+        self.assertEqual(len(prog.targets[0].latencies), 0)
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: httpok for http://foo/bar: slow responses')
+        self.assertEqual(mailed[3], 'p75 latency of the last 4 responses from '
+                         'http://foo/bar was 2.500s, over the limit of 2.000s')
+        self.assertEqual(mailed[5], 'status contacting http://foo/bar: 200 OK')
+        self.assertEqual(mailed[6], "Restarting selected processes ['foo']")
+
+    def test_runforever_body_not_found(self):
+        from superlance.httpok import BodyMatcher
+        response = DummyResponse()
+        response.body = 'x' * 100000 + 'tasty'
+        prog = self._makeOnePopulated(['foo'], None, response=response)
+        prog.matcher = BodyMatcher('tasty')
+        prog.maxbody = 50000
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                    'Subject: httpok for http://foo/bar: bad body returned')
+
+    def test_runforever_body_found(self):
+        from superlance.httpok import BodyMatcher
+        response = DummyResponse()
+        response.body = 'x' * 100000 + 'tasty'
+        prog = self._makeOnePopulated(['foo'], None, response=response)
+        prog.matcher = BodyMatcher('tasty')
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def test_get_closes_connection_when_body_unread(self):
+        from superlance.httpok import BodyMatcher
+        response = DummyResponse()
+        response.body = 'tasty' + 'x' * 100000
+        prog = self._makeOnePopulated(['foo'], None, response=response)
+        prog.matcher = BodyMatcher('tasty')
+        conn = prog.connect(prog.targets[0])
+        res, found, timings = prog.get(conn, '/bar')
+        self.assertEqual(found, True)
+        self.assertEqual(res.pos, 8192)
+        self.assertEqual(conn.sock, None)
+
+    def _makeDamped(self, ticks, **kw):
+        from superlance.httpok import Damper
+        prog = self._makeOnePopulated(['foo'], None, exc=True)
+        prog.damper = Damper(**kw)
+        prog.clock = lambda: self.now
+        self.now = 1000
+        prog.stdin.write('eventname:TICK len:0\n' * ticks)
+        prog.stdin.seek(0)
+        return prog
+
+    def test_runforever_failures_threshold(self):
+        prog = self._makeDamped(2, failures=2, checks=3)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], 'httpok for http://foo/bar: bad status '
+                         'returned, not restarting yet')
+        self.assertEqual(lines[1], ' foo: 1 of the last 1 checks failed, '
+                         'restarting after 2')
+        self.failIf('mailed' in prog.__dict__)
+        prog.stderr = StringIO()
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+        self.assertEqual(lines[1], 'foo is in RUNNING state, restarting')
+        self.assertEqual(lines[2], 'foo restarted')
+
+    def test_runforever_failures_not_consecutive(self):
+        prog = self._makeDamped(12, failures=2, checks=3)
+        failing = prog.connclass
+        passing = make_connection(DummyResponse())
+        prog.runforever(test=True)
+        prog.connclass = passing
+        for i in range(10):
+            prog.runforever(test=True)
+        prog.connclass = failing
+        prog.stderr = StringIO()
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], ' foo: 1 of the last 3 checks failed, '
+                         'restarting after 2')
+        self.failIf('mailed' in prog.__dict__)
+
+    def test_runforever_cooldown(self):
+        prog = self._makeDamped(2, cooldown=60)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[2], 'foo restarted')
+        prog.stderr = StringIO()
+        del prog.mailed
+        self.now += 10
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], ' foo: restarted recently, not '
+                         'restarting for 50 seconds')
+        self.failIf('mailed' in prog.__dict__)
+
+    def test_probe_msg_includes_timings(self):
+        prog = self._makeOnePopulated([], None)
+        times = [10.0, 10.5, 11.0, 11.25]
+        prog.clock = lambda: times.pop(0)
+        status, found, msg, timings = prog.probe(prog.targets[0])
+        self.assertEqual(status, 200)
+        self.assertEqual(msg, 'status contacting http://foo/bar: 200 OK\n\n'
+                         ' connect 0.500s, first byte 1.000s, total 1.250s')
+
+class TargetTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.httpok import Target
+        return Target
+
+    def _makeOne(self, *opts):
+        return self._getTargetClass()(*opts)
+
+    def test_ctor(self):
+        target = self._makeOne('https://foo:8080/bar?baz=1', ['foo'], False)
+        self.assertEqual(target.hostport, 'foo:8080')
+        self.assertEqual(target.path, '/bar?baz=1')
+        from superlance.timeoutconn import TimeoutHTTPSConnection
+        self.assertEqual(target.connclass, TimeoutHTTPSConnection)
+
+    def test_ctor_tcp(self):
+        target = self._makeOne('tcp://[::1]:6379/?send=PING%0D%0A'
+                               '&expect=%2BPONG', ['foo'], False)
+        self.assertEqual(target.host, '::1')
+        self.assertEqual(target.port, 6379)
+        self.assertEqual(target.send, 'PING\r\n')
+        self.assertEqual(target.matcher.pattern, '+PONG')
+        self.assertEqual(target.connclass, None)
+
+    def test_ctor_tcp_no_port(self):
+        self.assertRaises(ValueError, self._makeOne, 'tcp://foo', [], True)
+
+    def test_ctor_bad_scheme(self):
+        self.assertRaises(ValueError, self._makeOne, 'ftp://foo', [], True)
+
+    def test_matches(self):
+        target = self._makeOne('http://foo/', ['foo', 'baz:baz_01'], False)
+        self.failUnless(target.matches({'name':'foo', 'group':'foo'}))
+        self.failUnless(target.matches({'name':'baz_01', 'group':'baz'}))
+        self.failIf(target.matches({'name':'bar', 'group':'bar'}))
+
+class HTTPOkCoreDumpTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+        self.coredir = os.path.join(self.tempdir, 'cores')
+        os.mkdir(self.coredir)
+        # a gcore which writes 'core' to <name>.<pid>, like gcore -o
+        self.gcore = os.path.join(self.tempdir, 'gcore')
+        f = open(self.gcore, 'w')
+        f.write('printf core > "$1.$2"\necho dumped $2\n')
+        f.close()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _makeDumper(self, **kw):
+        from superlance.httpok import CoreDumper
+        return CoreDumper('sh %s' % self.gcore, self.coredir, **kw)
+
+    def _makeOne(self, background=False, defer=False, **kw):
+        from superlance.httpok import HTTPOk
+        prog = HTTPOk(DummyRPCServer(), ['foo'], False, 'http://foo/bar', 10,
+                      '200', None, 'chrism@plope.com', 'cat - > /dev/null',
+                      self.coredir, 'sh %s' % self.gcore, True,
+                      dumper=self._makeDumper(**kw),
+                      gcorebackground=background, gcoredefer=defer)
+        prog.stdin = StringIO()
+        prog.stdout = StringIO()
+        prog.stderr = StringIO()
+        prog.connclass = make_connection(DummyResponse(), exc=True)
+        return prog
+
+    def test_dump(self):
+        dumper = self._makeDumper()
+        self.assertEqual(dumper.dump('foo:bar', 11), 'dumped 11\n')
+        path = os.path.join(self.coredir, 'foo:bar.11')
+        self.assertEqual(open(path).read(), 'core')
+
+    def test_dump_compress(self):
+        import gzip
+        dumper = self._makeDumper(compress=True)
+        output = dumper.dump('foo', 11)
+        path = os.path.join(self.coredir, 'foo.11')
+        self.assertEqual(output, 'dumped 11\n\n compressed %s to %s.gz' % (
+            path, path))
+        self.assertEqual(os.listdir(self.coredir), ['foo.11.gz'])
+        self.assertEqual(gzip.open(path + '.gz').read(), 'core')
+
+    def test_dump_prune(self):
+        old = os.path.join(self.coredir, 'old.1')
+        open(old, 'w').write('x' * 10)
+        os.utime(old, (0, 0))
+        dumper = self._makeDumper(maxsize=8)
+        output = dumper.dump('foo', 11)
+        self.assertEqual(output, 'dumped 11\n\n removed %s to keep %s under '
+                         '8 bytes' % (old, self.coredir))
+        self.assertEqual(os.listdir(self.coredir), ['foo.11'])
+
+    def test_dump_prune_only_finished_cores(self):
+        for name in ('notes.txt', 'bar.12', 'old.1.gz'):
+            path = os.path.join(self.coredir, name)
+            open(path, 'w').write('x' * 10)
+            os.utime(path, (0, 0))
+        dumper = self._makeDumper(maxsize=8)
+        # still being written by another dump
+        dumper.running['bar'] = None
+        output = dumper.dump('foo', 11)
+        old = os.path.join(self.coredir, 'old.1.gz')
+        self.assertEqual(output, 'dumped 11\n\n removed %s to keep %s under '
+                         '8 bytes' % (old, self.coredir))
+        self.assertEqual(sorted(os.listdir(self.coredir)),
+                         ['bar.12', 'foo.11', 'notes.txt'])
+
+    def test_background(self):
+        dumper = self._makeDumper()
+        dumper.start('foo', 11)
+        self.failUnless(dumper.busy('foo'))
+        self.failUnless(dumper.full())
+        dumper.wait()
+        self.assertEqual(dumper.finished(), [('foo', 'dumped 11\n')])
+        self.failIf(dumper.busy('foo'))
+        self.assertEqual(dumper.finished(), [])
+
+    def test_runforever_gcore_background(self):
+        prog = self._makeOne(background=True)
+        prog.stdin.write('eventname:TICK len:0\neventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'gcore of foo started in the background')
+        self.assertEqual(lines[2], 'foo is in RUNNING state, restarting')
+        self.assertEqual(lines[3], 'foo restarted')
+        prog.dumper.wait()
+        prog.stderr = StringIO()
+        prog.connclass = make_connection(DummyResponse())
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], 'gcore output for foo:')
+        self.assertEqual(lines[2], ' dumped 11')
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1], 'Subject: httpok: gcore of foo finished')
+
+    def test_runforever_gcore_defer(self):
+        prog = self._makeOne(background=True, defer=True)
+        prog.stdin.write('eventname:TICK len:0\neventname:NOTATICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'foo is in RUNNING state, running gcore, '
+                         'restarting when it finishes')
+        self.failIf('foo restarted' in lines, lines)
+        self.assertEqual(prog.pending, ['foo'])
+        prog.dumper.wait()
+        prog.stderr = StringIO()
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], 'gcore output for foo:')
+        self.assertEqual(lines[2], ' dumped 11')
+        self.assertEqual(lines[4], 'foo dumped, restarting')
+        self.assertEqual(lines[5], 'foo restarted')
+        self.assertEqual(prog.pending, [])
+
+    def test_restart_pending(self):
+        prog = self._makeOne(background=True, defer=True)
+        prog.pending.append('foo')
+        messages = []
+        spec = DummySupervisorRPCNamespace.all_process_info[0]
+        prog.restart(spec, messages.append)
+        self.assertEqual(messages, ['foo is in RUNNING state, restarting when '
+                                    'its gcore finishes'])
+
+    def test_restart_gcore_jobs_full(self):
+        prog = self._makeOne(background=True)
+        prog.dumper.running['other'] = None
+        messages = []
+        spec = DummySupervisorRPCNamespace.all_process_info[0]
+        prog.restart(spec, messages.append)
+        self.assertEqual(messages, ['1 gcore programs are already running, '
+                                    'not dumping foo',
+                                    'foo is in RUNNING state, restarting',
+                                    'foo restarted'])
+
+class HTTPOkTCPTests(unittest.TestCase):
+    def setUp(self):
+        import socket
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.received = []
+
+    def tearDown(self):
+        self.server.close()
+
+    def _serve(self, reply):
+        import threading
+        def serve():
+            conn, addr = self.server.accept()
+            self.received.append(conn.recv(100))
+            conn.sendall(reply)
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _makeOne(self, url):
+        from superlance.httpok import HTTPOk
+        prog = HTTPOk(DummyRPCServer(), ['foo'], False, url, 2, '200', None,
+                      'chrism@plope.com', 'cat - > /dev/null', None, None,
+                      True)
+        prog.stdin = StringIO()
+        prog.stdout = StringIO()
+        prog.stderr = StringIO()
+        return prog
+
+    def test_connect(self):
+        prog = self._makeOne('tcp://127.0.0.1:%s' % self.port)
+        status, found, msg, timings = prog.probe(prog.targets[0])
+        self.assertEqual(status, True)
+        self.assertEqual(found, None)
+        self.failUnless(msg.startswith('connected to tcp://127.0.0.1:'), msg)
+
+    def test_connect_refused(self):
+        self.server.close()
+        prog = self._makeOne('tcp://127.0.0.1:%s' % self.port)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1], 'Subject: httpok for tcp://127.0.0.1:%s: '
+                         'connection failed' % self.port)
+        self.assertEqual(mailed[3], 'error connecting to tcp://127.0.0.1:%s:'
+                         % self.port)
+
+    def test_send_expect(self):
+        thread = self._serve('+PONG\r\n')
+        prog = self._makeOne('tcp://127.0.0.1:%s/?send=PING%%0D%%0A'
+                             '&expect=%%2BPONG' % self.port)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        thread.join()
+        self.assertEqual(self.received, ['PING\r\n'])
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def test_send_expect_wrong_reply(self):
+        thread = self._serve('-ERR\r\n')
+        prog = self._makeOne('tcp://127.0.0.1:%s/?send=PING%%0D%%0A'
+                             '&expect=%%2BPONG' % self.port)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        thread.join()
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1], 'Subject: httpok for tcp://127.0.0.1:%s/'
+                         '?send=PING%%0D%%0A&expect=%%2BPONG: bad response '
+                         'returned' % self.port)
+        self.assertEqual(mailed[3], "connected to tcp://127.0.0.1:%s/"
+                         "?send=PING%%0D%%0A&expect=%%2BPONG, but did not "
+                         "receive '+PONG'" % self.port)
+
+class DamperTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.httpok import Damper
+        return Damper
+
+    def _makeOne(self, *arg, **kw):
+        return self._getTargetClass()(*arg, **kw)
+
+    def test_disabled(self):
+        damper = self._makeOne()
+        self.failIf(damper.enabled())
+        self.assertEqual(damper.ready('foo', 0), None)
+
+    def test_failures_of_checks(self):
+        damper = self._makeOne(failures=2, checks=3)
+        damper.record('foo', True, 0)
+        self.assertEqual(damper.ready('foo', 0),
+                         '1 of the last 1 checks failed, restarting after 2')
+        damper.record('foo', False, 1)
+        damper.record('foo', True, 2)
+        self.assertEqual(damper.ready('foo', 2), None)
+        damper.record('foo', False, 3)
+        self.assertEqual(damper.ready('foo', 3),
+                         '1 of the last 3 checks failed, restarting after 2')
+        self.assertEqual(damper.ready('bar', 3),
+                         '0 of the last 0 checks failed, restarting after 2')
+
+    def test_cooldown_backoff(self):
+        damper = self._makeOne(cooldown=10, maxcooldown=25)
+        damper.record('foo', True, 0)
+        damper.restarted('foo', 0)
+        self.assertEqual(damper.ready('foo', 5),
+                         'restarted recently, not restarting for 5 seconds')
+        damper.record('foo', True, 10)
+        self.assertEqual(damper.ready('foo', 10), None)
+        damper.restarted('foo', 10)
+        self.assertEqual(damper.ready('foo', 29), 'restarted recently, '
+                         'not restarting for 1 seconds')
+        damper.record('foo', True, 30)
+        damper.restarted('foo', 30)
+        # capped at maxcooldown
+        self.assertEqual(damper.ready('foo', 54), 'restarted recently, '
+                         'not restarting for 1 seconds')
+        damper.record('foo', True, 55)
+        self.assertEqual(damper.ready('foo', 55), None)
+
+    def test_passing_after_cooldown_resets_backoff(self):
+        damper = self._makeOne(cooldown=10)
+        damper.restarted('foo', 0)
+        damper.record('foo', False, 5)
+        damper.restarted('foo', 10)
+        self.assertEqual(damper.ready('foo', 29), 'restarted recently, '
+                         'not restarting for 1 seconds')
+        damper.record('foo', False, 30)
+        damper.restarted('foo', 40)
+        damper.record('foo', True, 50)
+        self.assertEqual(damper.ready('foo', 50), None)
+
+class ReadBodyTests(unittest.TestCase):
+    def _callFUT(self, body, pattern=None, regex=False, maxbytes=None,
+                 chunksize=4):
+        from superlance.httpok import read_body, BodyMatcher
+        res = DummyResponse()
+        res.body = body
+        matcher = None
+        if pattern is not None:
+            matcher = BodyMatcher(pattern, regex)
+        return read_body(res, matcher, maxbytes, chunksize), res.pos
+
+    def test_no_matcher_reads_all(self):
+        self.assertEqual(self._callFUT('x' * 10), ((None, True), 10))
+
+    def test_no_matcher_maxbytes(self):
+        self.assertEqual(self._callFUT('x' * 10, maxbytes=6),
+                         ((None, False), 6))
+
+    def test_found_across_chunks(self):
+        self.assertEqual(self._callFUT('abcdefghij', 'def'),
+                         ((True, False), 8))
+
+    def test_found_at_end(self):
+        self.assertEqual(self._callFUT('abcdefghij', 'ij'),
+                         ((True, True), 10))
+
+    def test_not_found(self):
+        self.assertEqual(self._callFUT('abcdefghij', 'xyz'),
+                         ((False, True), 10))
+
+    def test_not_found_before_maxbytes(self):
+        self.assertEqual(self._callFUT('abcdefghij', 'hij', maxbytes=8),
+                         ((False, False), 8))
+
+    def test_regex_across_chunks(self):
+        self.assertEqual(self._callFUT('status: ok\nmore', r'status:\s+ok',
+                                       regex=True),
+                         ((True, False), 12))
+
+    def test_regex_not_found(self):
+        self.assertEqual(self._callFUT('status: bad', r'status:\s+ok',
+                                       regex=True),
+                         ((False, True), 11))
+
+class PercentileTests(unittest.TestCase):
+    def _callFUT(self, values, percent):
+        from superlance.httpok import percentile
+        return percentile(values, percent)
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3, 10, 9, 8, 7, 6]
+        self.assertEqual(self._callFUT(values, 95), 10)
+        self.assertEqual(self._callFUT(values, 50), 5)
+        self.assertEqual(self._callFUT(values, 0), 1)
+        self.assertEqual(self._callFUT([3.5], 99), 3.5)
+
+class ParseConfigTests(unittest.TestCase):
+    def _callFUT(self, text, programs, any):
+        from superlance.httpok import parse_config
+        return parse_config(StringIO(text), programs, any)
+
+    def test_parse(self):
+        targets = self._callFUT(
+            '# comment\n'
+            '\n'
+            'http://foo/ foo baz:baz_01\n'
+            'http://bar/ *\n'
+            'http://baz/\n',
+            ['bar'], False)
+        self.assertEqual(len(targets), 3)
+        self.assertEqual(targets[0].url, 'http://foo/')
+        self.assertEqual(targets[0].programs, ['foo', 'baz:baz_01'])
+        self.assertEqual(targets[0].any, False)
+        self.assertEqual(targets[1].any, True)
+        self.assertEqual(targets[2].programs, ['bar'])
+
+    def test_parse_action(self):
+        targets = self._callFUT(
+            'http://foo/ foo action=signal:HUP\n'
+            'http://bar/ "action=exec:reload --all"\n'
+            'http://baz/ baz\n',
+            ['bar'], False)
+        self.assertEqual(targets[0].programs, ['foo'])
+        self.assertEqual(str(targets[0].action), 'signal:HUP')
+        self.assertEqual(targets[1].programs, ['bar'])
+        self.assertEqual(targets[1].action.command, 'reload --all')
+        self.assertEqual(targets[2].action, None)
+
+class ProbePoolTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.httpok import ProbePool
+        return ProbePool
+
+    def _makeOne(self, size):
+        return self._getTargetClass()(size)
+
+    def test_map(self):
+        pool = self._makeOne(2)
+        results = pool.map(lambda x: x * 2, [1, 2, 3], 5)
+        self.assertEqual(results, [2, 4, 6])
+        self.assertEqual(len(pool.threads), 2)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -22,6 +22,15 @@ class MemmonTests(unittest.TestCase):
         memmon.pscommand = 'echo 22%s'
         return memmon
         
+    def test_mail_uses_notifier(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        sent = []
+        memmon.notifier.sendtext = sent.append
+        memmon.mail('chrism@plope.com', 'subject', 'body')
+        self.assertEqual(sent, ['To: chrism@plope.com\nSubject: subject\n\n'
+                                'body'])
+        self.assertEqual(memmon.mailed, sent[0])
+
     def test_runforever_notatick(self):
         programs = {'foo':0, 'bar':0, 'baz_01':0 }
         groups = {}
@@ -191,6 +200,514 @@ class MemmonTests(unittest.TestCase):
           'Subject: memmon: failed to stop process BAD_NAME:BAD_NAME, exiting')
         self.assertEqual(mailed[2], '')
         self.failUnless(mailed[3].startswith('Failed'))
-        
+
+    def test_runforever_tick_uses_sampler(self):
+        programs = {'foo':0}
+        groups = {}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.sampler = DummySampler({11:4096})
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertEqual(memmon.sampler.sampled, [[11, 12, 12]])
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo is 4096')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
+    def test_runforever_tick_programs_tree(self):
+        from superlance.memmon import ProcessTree
+        programs = {'foo':10000}
+        groups = {'foo':5000}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.modes = {('program', 'foo'):{'scope':'tree'}}
+        memmon.sampler = DummySampler({11:4096, 20:4096, 21:4096},
+                                      ProcessTree({11:[20], 20:[21]}))
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertEqual(memmon.sampler.sampled, [[11, 12, 12, 20, 21]])
+        lines = memmon.stderr.getvalue().split('\n')
+        # the group rule is not checked once the program rule restarted
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0], 'Checking programs foo=10000')
+        self.assertEqual(lines[1], 'Checking groups foo=5000')
+        self.assertEqual(lines[2], 'RSS of foo:foo and 2 descendants is 12288')
+        self.assertEqual(lines[3], 'Restarting foo:foo')
+        self.assertEqual(lines[4], '')
+
+    def test_runforever_tick_groups_tree_norestart(self):
+        from superlance.memmon import ProcessTree
+        programs = {}
+        groups = {'foo':10000}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.modes = {('group', 'foo'):{'scope':'tree'}}
+        memmon.sampler = DummySampler({11:4096, 20:4096},
+                                      ProcessTree({11:[20]}))
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo and 1 descendants is 8192')
+        self.assertEqual(lines[2], '')
+        self.assertEqual(memmon.mailed, False)
+
+    def test_runforever_tick_programs_pss_under_rss_limit(self):
+        programs = {'foo':8192}
+        groups = {}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.modes = {('program', 'foo'):{'metric':'pss'}}
+        memmon.sampler = DummySampler({11:4096})
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        # RSS is an upper bound on PSS, so smaps is never read
+        self.assertEqual(memmon.sampler.smapsed, [])
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo is 4096')
+        self.assertEqual(memmon.mailed, False)
+
+    def test_runforever_tick_programs_pss_under_limit(self):
+        programs = {'foo':8192}
+        groups = {}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.modes = {('program', 'foo'):{'metric':'pss'}}
+        memmon.sampler = DummySampler(
+            {11:16384}, smaps={11:{'rss':16384, 'pss':6000, 'uss':1000}})
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertEqual(memmon.sampler.smapsed, [11])
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'PSS of foo:foo is 6000')
+        self.assertEqual(memmon.mailed, False)
+
+    def test_runforever_tick_groups_uss_tree_over_limit(self):
+        from superlance.memmon import ProcessTree
+        programs = {}
+        groups = {'foo':8192}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.modes = {('group', 'foo'):{'metric':'uss', 'scope':'tree'}}
+        memmon.sampler = DummySampler(
+            {11:16384, 20:16384, 21:16384}, ProcessTree({11:[20, 21]}),
+            smaps={11:{'rss':16384, 'pss':9000, 'uss':1000},
+                   20:{'rss':16384, 'pss':9000, 'uss':8000}})
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        # 21 exited between sampling and reading smaps
+        self.assertEqual(memmon.sampler.smapsed, [11, 20, 21])
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'USS of foo:foo and 2 descendants is 9000')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.failUnless(memmon.mailed.endswith('(9000 bytes USS)'))
+
+    def test_runforever_tick_any_pss_without_smaps(self):
+        programs = {}
+        groups = {}
+        any = 0
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.modes = {('any', None):{'metric':'pss'}}
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo is 2264064')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
+    def _makeLeaking(self, leakaction, start):
+        import time
+        from superlance.memmon import History
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.leak = 1024 * 1024
+        memmon.window = 3
+        memmon.leakaction = leakaction
+        history = History(3)
+        now = time.time()
+        history.append(now - 120, start)
+        history.append(now - 60, start + 1024 * 1024)
+        memmon.histories['foo:foo'] = (11, history)
+        memmon.histories['gone:gone'] = (99, History(3))
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        return memmon
+
+    def test_runforever_tick_leak_restart(self):
+        memmon = self._makeLeaking('restart', 0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.failUnless(lines[1].startswith(
+            'RSS of foo:foo is growing by 113'))
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.failUnless(' because its memory was growing by 113'
+                        in memmon.mailed)
+        # foo:foo starts over, bar and baz are new
+        self.assertEqual(sorted(memmon.histories.keys()),
+                         ['bar:bar', 'baz:baz_01'])
+
+    def test_runforever_tick_leak_mail(self):
+        memmon = self._makeLeaking('mail', 0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.failUnless(lines[1].startswith(
+            'RSS of foo:foo is growing by 113'))
+        self.assertEqual(lines[2], '')
+        mailed = memmon.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: memmon: process foo:foo is leaking memory')
+
+    def test_runforever_tick_leak_slow_growth(self):
+        memmon = self._makeLeaking('restart', 2000000)
+        memmon.runforever(test=True)
+        self.assertEqual(memmon.stderr.getvalue(), '\n')
+        self.assertEqual(memmon.mailed, False)
+        self.assertEqual(len(memmon.histories['foo:foo'][1]), 3)
+
+    def test_runforever_tick_leak_new_pid(self):
+        memmon = self._makeLeaking('restart', 0)
+        memmon.histories['foo:foo'] = (10, memmon.histories['foo:foo'][1])
+        memmon.runforever(test=True)
+        self.assertEqual(memmon.mailed, False)
+        self.assertEqual(memmon.histories['foo:foo'][0], 11)
+        self.assertEqual(len(memmon.histories['foo:foo'][1]), 1)
+
+    def _makeStaggered(self, maxrestarts, keeprunning):
+        from supervisor.process import ProcessStates
+        memmon = self._makeOnePopulated({}, {'web':1000}, None)
+        memmon.maxrestarts = maxrestarts
+        memmon.keeprunning = keeprunning
+        memmon.rpc.supervisor.all_process_info = []
+        for name, pid in ('a', 11), ('b', 12), ('c', 13), ('d', 14):
+            memmon.rpc.supervisor.all_process_info.append({
+                'name':name, 'group':'web', 'pid':pid,
+                'state':ProcessStates.RUNNING, 'statename':'RUNNING'})
+        memmon.sampler = DummySampler({11:2000, 12:4000, 13:3000, 14:500})
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        return memmon
+
+    def test_runforever_tick_staggered_max_restarts(self):
+        memmon = self._makeStaggered(2, None)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1:5], ['RSS of web:a is 2000',
+                                      'RSS of web:b is 4000',
+                                      'RSS of web:c is 3000',
+                                      'RSS of web:d is 500'])
+        # worst first
+        self.assertEqual(lines[5], 'Deferring restart of web:a, already '
+                         'restarted 2 in group web this tick')
+        self.assertEqual(lines[6], 'Restarting web:b')
+        self.assertEqual(lines[7], 'Restarting web:c')
+        self.assertEqual(lines[8], '')
+        self.assertEqual(memmon.queue, [])
+
+    def test_runforever_tick_staggered_one_round_trip(self):
+        memmon = self._makeStaggered(None, 0)
+        infos = memmon.rpc.supervisor.all_process_info
+        memmon.rpc = DummyMulticallRPCServer([[True]] * 6)
+        memmon.rpc.supervisor.all_process_info = infos
+        memmon.runforever(test=True)
+        calls = memmon.rpc.system.calls
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([ (x['methodName'], x['params']) for x in calls[0] ],
+                         [('supervisor.stopProcess', ['web:b']),
+                          ('supervisor.startProcess', ['web:b']),
+                          ('supervisor.stopProcess', ['web:c']),
+                          ('supervisor.startProcess', ['web:c']),
+                          ('supervisor.stopProcess', ['web:a']),
+                          ('supervisor.startProcess', ['web:a'])])
+        self.failUnless(memmon.mailed.startswith(
+            'To: chrism@plope.com\nSubject: memmon: process web:a restarted'))
+
+    def test_runforever_tick_staggered_leak_deferred(self):
+        import time
+        from superlance.memmon import History
+        memmon = self._makeStaggered(1, None)
+        memmon.groups = {}
+        memmon.leak = 1
+        memmon.window = 3
+        memmon.leakaction = 'restart'
+        now = time.time()
+        for pname, pid in ('web:a', 11), ('web:b', 12):
+            history = History(3)
+            history.append(now - 120, 0)
+            history.append(now - 60, 1000)
+            memmon.histories[pname] = (pid, history)
+        # a second tick
+        memmon.stdin.seek(0, 2)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[3], 'Deferring restart of web:a, already '
+                         'restarted 1 in group web this tick')
+        self.assertEqual(lines[4], 'Restarting web:b')
+        # web:a keeps its samples, web:b starts over
+        self.assertEqual(len(memmon.histories['web:a'][1]), 3)
+        self.failIf('web:b' in memmon.histories)
+        # so web:a is restarted on the next tick
+        memmon.stderr.truncate(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual([ line for line in lines
+                           if line.startswith('Restarting') ],
+                         ['Restarting web:a'])
+
+    def test_runforever_tick_programs_signal(self):
+        from superlance.memmon import parse_namesize
+        name, size, modes = parse_namesize('-p', 'foo=0,signal:HUP')
+        memmon = self._makeOnePopulated({name:size}, {}, None)
+        memmon.modes[('program', name)] = modes
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[2], 'Running signal:HUP on foo:foo')
+        self.assertEqual(memmon.rpc.supervisor._signalled, ('foo:foo', 'HUP'))
+        mailed = memmon.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: memmon: ran signal:HUP on process foo:foo')
+
+    def test_runforever_tick_staggered_keep_running(self):
+        memmon = self._makeStaggered(None, 3)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[5], 'Deferring restart of web:c, only 3 in '
+                         'group web are RUNNING')
+        self.assertEqual(lines[6], 'Deferring restart of web:a, only 3 in '
+                         'group web are RUNNING')
+        self.assertEqual(lines[7], 'Restarting web:b')
+        self.assertEqual(lines[8], '')
+
+    def test_runforever_tick_staggered_keep_running_all_over(self):
+        memmon = self._makeStaggered(None, 2)
+        memmon.sampler = DummySampler({11:2000, 12:4000, 13:3000, 14:1500})
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        # restarting two of the four leaves two RUNNING
+        self.assertEqual(lines[5], 'Deferring restart of web:a, only 2 in '
+                         'group web are RUNNING')
+        self.assertEqual(lines[6], 'Deferring restart of web:d, only 2 in '
+                         'group web are RUNNING')
+        self.assertEqual(lines[7], 'Restarting web:b')
+        self.assertEqual(lines[8], 'Restarting web:c')
+        self.assertEqual(lines[9], '')
+
+    def test_runforever_tick_staggered_keep_running_stopped(self):
+        from supervisor.process import ProcessStates
+        memmon = self._makeStaggered(None, 3)
+        memmon.rpc.supervisor.all_process_info[3]['state'] = \
+            ProcessStates.STARTING
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[5], 'Deferring restart of web:b, only 3 in '
+                         'group web are RUNNING')
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(memmon.mailed, False)
+
+class DummySampler:
+    def __init__(self, rsses, tree=None, smaps=None):
+        self.rsses = rsses
+        self.processtree = tree
+        self.details = smaps or {}
+        self.sampled = []
+        self.smapsed = []
+
+    def sample(self, pids):
+        self.sampled.append(pids)
+        return self.rsses
+
+    def smaps(self, pid):
+        self.smapsed.append(pid)
+        return self.details.get(pid)
+
+    def tree(self):
+        return self.processtree
+
+class HistoryTests(unittest.TestCase):
+    def _makeOne(self, size):
+        from superlance.memmon import History
+        return History(size)
+
+    def test_append_wraps(self):
+        history = self._makeOne(3)
+        self.failIf(history.full())
+        for i in range(5):
+            history.append(i, i * 10)
+        self.failUnless(history.full())
+        self.assertEqual(len(history), 3)
+        self.assertEqual(list(history.times), [3.0, 4.0, 2.0])
+
+    def test_slope(self):
+        history = self._makeOne(4)
+        history.append(1000.0, 100)
+        self.assertEqual(history.slope(), 0.0)
+        history.append(1010.0, 300)
+        history.append(1020.0, 300)
+        history.append(1030.0, 700)
+        self.assertEqual(history.slope(), 18.0)
+        # the oldest sample is overwritten
+        history.append(1040.0, 700)
+        self.assertEqual(history.slope(), 16.0)
+
+    def test_slope_same_time(self):
+        history = self._makeOne(2)
+        history.append(1000.0, 100)
+        history.append(1000.0, 300)
+        self.assertEqual(history.slope(), 0.0)
+
+class ProcessTreeTests(unittest.TestCase):
+    def _makeOne(self, children):
+        from superlance.memmon import ProcessTree
+        return ProcessTree(children)
+
+    def test_descendants(self):
+        tree = self._makeOne({1:[11, 12], 11:[20, 21], 21:[30]})
+        self.assertEqual(sorted(tree.descendants(11)), [20, 21, 30])
+        self.assertEqual(tree.descendants(30), [])
+        self.assertEqual(len(tree.descendants(1)), 5)
+
+class ProcSamplerTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.memmon import ProcSampler
+        return ProcSampler
+
+    def setUp(self):
+        import tempfile
+        self.procdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.procdir)
+
+    def _makeProc(self, pid, name, data):
+        import os
+        piddir = os.path.join(self.procdir, str(pid))
+        if not os.path.isdir(piddir):
+            os.mkdir(piddir)
+        f = open(os.path.join(piddir, name), 'w')
+        f.write(data)
+        f.close()
+
+    def test_available(self):
+        klass = self._getTargetClass()
+        self.failIf(klass.available(self.procdir))
+        self._makeProc('self', 'statm', '1 2 3 4 5 6 7\n')
+        self.failUnless(klass.available(self.procdir))
+
+    def test_sample(self):
+        self._makeProc(11, 'statm', '2000 100 50 10 0 300 0\n')
+        self._makeProc(12, 'statm', '2000 7 50 10 0 300 0\n')
+        self._makeProc(13, 'statm', 'garbage\n')
+        sampler = self._getTargetClass()(self.procdir)
+        sampler.pagesize = 4096
+        rsses = sampler.sample([11, 12, 13, 14])
+        self.assertEqual(rsses, {11:100 * 4096, 12:7 * 4096})
+
+    def test_smaps_rollup(self):
+        self._makeProc(11, 'smaps_rollup',
+            '00400000-7ffd0000 ---p 00000000 00:00 0    [rollup]\n'
+            'Rss:                 400 kB\n'
+            'Pss:                 150 kB\n'
+            'Pss_Anon:            100 kB\n'
+            'Shared_Clean:        300 kB\n'
+            'Private_Clean:        20 kB\n'
+            'Private_Dirty:        80 kB\n'
+            'Private_Hugetlb:       0 kB\n')
+        sampler = self._getTargetClass()(self.procdir)
+        self.assertEqual(sampler.smaps(11),
+                         {'rss':400 * 1024, 'pss':150 * 1024,
+                          'uss':100 * 1024})
+
+    def test_smaps_fallback(self):
+        self._makeProc(11, 'smaps',
+            '00400000-00452000 r-xp 00000000 08:02 173521 /usr/bin/foo\n'
+            'Rss:                 100 kB\n'
+            'Pss:                  50 kB\n'
+            'Private_Dirty:        10 kB\n'
+            '00651000-00652000 rw-p 00051000 08:02 173521 /usr/bin/foo\n'
+            'Rss:                   4 kB\n'
+            'Pss:                   4 kB\n'
+            'Private_Dirty:         4 kB\n'
+            'VmFlags: rd wr mr mw me ac\n')
+        sampler = self._getTargetClass()(self.procdir)
+        self.assertEqual(sampler.smaps(11),
+                         {'rss':104 * 1024, 'pss':54 * 1024,
+                          'uss':14 * 1024})
+
+    def test_smaps_missing(self):
+        sampler = self._getTargetClass()(self.procdir)
+        self.assertEqual(sampler.smaps(11), None)
+
+    def test_tree(self):
+        self._makeProc(1, 'stat', '1 (init) S 0 1 1 0 -1\n')
+        self._makeProc(11, 'stat', '11 (gunicorn: master) S 1 11 11 0\n')
+        self._makeProc(20, 'stat', '20 (a) (b)) R 11 11 11 0\n')
+        self._makeProc(21, 'stat', '21 (worker) S 11 11 11 0\n')
+        self._makeProc(22, 'stat', '')
+        self._makeProc('self', 'stat', '22 (python) S 1 1 1 0\n')
+        sampler = self._getTargetClass()(self.procdir)
+        tree = sampler.tree()
+        self.assertEqual(sorted(tree.descendants(11)), [20, 21])
+        self.assertEqual(sorted(tree.descendants(0)), [1, 11, 20, 21])
+
+class PSSamplerTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.memmon import PSSampler
+        return PSSampler
+
+    def test_sample(self):
+        sampler = self._getTargetClass()('echo 22%s')
+        self.assertEqual(sampler.sample([11]), {11:2211 * 1024})
+
+    def test_sample_no_output(self):
+        sampler = self._getTargetClass()('true %s')
+        self.assertEqual(sampler.sample([11]), {})
+
+    def test_sample_garbage(self):
+        sampler = self._getTargetClass()('echo foo%s')
+        self.assertEqual(sampler.sample([11]), {})
+
+    def test_tree(self):
+        sampler = self._getTargetClass()()
+        sampler.pstreecommand = 'printf "  11     1\\n 20 11\\njunk\\n"'
+        tree = sampler.tree()
+        self.assertEqual(tree.descendants(1), [11, 20])
+
+class ParseLimitTests(unittest.TestCase):
+    def test_plain(self):
+        from superlance.memmon import parse_limit
+        self.assertEqual(parse_limit('-a', '1MB'), (1024 * 1024, {}))
+
+    def test_tree(self):
+        from superlance.memmon import parse_namesize
+        self.assertEqual(parse_namesize('-p', 'foo=1KB,tree'),
+                         ('foo', 1024, {'scope':'tree'}))
+
+    def test_metric(self):
+        from superlance.memmon import parse_namesize
+        self.assertEqual(parse_namesize('-g', 'foo=1KB,pss,tree'),
+                         ('foo', 1024, {'scope':'tree', 'metric':'pss'}))
+
+    def test_action(self):
+        from superlance.memmon import parse_namesize
+        name, size, modes = parse_namesize('-p', 'foo=1KB,exec:reload foo')
+        self.assertEqual(str(modes['action']), 'exec:reload foo')
+
+class MakeSamplerTests(unittest.TestCase):
+    def test_ps(self):
+        from superlance.memmon import make_sampler
+        self.assertEqual(make_sampler('ps'), None)
+
+    def test_proc(self):
+        from superlance.memmon import make_sampler, ProcSampler
+        self.failUnless(isinstance(make_sampler('proc'), ProcSampler))
+
 if __name__ == '__main__':
     unittest.main()  
\ No newline at end of file
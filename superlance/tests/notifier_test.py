@@ -0,0 +1,559 @@
+import os
+import shutil
+import smtplib
+import socket
+import tempfile
+import unittest
+from StringIO import StringIO
+from email.MIMEText import MIMEText
+
+def make_message(body='body', to='you@example.com'):
+    msg = MIMEText(body)
+    msg['From'] = 'me@example.com'
+    msg['To'] = to
+    msg['Subject'] = 'Test'
+    return msg
+
+class DummySMTP:
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.calls = []
+        self.sent = []
+        self.errors = []
+        DummySMTP.instances.append(self)
+
+    def ehlo(self):
+        self.calls.append('ehlo')
+
+    def starttls(self):
+        self.calls.append('starttls')
+
+    def sendmail(self, sender, recipients, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((sender, recipients, text))
+
+    def quit(self):
+        self.calls.append('quit')
+
+    def close(self):
+        self.calls.append('close')
+
+class TokenBucketTests(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from superlance.notifier import TokenBucket
+        return TokenBucket(*arg, **kw)
+
+    def test_burst_then_rate(self):
+        bucket = self._makeOne(2, per=60)
+        self.failUnless(bucket.take(0))
+        self.failUnless(bucket.take(0))
+        self.failIf(bucket.take(0))
+        self.assertEqual(bucket.wait(0), 30)
+        self.assertAlmostEqual(bucket.wait(10), 20)
+        self.failUnless(bucket.take(30))
+        self.failIf(bucket.take(30))
+
+    def test_refill_capped(self):
+        bucket = self._makeOne(1, per=10, burst=2)
+        bucket.take(0)
+        bucket.take(0)
+        bucket.refill(1000)
+        self.assertEqual(bucket.tokens, 2)
+
+class SinkTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sendmail(self):
+        from superlance.notifier import SendmailSink
+        path = os.path.join(self.tempdir, 'email.log')
+        sink = SendmailSink('cat - > %s' % path)
+        subject = 'x' * 100
+        msg = make_message()
+        msg.replace_header('Subject', subject)
+        sink.deliver(msg)
+        text = open(path).read()
+        # not folded
+        self.failUnless(('Subject: %s\n' % subject) in text)
+        self.failUnless(text.endswith('\n\nbody'))
+
+    def test_sendmail_fails(self):
+        from superlance.notifier import SendmailSink, NotifierError
+        from superlance.notifier import permanent
+        sink = SendmailSink('cat > /dev/null; exit 3')
+        try:
+            sink.deliver(make_message())
+        except NotifierError, why:
+            self.failUnless(permanent(why))
+        else:
+            self.fail('no error')
+        # EX_TEMPFAIL is worth retrying
+        sink = SendmailSink('cat > /dev/null; exit 75')
+        try:
+            sink.deliver(make_message())
+        except NotifierError, why:
+            self.failIf(permanent(why))
+        else:
+            self.fail('no error')
+
+    def test_permanent(self):
+        from superlance.notifier import permanent
+        self.failUnless(permanent(smtplib.SMTPRecipientsRefused(
+            {'a': (550, 'no such user'), 'b': (553, 'bad address')})))
+        self.failIf(permanent(smtplib.SMTPRecipientsRefused(
+            {'a': (550, 'no such user'), 'b': (450, 'try later')})))
+        self.failUnless(permanent(smtplib.SMTPSenderRefused(
+            553, 'denied', 'me')))
+        self.failUnless(permanent(smtplib.SMTPDataError(554, 'spam')))
+        self.failIf(permanent(smtplib.SMTPDataError(451, 'try later')))
+        self.failIf(permanent(smtplib.SMTPServerDisconnected('gone')))
+        self.failIf(permanent(socket.error('refused')))
+
+    def test_file(self):
+        from superlance.notifier import FileSink
+        path = os.path.join(self.tempdir, 'mbox')
+        sink = FileSink(path)
+        sink.deliver(make_message('From here'))
+        sink.deliver(make_message('two'))
+        import mailbox
+        msgs = list(mailbox.mbox(path))
+        self.assertEqual(len(msgs), 2)
+        self.assertEqual(msgs[0].get_payload(), '>From here\n')
+        self.assertEqual(msgs[1]['To'], 'you@example.com')
+
+    def test_webhook(self):
+        from superlance.notifier import WebhookSink, NotifierError
+        requests = []
+        class DummyResponse:
+            def __init__(self, status):
+                self.status = status
+                self.reason = 'Reason'
+            def read(self):
+                return ''
+        class DummyConnection:
+            status = 204
+            def __init__(self, netloc, timeout=None):
+                self.netloc = netloc
+            def request(self, method, path, body, headers):
+                requests.append((self.netloc, method, path, body))
+            def getresponse(self):
+                return DummyResponse(DummyConnection.status)
+            def close(self):
+                pass
+        sink = WebhookSink('http://localhost:8000/hook?x=1')
+        sink.connclass = DummyConnection
+        sink.deliver(make_message())
+        netloc, method, path, body = requests[0]
+        self.assertEqual((netloc, method, path),
+                         ('localhost:8000', 'POST', '/hook?x=1'))
+        import json
+        self.assertEqual(json.loads(body),
+                         {'to': 'you@example.com', 'from': 'me@example.com',
+                          'subject': 'Test', 'body': 'body'})
+        DummyConnection.status = 500
+        self.assertRaises(NotifierError, sink.deliver, make_message())
+
+    def test_make_sink(self):
+        from superlance import notifier
+        sink = notifier.make_sink('sendmail:/usr/sbin/sendmail -t')
+        self.assertEqual(sink.command, '/usr/sbin/sendmail -t')
+        sink = notifier.make_sink('smtp:mail.example.com:2525')
+        self.assertEqual((sink.host, sink.port), ('mail.example.com', 2525))
+        sink = notifier.make_sink('smtp:')
+        self.assertEqual((sink.host, sink.port), ('localhost', None))
+        sink = notifier.make_sink('webhook:https://example.com/')
+        self.assertEqual(sink.path, '/')
+        sink = notifier.make_sink('file:/tmp/mbox')
+        self.assertEqual(sink.path, '/tmp/mbox')
+        for spec in ('sendmail', 'smtp:host:port', 'webhook:ftp://x',
+                     'file:', 'pigeon:x'):
+            self.assertRaises(ValueError, notifier.make_sink, spec)
+
+class CombineTests(unittest.TestCase):
+    def _callFUT(self, msgs):
+        from superlance.notifier import combine
+        return combine(msgs)
+
+    def test_one_each(self):
+        msgs = [make_message(to='a'), make_message(to='b')]
+        self.assertEqual(self._callFUT(msgs), msgs)
+
+    def test_combined(self):
+        msgs = [make_message('one', to='a'), make_message('two', to='b'),
+                make_message('three', to='a')]
+        result = self._callFUT(msgs)
+        self.assertEqual(len(result), 2)
+        digest = result[0]
+        self.assertEqual(digest['To'], 'a')
+        self.assertEqual(digest['From'], 'me@example.com')
+        self.assertEqual(digest['Subject'], 'Test (and 1 more)')
+        self.assertEqual(digest.get_payload(),
+                         'Subject: Test\n\none\n\nSubject: Test\n\nthree')
+        self.failUnless(result[1] is msgs[1])
+
+class SMTPSinkTests(unittest.TestCase):
+    def setUp(self):
+        DummySMTP.instances = []
+
+    def _getTargetClass(self):
+        from superlance.notifier import SMTPSink
+        return SMTPSink
+
+    def _makeOne(self, *arg, **kw):
+        sink = self._getTargetClass()(*arg, **kw)
+        sink.smtpclass = DummySMTP
+        return sink
+
+    def test_connection_reused(self):
+        sink = self._makeOne('mail.example.com')
+        sink.deliver(make_message('one'))
+        sink.deliver(make_message('two'))
+        self.assertEqual(len(DummySMTP.instances), 1)
+        conn = DummySMTP.instances[0]
+        self.assertEqual(conn.host, 'mail.example.com')
+        self.assertEqual(conn.calls, ['ehlo'])
+        self.assertEqual(len(conn.sent), 2)
+        self.assertEqual(conn.sent[0][:2],
+                         ('me@example.com', ['you@example.com']))
+
+    def test_envelope_no_from(self):
+        sink = self._makeOne(sender='listener@example.com')
+        msg = make_message()
+        del msg['From']
+        sink.deliver(msg)
+        self.assertEqual(DummySMTP.instances[0].sent[0][:2],
+                         ('listener@example.com', ['you@example.com']))
+
+    def test_envelope_default_sender(self):
+        from superlance.notifier import default_sender
+        sink = self._makeOne()
+        self.assertEqual(sink.sender, default_sender())
+        self.failUnless('@' in sink.sender)
+
+    def test_envelope_several_recipients(self):
+        sink = self._makeOne()
+        sink.deliver(make_message(to='a@example.com, Bee <b@example.com>'))
+        self.assertEqual(DummySMTP.instances[0].sent[0][:2],
+                         ('me@example.com', ['a@example.com',
+                                             'b@example.com']))
+
+    def test_starttls(self):
+        sink = self._makeOne(starttls=True)
+        sink.deliver(make_message())
+        self.assertEqual(DummySMTP.instances[0].calls,
+                         ['ehlo', 'starttls', 'ehlo'])
+
+    def test_reconnects_once(self):
+        sink = self._makeOne()
+        sink.deliver(make_message())
+        old = DummySMTP.instances[0]
+        old.errors.append(smtplib.SMTPServerDisconnected('gone'))
+        sink.deliver(make_message('two'))
+        self.assertEqual(len(DummySMTP.instances), 2)
+        self.assertEqual(old.calls, ['ehlo', 'quit'])
+        self.assertEqual(len(DummySMTP.instances[1].sent), 1)
+
+    def test_fresh_connection_error_raised(self):
+        class BrokenSMTP(DummySMTP):
+            def sendmail(self, sender, recipients, text):
+                raise socket.error('reset')
+        sink = self._makeOne()
+        sink.smtpclass = BrokenSMTP
+        self.assertRaises(socket.error, sink.deliver, make_message())
+        self.assertEqual(sink.conn, None)
+        # an old connection is given up on, and a new one tried once
+        sink = self._makeOne()
+        sink.connect()
+        sink.smtpclass = BrokenSMTP
+        sink.conn.errors.append(socket.error('reset'))
+        self.assertRaises(socket.error, sink.deliver, make_message())
+        self.assertEqual(len(DummySMTP.instances), 3)
+
+    def test_close(self):
+        sink = self._makeOne()
+        sink.deliver(make_message())
+        sink.close()
+        self.assertEqual(DummySMTP.instances[0].calls, ['ehlo', 'quit'])
+        self.assertEqual(sink.conn, None)
+
+class DummySink:
+    def __init__(self):
+        self.delivered = []
+        self.errors = []
+        self.closed = False
+
+    def deliver(self, msg):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.delivered.append(msg)
+
+    def close(self):
+        self.closed = True
+
+class NotifierTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _getTargetClass(self):
+        from superlance.notifier import Notifier
+        return Notifier
+
+    def _makeOne(self, **kw):
+        sink = DummySink()
+        kw.setdefault('stderr', StringIO())
+        notifier = self._getTargetClass()(sink, **kw)
+        notifier.clock = lambda: self.now
+        return notifier
+
+    def test_send_not_started_is_synchronous(self):
+        notifier = self._makeOne()
+        msg = make_message()
+        notifier.send(msg)
+        self.assertEqual(notifier.sink.delivered, [msg])
+        notifier.sink.errors.append(smtplib.SMTPException('nope'))
+        self.assertRaises(smtplib.SMTPException, notifier.send, msg)
+
+    def test_send_started(self):
+        notifier = self._makeOne()
+        notifier.start()
+        try:
+            msg = make_message()
+            notifier.send(msg)
+        finally:
+            notifier.stop(5)
+        self.assertEqual(notifier.sink.delivered, [msg])
+        self.failUnless(notifier.sink.closed)
+
+    def test_sendtext(self):
+        notifier = self._makeOne()
+        notifier.sendtext('To: a\nSubject: b\n\nbody')
+        msg = notifier.sink.delivered[0]
+        self.assertEqual((msg['To'], msg['Subject'], msg.get_payload()),
+                         ('a', 'b', 'body'))
+
+    def test_run_combines_queued(self):
+        from superlance.notifier import _STOP
+        notifier = self._makeOne()
+        for body in ('one', 'two', 'three'):
+            notifier.queue.put(make_message(body))
+        notifier.queue.put(_STOP)
+        notifier.run()
+        self.assertEqual(len(notifier.sink.delivered), 1)
+        self.assertEqual(notifier.sink.delivered[0]['Subject'],
+                         'Test (and 2 more)')
+        self.failUnless(notifier.sink.closed)
+
+    def test_run_rate_limited(self):
+        from superlance.notifier import _STOP
+        notifier = self._makeOne(rate=1)
+        notifier.queue.put(make_message('one'))
+        notifier.queue.put(_STOP)
+        notifier.run()
+        self.assertEqual(notifier.limiter.wait(self.now), 60)
+
+    def test_run_rate_limited_recipients(self):
+        notifier = self._makeOne(rate=1)
+        notifier.queue.put(make_message('one', to='a'))
+        notifier.queue.put(make_message('two', to='b'))
+        msgs, stop = notifier.collect()
+        notifier.dispatch(msgs, stop)
+        # one token: the second recipient waits for the next
+        self.assertEqual([ msg['To'] for msg in notifier.sink.delivered ],
+                         ['a'])
+        self.assertEqual(notifier.ratewait(), 60)
+        notifier.queue.put(make_message('three', to='b'))
+        self.now += 60
+        msgs, stop = notifier.collect()
+        notifier.dispatch(msgs, stop)
+        self.assertEqual([ msg['To'] for msg in notifier.sink.delivered ],
+                         ['a', 'b'])
+        self.assertEqual(notifier.sink.delivered[1]['Subject'],
+                         'Test (and 1 more)')
+        self.assertEqual(notifier.deferred, [])
+
+    def test_collect_bounded(self):
+        notifier = self._makeOne(maxqueue=3)
+        for body in ('one', 'two', 'three'):
+            notifier.queue.put(make_message(body))
+        notifier.maxqueue = 2
+        msgs, stop = notifier.collect()
+        self.assertEqual(len(msgs), 2)
+        self.failIf(stop)
+        self.assertEqual(notifier.queue.qsize(), 1)
+
+    def test_stop_waits_for_queued(self):
+        import time
+        notifier = self._makeOne()
+        deliver = notifier.sink.deliver
+        def slow(msg):
+            time.sleep(0.3)
+            deliver(msg)
+        notifier.sink.deliver = slow
+        notifier.start()
+        notifier.send(make_message('one', to='a'))
+        notifier.send(make_message('two', to='b'))
+        notifier.stop(5)
+        self.assertEqual(len(notifier.sink.delivered), 2)
+
+    def test_queue_full_dropped(self):
+        notifier = self._makeOne(maxqueue=1)
+        # pretend to be started without running the thread
+        notifier.thread = object()
+        notifier.send(make_message('one'))
+        notifier.send(make_message('two'))
+        self.assertEqual(notifier.queue.qsize(), 1)
+        self.assertEqual(notifier.stderr.getvalue(),
+            'Notification queue full, dropping message to you@example.com\n')
+
+    def test_queue_full_spooled(self):
+        notifier = self._makeOne(maxqueue=1, spooldir=self.tempdir)
+        notifier.thread = object()
+        notifier.send(make_message('one'))
+        notifier.send(make_message('two'))
+        self.assertEqual(len(notifier.spooled()), 1)
+        notifier.process(None)
+        self.assertEqual([ msg.get_payload() for msg in
+                           notifier.sink.delivered ], ['two'])
+        self.assertEqual(notifier.spooled(), [])
+
+    def test_process_backs_off(self):
+        notifier = self._makeOne()
+        notifier.sink.errors.append(socket.error('refused'))
+        notifier.process(make_message('one'))
+        self.assertEqual(notifier.stderr.getvalue(),
+            'Error sending email: refused, retrying in 1 seconds\n')
+        self.assertEqual(notifier.retry, 1001.0)
+        # too early: held behind the first one
+        notifier.process(make_message('two'))
+        self.assertEqual(notifier.sink.delivered, [])
+        self.assertEqual(len(notifier.held), 2)
+        # fails again: the delay doubles
+        self.now = 1001.0
+        notifier.sink.errors.append(socket.error('refused'))
+        notifier.process(None)
+        self.assertEqual(notifier.retry, 1003.0)
+        self.assertEqual(len(notifier.held), 2)
+        self.now = 1003.0
+        notifier.process(None)
+        self.assertEqual([ msg.get_payload() for msg in
+                           notifier.sink.delivered ], ['one', 'two'])
+        self.failIf(notifier.has_held())
+        self.assertEqual(notifier.failures, 0)
+
+    def test_process_backoff_capped(self):
+        notifier = self._makeOne(maxbackoff=5)
+        notifier.failures = 10
+        notifier.sink.errors.append(socket.error('refused'))
+        notifier.process(make_message())
+        self.assertEqual(notifier.retry, 1005.0)
+
+    def test_held_bounded(self):
+        notifier = self._makeOne(maxqueue=2)
+        notifier.retry = 2000
+        for body in ('one', 'two', 'three'):
+            notifier.process(make_message(body, to=body))
+        self.assertEqual([ msg.get_payload() for msg in notifier.held ],
+                         ['two', 'three'])
+        self.assertEqual(notifier.stderr.getvalue(),
+                         'Dropping undeliverable message to one\n')
+
+    def test_process_permanent_failure_given_up(self):
+        notifier = self._makeOne()
+        notifier.sink.errors.append(smtplib.SMTPDataError(554, 'spam'))
+        notifier.process(make_message('one'))
+        self.assertEqual(notifier.stderr.getvalue(),
+            'Error sending email to you@example.com: (554, \'spam\'), '
+            'giving up\n')
+        self.assertEqual(notifier.retry, 0)
+        self.failIf(notifier.has_held())
+        notifier.process(make_message('two'))
+        self.assertEqual([ msg.get_payload() for msg in
+                           notifier.sink.delivered ], ['two'])
+
+    def test_process_permanent_failure_spooled_set_aside(self):
+        notifier = self._makeOne(spooldir=self.tempdir)
+        notifier.sink.errors.append(socket.error('refused'))
+        notifier.process(make_message('one'))
+        notifier.process(make_message('two'))
+        self.now = 1001.0
+        # the first is rejected but doesn't stop the second
+        notifier.sink.errors.append(smtplib.SMTPRecipientsRefused(
+            {'you@example.com': (550, 'no such user')}))
+        notifier.process(None)
+        self.assertEqual([ msg.get_payload() for msg in
+                           notifier.sink.delivered ], ['two'])
+        self.failIf(notifier.has_held())
+        names = os.listdir(self.tempdir)
+        self.assertEqual(len(names), 1)
+        self.failUnless(names[0].endswith('.eml.failed'))
+
+    def test_unreadable_spooled_set_aside(self):
+        notifier = self._makeOne(spooldir=self.tempdir)
+        os.mkdir(os.path.join(self.tempdir, 'broken.eml'))
+        self.failUnless(notifier.has_held())
+        notifier.process(None)
+        self.failUnless('Error reading spooled message' in
+                        notifier.stderr.getvalue())
+        self.assertEqual(os.listdir(self.tempdir), ['broken.eml.failed'])
+        self.failIf(notifier.has_held())
+
+    def test_unremovable_spooled_skipped(self):
+        notifier = self._makeOne(spooldir=self.tempdir)
+        notifier.spool(make_message('one'))
+        def remove(path):
+            raise OSError(13, 'Permission denied')
+        import superlance.notifier
+        old = superlance.notifier.os.remove
+        superlance.notifier.os.remove = remove
+        try:
+            notifier.process(None)
+        finally:
+            superlance.notifier.os.remove = old
+        self.failUnless('Error removing spooled message' in
+                        notifier.stderr.getvalue())
+        self.assertEqual(len(notifier.sink.delivered), 1)
+        # not sent again
+        self.failIf(notifier.has_held())
+        notifier.process(None)
+        self.assertEqual(len(notifier.sink.delivered), 1)
+
+    def test_run_survives_errors(self):
+        from superlance.notifier import _STOP
+        notifier = self._makeOne()
+        def broken(msg):
+            raise ValueError('oops')
+        notifier.process = broken
+        notifier.queue.put(make_message('one'))
+        notifier.queue.put(_STOP)
+        notifier.run()
+        self.assertEqual(notifier.stderr.getvalue(),
+                         'Error in notifier: oops\n')
+        self.failUnless(notifier.sink.closed)
+
+    def test_spooled_survives_restart(self):
+        notifier = self._makeOne(spooldir=self.tempdir)
+        notifier.sink.errors.append(socket.error('refused'))
+        notifier.process(make_message('one'))
+        self.assertEqual(len(notifier.spooled()), 1)
+        self.failIf(os.listdir(self.tempdir)[0].endswith('.tmp'))
+        # a new listener picks it up
+        notifier = self._makeOne(spooldir=self.tempdir)
+        self.failUnless(notifier.has_held())
+        notifier.process(None)
+        self.assertEqual(notifier.sink.delivered[0].get_payload(), 'one')
+        self.assertEqual(notifier.sink.delivered[0]['To'],
+                         'you@example.com')
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+if __name__ == '__main__':
+    unittest.main()
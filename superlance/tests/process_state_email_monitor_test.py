@@ -1,5 +1,6 @@
 import unittest
 import mock
+import email.MIMEText
 import time
 from StringIO import StringIO
 
@@ -72,6 +73,33 @@ class ProcessStateEmailMonitorTests(unittest.TestCase):
 
         #Test that error was logged to stderr
         self.assertEquals("Error sending email: test\n", monitor.stderr.getvalue())
+
+    def test_run_flushes_notifier_on_exit(self):
+        monitor = self._make_one()
+        delivered = []
+        monitor.notifier.sink = mock.Mock()
+        monitor.notifier.sink.deliver = delivered.append
+        msg = email.MIMEText.MIMEText('body')
+        msg['To'] = self.to_email
+        def handle_event(headers, payload):
+            monitor.notifier.send(msg)
+        monitor.handle_event = handle_event
+        monitor.stdin = StringIO('eventname:TICK_60 len:0\n')
+        self.assertRaises(EOFError, monitor.run)
+        self.assertEquals([msg], delivered)
+        self.assertEquals(None, monitor.notifier.thread)
+
+    def test_send_smtp_uses_notifier(self):
+        monitor = self._make_one(smtp_host='mail.blah.com',
+                                 smtp_starttls=True, send_queue=5,
+                                 spool_dir='/tmp/spool')
+        self.assertEquals('mail.blah.com', monitor.notifier.sink.host)
+        self.failUnless(monitor.notifier.sink.starttls)
+        self.assertEquals(5, monitor.notifier.maxqueue)
+        self.assertEquals('/tmp/spool', monitor.notifier.spooldir)
+        monitor.notifier.send = mock.Mock()
+        monitor.send_smtp('msg')
+        monitor.notifier.send.assert_called_with('msg')
     
     def test_send_batch_notification(self):
         test_msgs = ['msg1', 'msg2']
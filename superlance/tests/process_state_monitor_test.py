@@ -20,6 +20,8 @@ class ProcessStateMonitorTests(unittest.TestCase):
         kwargs['stdin'] = StringIO()
         kwargs['stdout'] = StringIO()
         kwargs['stderr'] = StringIO()
+        self.now = 1000.0
+        kwargs['clock'] = lambda: self.now
         
         obj = self._get_target_class()(**kwargs)
         obj.send_batch_notification = mock.Mock()
@@ -81,6 +83,7 @@ pid:58597' % (pname, gname, expected)
         monitor.handle_event(hdrs, payload)
         self.assertEquals(2, len(monitor.get_batch_msgs()))
         #Time expired
+        self.now += 60
         hdrs, payload = self.get_tick60_event()
         monitor.handle_event(hdrs, payload)
         
@@ -91,11 +94,106 @@ pid:58597' % (pname, gname, expected)
 
     def test_handle_event_tick_interval_not_expired(self):
         monitor = self._make_one_mocked(interval=3)
+        hdrs, payload = self.get_process_exited_event('foo', 'bar', 0)
+        monitor.handle_event(hdrs, payload)
         hdrs, payload = self.get_tick60_event()
+        self.now += 60
         monitor.handle_event(hdrs, payload)
         self.assertEquals(1.0, monitor.get_batch_minutes())
+        self.now += 60
         monitor.handle_event(hdrs, payload)
         self.assertEquals(2.0, monitor.get_batch_minutes())
+        self.assertEquals(0, monitor.send_batch_notification.call_count)
+
+    def test_handle_event_tick_late(self):
+        monitor = self._make_one_mocked(interval=3)
+        hdrs, payload = self.get_process_exited_event('foo', 'bar', 0)
+        monitor.handle_event(hdrs, payload)
+        # one tick, three minutes late
+        self.now += 180
+        hdrs, payload = self.get_tick60_event()
+        monitor.handle_event(hdrs, payload)
+        self.assertEquals(1, monitor.send_batch_notification.call_count)
+        self.assertEquals(0.0, monitor.get_batch_minutes())
+
+    def test_handle_event_tick_no_batch(self):
+        monitor = self._make_one_mocked()
+        self.now += 600
+        hdrs, payload = self.get_tick60_event()
+        monitor.handle_event(hdrs, payload)
+        self.assertEquals(0, monitor.send_batch_notification.call_count)
+
+    def test_handle_event_exit_without_tick(self):
+        monitor = self._make_one_mocked()
+        hdrs, payload = self.get_process_exited_event('foo', 'bar', 0)
+        monitor.handle_event(hdrs, payload)
+        self.now += 60
+        monitor.handle_event(hdrs, payload)
+        self.assertEquals(1, monitor.send_batch_notification.call_count)
+
+    def test_handle_event_flush_size(self):
+        monitor = self._make_one_mocked(interval=60, flush_size=2)
+        hdrs, payload = self.get_process_exited_event('foo', 'bar', 0)
+        monitor.handle_event(hdrs, payload)
+        self.assertEquals(0, monitor.send_batch_notification.call_count)
+        monitor.handle_event(hdrs, payload)
+        self.assertEquals(1, monitor.send_batch_notification.call_count)
+        self.assertEquals([], monitor.get_batch_msgs())
+
+    def test_handle_event_urgent(self):
+        monitor = self._make_one_mocked(interval=60,
+                                        urgent_events=['PROCESS_STATE_EXITED'])
+        hdrs, payload = self.get_process_exited_event('foo', 'bar', 0)
+        monitor.handle_event(hdrs, payload)
+        self.assertEquals(1, monitor.send_batch_notification.call_count)
+
+    def test_handle_event_exit_bounded(self):
+        monitor = self._make_one_mocked(batch_lines=2, batch_keys=1)
+        for i in range(100):
+            hdrs, payload = self.get_process_exited_event('foo', 'bar', 0)
+            monitor.handle_event(hdrs, payload)
+        hdrs, payload = self.get_process_exited_event('bark', 'dog', 0)
+        monitor.handle_event(hdrs, payload)
+        self.assertEquals(101, len(monitor.batchmsgs))
+        msgs = monitor.get_batch_msgs()
+        self.assertEquals(4, len(msgs))
+        self.failUnless(msgs[0].startswith(
+            'bar:foo PROCESS_STATE_EXITED: 100 events from '))
+        self.failUnless(msgs[0].endswith(', the last 2:'))
+        self.assertEquals('... and 1 more events for other processes',
+                          msgs[3])
+
+class BatchBufferTests(unittest.TestCase):
+
+    def _make_one(self, lines=2, keys=2):
+        from superlance.process_state_monitor import BatchBuffer
+        return BatchBuffer(lines, keys)
+
+    def test_not_rolled_up(self):
+        batch = self._make_one()
+        batch.append('a1', 'a', 10)
+        batch.append('b1', 'b', 11)
+        batch.append('a2', 'a', 12)
+        self.assertEquals(3, len(batch))
+        self.assertEquals(['a1', 'b1', 'a2'], list(batch))
+
+    def test_rolled_up(self):
+        batch = self._make_one()
+        batch.format_time = str
+        batch.append('a1', ('g', 'a', 'EV'), 10)
+        batch.append('b1', ('g', 'b', 'EV'), 11)
+        batch.append('a2', ('g', 'a', 'EV'), 12)
+        batch.append('a3', ('g', 'a', 'EV'), 13)
+        self.assertEquals(['g:a EV: 3 events from 10 to 13, the last 2:',
+                           'a2', 'a3', 'b1'], list(batch))
+
+    def test_keys_bounded(self):
+        batch = self._make_one(keys=1)
+        batch.append('a1', 'a', 10)
+        batch.append('b1', 'b', 11)
+        batch.append('b2', 'b', 12)
+        self.assertEquals(['a1', '... and 2 more events for other processes'],
+                          list(batch))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,127 @@
+import os
+import unittest
+from superlance.tests.dummy import *
+
+class CountingRPCServer(DummyRPCServer):
+    def __init__(self):
+        DummyRPCServer.__init__(self)
+        self.calls = 0
+        getAllProcessInfo = self.supervisor.getAllProcessInfo
+        def counting():
+            self.calls += 1
+            return getAllProcessInfo()
+        self.supervisor.getAllProcessInfo = counting
+
+class ProcessInfoSnapshotTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.snapshot import ProcessInfoSnapshot
+        return ProcessInfoSnapshot
+
+    def _makeOne(self, rpc, maxage=5):
+        snapshot = self._getTargetClass()(rpc, self.path, maxage)
+        snapshot.clock = lambda: self.now
+        return snapshot
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'snapshot')
+        self.now = 1000.0
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def test_getAllProcessInfo_shared(self):
+        rpc = CountingRPCServer()
+        first = self._makeOne(rpc)
+        second = self._makeOne(rpc)
+        self.assertEqual(first.getAllProcessInfo(),
+                         DummySupervisorRPCNamespace.all_process_info)
+        self.now += 4
+        self.assertEqual(second.getAllProcessInfo(),
+                         DummySupervisorRPCNamespace.all_process_info)
+        self.assertEqual(rpc.calls, 1)
+
+    def test_getAllProcessInfo_too_old(self):
+        rpc = CountingRPCServer()
+        snapshot = self._makeOne(rpc)
+        snapshot.getAllProcessInfo()
+        self.now += 6
+        snapshot.getAllProcessInfo()
+        self.assertEqual(rpc.calls, 2)
+        # and the refreshed one is shared again
+        snapshot.getAllProcessInfo()
+        self.assertEqual(rpc.calls, 2)
+
+    def test_getAllProcessInfo_same_tick_only(self):
+        rpc = CountingRPCServer()
+        first = self._makeOne(rpc)
+        second = self._makeOne(rpc)
+        first.tick = second.tick = '1000'
+        first.getAllProcessInfo()
+        second.getAllProcessInfo()
+        self.assertEqual(rpc.calls, 1)
+        # young enough, but from the tick before
+        self.now += 1
+        first.tick = second.tick = '1005'
+        first.getAllProcessInfo()
+        self.assertEqual(rpc.calls, 2)
+        second.getAllProcessInfo()
+        self.assertEqual(rpc.calls, 2)
+
+    def test_getAllProcessInfo_clock_went_backwards(self):
+        rpc = CountingRPCServer()
+        snapshot = self._makeOne(rpc)
+        snapshot.getAllProcessInfo()
+        self.now -= 60
+        snapshot.getAllProcessInfo()
+        self.assertEqual(rpc.calls, 2)
+
+    def test_getAllProcessInfo_mangled_file(self):
+        rpc = CountingRPCServer()
+        snapshot = self._makeOne(rpc)
+        f = open(self.path, 'w')
+        f.write('<params><param><value>')
+        f.close()
+        self.assertEqual(len(snapshot.getAllProcessInfo()), 3)
+        self.assertEqual(rpc.calls, 1)
+        self.assertEqual(len(snapshot.read()), 3)
+
+    def test_write_leaves_no_temporary_files(self):
+        snapshot = self._makeOne(DummyRPCServer())
+        snapshot.getAllProcessInfo()
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['snapshot', 'snapshot.lock'])
+
+class WrapTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def test_wrap(self):
+        from superlance.snapshot import wrap
+        rpc = CountingRPCServer()
+        wrapped = wrap(rpc, os.path.join(self.tempdir, 'snapshot'))
+        wrapped.supervisor.getAllProcessInfo()
+        wrapped.supervisor.getAllProcessInfo()
+        self.assertEqual(rpc.calls, 1)
+        self.assertEqual(wrapped.supervisor.startProcess('foo'), True)
+        self.failUnless(wrapped.system is rpc.system)
+
+    def test_set_tick(self):
+        from superlance.snapshot import wrap, set_tick
+        rpc = CountingRPCServer()
+        wrapped = wrap(rpc, os.path.join(self.tempdir, 'snapshot'))
+        set_tick(wrapped, 'when:1005')
+        self.assertEqual(wrapped.snapshot.tick, '1005')
+        # a plain RPC interface is left alone
+        set_tick(rpc, 'when:1005')
+        self.failIf(hasattr(rpc, 'snapshot'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import socket
+import threading
+import time
+import unittest
+
+class InterleaveTests(unittest.TestCase):
+    def _callFUT(self, addrs):
+        from superlance.timeoutconn import interleave
+        return interleave(addrs)
+
+    def test_interleave(self):
+        addrs = [(10, 1), (10, 2), (10, 3), (2, 4), (2, 5)]
+        self.assertEqual(self._callFUT(addrs),
+                         [(10, 1), (2, 4), (10, 2), (2, 5), (10, 3)])
+
+    def test_one_family(self):
+        addrs = [(2, 1), (2, 2)]
+        self.assertEqual(self._callFUT(addrs), addrs)
+
+class ResolverTests(unittest.TestCase):
+    def _getTargetClass(self):
+        from superlance.timeoutconn import Resolver
+        return Resolver
+
+    def _makeOne(self, results, ttl=60):
+        resolver = self._getTargetClass()(ttl)
+        calls = []
+        def getaddrinfo(host, port, family, socktype):
+            calls.append((host, port))
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        resolver.getaddrinfo = getaddrinfo
+        return resolver, calls
+
+    def test_cached(self):
+        resolver, calls = self._makeOne([['addr1'], ['addr2']])
+        self.assertEqual(resolver.resolve('foo', 80), ['addr1'])
+        self.assertEqual(resolver.resolve('foo', 80), ['addr1'])
+        self.assertEqual(calls, [('foo', 80)])
+
+    def test_expired(self):
+        resolver, calls = self._makeOne([['addr1'], ['addr2']], ttl=0)
+        self.assertEqual(resolver.resolve('foo', 80), ['addr1'])
+        self.assertEqual(resolver.resolve('foo', 80), ['addr2'])
+        self.assertEqual(len(calls), 2)
+
+    def test_error_not_cached(self):
+        resolver, calls = self._makeOne([socket.gaierror('nope'), ['addr1']])
+        self.assertRaises(socket.gaierror, resolver.resolve, 'foo', 80)
+        self.assertEqual(resolver.resolve('foo', 80), ['addr1'])
+
+    def test_deadline(self):
+        resolver = self._getTargetClass()()
+        release = threading.Event()
+        def getaddrinfo(host, port, family, socktype):
+            release.wait(5)
+            return ['addr1']
+        resolver.getaddrinfo = getaddrinfo
+        try:
+            self.assertRaises(socket.timeout, resolver.resolve, 'foo', 80,
+                              time.time() + 0.1)
+        finally:
+            release.set()
+
+class ConnectTests(unittest.TestCase):
+    def setUp(self):
+        from superlance import timeoutconn
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        # a port nothing listens on
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        self.closedport = closed.getsockname()[1]
+        closed.close()
+        self.saved = timeoutconn.resolver
+        timeoutconn.resolver = timeoutconn.Resolver()
+
+    def tearDown(self):
+        from superlance import timeoutconn
+        timeoutconn.resolver = self.saved
+        self.server.close()
+
+    def _callFUT(self, *arg, **kw):
+        from superlance.timeoutconn import connect
+        return connect(*arg, **kw)
+
+    def _addr(self, port):
+        return (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                ('127.0.0.1', port))
+
+    def test_connect(self):
+        sock = self._callFUT('127.0.0.1', self.port, 5)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', self.port))
+        self.failUnless(0 < sock.gettimeout() <= 5)
+        sock.close()
+
+    def test_connect_falls_back(self):
+        from superlance import timeoutconn
+        timeoutconn.resolver.getaddrinfo = lambda *arg: [
+            self._addr(self.closedport), self._addr(self.port)]
+        sock = self._callFUT('foo', 80, 5)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', self.port))
+        sock.close()
+
+    def test_connect_refused(self):
+        self.assertRaises(socket.error, self._callFUT, '127.0.0.1',
+                          self.closedport, 5)
+
+    def test_deadline_passed(self):
+        self.assertRaises(socket.timeout, self._callFUT, '127.0.0.1',
+                          self.port, deadline=time.time() - 1)
+
+class DeadlineSocketTests(unittest.TestCase):
+    def test_request_deadline(self):
+        from superlance.timeoutconn import TimeoutHTTPConnection
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        stop = threading.Event()
+        def serve():
+            # answer a byte at a time, each well within the timeout
+            conn, addr = server.accept()
+            conn.recv(1000)
+            for c in 'HTTP/1.0 200 OK\r\n':
+                if stop.isSet():
+                    break
+                conn.send(c)
+                time.sleep(0.1)
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.setDaemon(True)
+        thread.start()
+        conn = TimeoutHTTPConnection('127.0.0.1:%s' %
+                                     server.getsockname()[1])
+        conn.timeout = 0.5
+        conn.deadline = time.time() + 0.5
+        start = time.time()
+        try:
+            conn.request('GET', '/')
+            self.assertRaises(socket.timeout, conn.getresponse)
+            self.failUnless(time.time() - start < 1)
+        finally:
+            stop.set()
+            thread.join()
+            server.close()
+
+if __name__ == '__main__':
+    unittest.main()
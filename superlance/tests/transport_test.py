@@ -0,0 +1,152 @@
+import socket
+import unittest
+import xmlrpclib
+from superlance.tests.dummy import *
+
+class DummyConnection:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        self.closed = False
+
+    def request(self, method, handler, body, headers):
+        self.requests.append(body)
+
+    def getresponse(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        self.closed = True
+
+class DummyHTTPResponse:
+    status = 200
+    reason = 'OK'
+    def __init__(self, value):
+        self.body = xmlrpclib.dumps((value,), methodresponse=True)
+
+    def read(self):
+        return self.body
+
+class KeepAliveTransportTests(unittest.TestCase):
+    def _makeOne(self, *connections):
+        from superlance.transport import KeepAliveTransport
+        transport = KeepAliveTransport('', '', 'unix:///tmp/supervisor.sock')
+        connections = list(connections)
+        transport._get_connection = lambda: connections.pop(0)
+        return transport
+
+    def test_request_reuses_connection(self):
+        conn = DummyConnection([DummyHTTPResponse(1), DummyHTTPResponse(2)])
+        transport = self._makeOne(conn)
+        self.assertEqual(transport.request('h', '/RPC2', 'x'), (1,))
+        self.assertEqual(transport.request('h', '/RPC2', 'y'), (2,))
+        self.assertEqual(conn.requests, ['x', 'y'])
+
+    def test_request_retries_closed_connection(self):
+        stale = DummyConnection([DummyHTTPResponse(1),
+                                 socket.error(32, 'Broken pipe')])
+        fresh = DummyConnection([DummyHTTPResponse(2)])
+        transport = self._makeOne(stale, fresh)
+        transport.request('h', '/RPC2', 'x')
+        body = xmlrpclib.dumps((), 'supervisor.getAllProcessInfo')
+        self.assertEqual(transport.request('h', '/RPC2', body), (2,))
+        self.failUnless(stale.closed)
+        self.assertEqual(fresh.requests, [body])
+
+    def test_request_does_not_retry_changes(self):
+        stale = DummyConnection([DummyHTTPResponse(1),
+                                 socket.error(104, 'Connection reset')])
+        fresh = DummyConnection([DummyHTTPResponse(2)])
+        transport = self._makeOne(stale, fresh)
+        transport.request('h', '/RPC2', 'x')
+        body = xmlrpclib.dumps(('foo',), 'supervisor.stopProcess')
+        self.assertRaises(socket.error, transport.request, 'h', '/RPC2', body)
+        self.assertEqual(fresh.requests, [])
+
+    def test_read_only(self):
+        from superlance.transport import read_only
+        self.failUnless(read_only(xmlrpclib.dumps(('foo',),
+                                                  'supervisor.getProcessInfo')))
+        self.failUnless(read_only(xmlrpclib.dumps((), 'system.listMethods')))
+        self.failIf(read_only(xmlrpclib.dumps(('foo',),
+                                              'supervisor.startProcess')))
+        calls = [{'methodName': 'supervisor.getProcessInfo',
+                  'params': ['foo']},
+                 {'methodName': 'supervisor.stopProcess', 'params': ['foo']}]
+        self.failIf(read_only(xmlrpclib.dumps((calls,), 'system.multicall')))
+        self.failUnless(read_only(xmlrpclib.dumps((calls[:1],),
+                                                  'system.multicall')))
+        self.failIf(read_only('not xml'))
+
+    def test_request_does_not_retry_fresh_connection(self):
+        import httplib
+        conn = DummyConnection([httplib.BadStatusLine('')])
+        transport = self._makeOne(conn)
+        self.assertRaises(httplib.BadStatusLine,
+                          transport.request, 'h', '/RPC2', 'x')
+        self.failUnless(conn.closed)
+        self.assertEqual(transport.connection, None)
+
+class RestartTests(unittest.TestCase):
+    def _callFUT(self, rpc, names, **kw):
+        from superlance.transport import restart
+        return restart(rpc, names, **kw)
+
+    def test_supports_multicall(self):
+        from mock import Mock
+        from superlance.transport import supports_multicall
+        from superlance.transport import getRPCInterface
+        env = {'SUPERVISOR_SERVER_URL':'unix:///tmp/supervisor.sock'}
+        self.failUnless(supports_multicall(getRPCInterface(env)))
+        self.failIf(supports_multicall(DummyRPCServer()))
+        self.failIf(supports_multicall(Mock()))
+
+    def test_restart_one_at_a_time(self):
+        results = self._callFUT(DummyRPCServer(), ['foo:foo', 'foo:FAILED',
+                                                   'foo:SPAWN_ERROR'])
+        self.assertEqual(results[0], ('foo:foo', None, None))
+        self.assertEqual(results[1][0], 'foo:FAILED')
+        self.assertEqual(results[1][1].faultCode, 30)
+        self.assertEqual(results[1][2], None)
+        self.assertEqual(results[2][1], None)
+        self.assertEqual(results[2][2].faultCode, 50)
+
+    def test_restart_multicall(self):
+        rpc = DummyMulticallRPCServer([
+            [True], [True],
+            {'faultCode':30, 'faultString':'FAILED'}, [True],
+            ])
+        results = self._callFUT(rpc, ['foo:foo', 'foo:FAILED'])
+        self.assertEqual(rpc.system.calls, [[
+            {'methodName':'supervisor.stopProcess', 'params':['foo:foo']},
+            {'methodName':'supervisor.startProcess', 'params':['foo:foo']},
+            {'methodName':'supervisor.stopProcess', 'params':['foo:FAILED']},
+            {'methodName':'supervisor.startProcess', 'params':['foo:FAILED']},
+            ]])
+        self.assertEqual(results[0], ('foo:foo', None, None))
+        self.assertEqual(results[1][1].faultString, 'FAILED')
+        self.assertEqual(results[1][2], None)
+
+    def test_restart_multicall_nowait(self):
+        rpc = DummyMulticallRPCServer([[True], [True]])
+        self._callFUT(rpc, ['foo:foo'], wait=False)
+        self.assertEqual(rpc.system.calls, [[
+            {'methodName':'supervisor.stopProcess', 'params':['foo:foo']},
+            {'methodName':'supervisor.startProcess',
+             'params':['foo:foo', False]},
+            ]])
+
+    def test_restart_multicall_already_started(self):
+        rpc = DummyMulticallRPCServer([
+            [True], {'faultCode':60, 'faultString':'ALREADY_STARTED'},
+            [True], {'faultCode':60, 'faultString':'ALREADY_STARTED'},
+            ])
+        results = self._callFUT(rpc, ['foo:foo', 'bar:bar'])
+        self.assertEqual(results, [('foo:foo', None, None),
+                                   ('bar:bar', None, None)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -73,7 +73,7 @@ class UptimemonTests(unittest.TestCase):
             now=1700,
             start=1000,
             statename='RUNNING')
-        uptimemon.restart.assert_called_with('group:foo')
+        uptimemon.restart.assert_called_with(['group:foo'])
         assert self.log[0]['msg'] == 'Process %s is running since %i seconds, longer than allowed %i'
 
     def test_check_process_info_should_restart_processes_by_group(self):
@@ -85,7 +85,7 @@ class UptimemonTests(unittest.TestCase):
             now=1700,
             start=1000,
             statename='RUNNING')
-        uptimemon.restart.assert_called_with('foo:a_name')
+        uptimemon.restart.assert_called_with(['foo:a_name'])
         assert self.log[0]['msg'] == 'Process %s is running since %i seconds, longer than allowed %i'
 
     def test_check_process_info_should_restart_processes_by_full_name(self):
@@ -97,7 +97,7 @@ class UptimemonTests(unittest.TestCase):
             now=1700,
             start=1000,
             statename='RUNNING')
-        uptimemon.restart.assert_called_with('group:foo')
+        uptimemon.restart.assert_called_with(['group:foo'])
         assert self.log[0]['msg'] == 'Process %s is running since %i seconds, longer than allowed %i'
 
     def test_check_process_info_should_not_restart_not_running(self):
@@ -128,7 +128,7 @@ class UptimemonTests(unittest.TestCase):
         rpc.supervisor.stopProcess.side_effect = xmlrpclib.Fault(13, 'failed')
         uptimemon = Uptimemon({}, {}, rpc)
 
-        uptimemon.restart('process')
+        uptimemon.restart(['process'])
         self.assertEquals(self.log[0]['msg'], 'Restarting %s')
         self.assertEquals(self.log[1]['msg'], 'Failed to stop process %s: %s')
 
@@ -138,9 +138,192 @@ class UptimemonTests(unittest.TestCase):
         rpc.supervisor.startProcess.side_effect = xmlrpclib.Fault(13, 'failed')
         uptimemon = Uptimemon({}, {}, rpc)
 
-        uptimemon.restart('process')
+        uptimemon.restart(['process'])
         self.assertEquals(self.log[0]['msg'], 'Restarting %s')
         self.assertEquals(self.log[1]['msg'], 'Failed to start process %s after stopping it: %s')
 
+    def _makeOne(self, infos, programs=None, groups=None, resync=3600, **kw):
+        rpc = Mock()
+        rpc.supervisor.getAllProcessInfo.return_value = infos
+        uptimemon = Uptimemon(programs or {}, groups or {}, rpc, resync, **kw)
+        uptimemon.clock = lambda: self.now
+        uptimemon.stderr = StringIO()
+        uptimemon.restart = Mock()
+        self.now = 1000
+        return uptimemon
+
+    def _info(self, name, group, start, statename='RUNNING'):
+        return {'name': name, 'group': group, 'start': start, 'now': self.now,
+                'statename': statename, 'state': 20, 'pid': 11,
+                'description': 'pid 11, uptime 0:01:40'}
+
+    def test_react_to_tick_resyncs_first(self):
+        uptimemon = self._makeOne([], {'foo': 600})
+        self.now = 1000
+        uptimemon.rpc.supervisor.getAllProcessInfo.return_value = [
+            self._info('foo', 'group', 900), self._info('bar', 'group', 0)]
+        uptimemon.react_to_tick()
+        self.assertEqual(uptimemon.heap, [(1500, 'group:foo')])
+        self.assertEqual(uptimemon.next_resync, 4600)
+        assert not uptimemon.restart.called
+
+    def test_react_to_tick_only_checks_expired(self):
+        uptimemon = self._makeOne([], {'foo': 600, 'bar': 600})
+        uptimemon.next_resync = 4600
+        uptimemon.schedule('group:foo', 1500)
+        uptimemon.schedule('group:bar', 1200)
+        self.now = 1300
+        uptimemon.rpc.supervisor.getProcessInfo.return_value = self._info(
+            'bar', 'group', 600)
+        uptimemon.react_to_tick()
+        assert not uptimemon.rpc.supervisor.getAllProcessInfo.called
+        uptimemon.rpc.supervisor.getProcessInfo.assert_called_with(
+            'group:bar')
+        uptimemon.restart.assert_called_with(['group:bar'])
+        self.assertEqual(uptimemon.deadlines,
+                         {'group:foo': 1500, 'group:bar': 1900})
+
+    def test_react_to_tick_one_perform(self):
+        from superlance.actions import Signal
+        uptimemon = self._makeOne([], {}, {'group': 600, 'other': 600},
+            actions_per_rule={('group', 'other'): Signal('HUP')})
+        del uptimemon.restart
+        calls = []
+        def perform(rpc, names, timeout=None):
+            calls.append(names)
+            return [ (name, []) for name in names ]
+        uptimemon.action.perform = perform
+        uptimemon.actions_per_rule[('group', 'other')].perform = perform
+        uptimemon.rpc.supervisor.getAllProcessInfo.return_value = [
+            self._info('foo', 'group', 0), self._info('bar', 'group', 0),
+            self._info('baz', 'other', 0)]
+        uptimemon.react_to_tick()
+        self.assertEqual(calls, [['group:foo', 'group:bar'], ['other:baz']])
+
+    def test_react_to_tick_reschedules_restarted_elsewhere(self):
+        uptimemon = self._makeOne([], {'foo': 600})
+        uptimemon.next_resync = 4600
+        uptimemon.schedule('group:foo', 1200)
+        self.now = 1300
+        uptimemon.rpc.supervisor.getProcessInfo.return_value = self._info(
+            'foo', 'group', 1000)
+        uptimemon.react_to_tick()
+        assert not uptimemon.restart.called
+        self.assertEqual(uptimemon.deadlines, {'group:foo': 1600})
+
+    def test_react_to_tick_skips_stale_entries(self):
+        uptimemon = self._makeOne([], {'foo': 600})
+        uptimemon.next_resync = 4600
+        uptimemon.schedule('group:foo', 1200)
+        uptimemon.schedule('group:foo', 1800)
+        self.now = 1300
+        uptimemon.react_to_tick()
+        assert not uptimemon.rpc.supervisor.getProcessInfo.called
+        self.assertEqual(uptimemon.heap, [(1800, 'group:foo')])
+
+    def test_react_to_tick_resyncs_when_due(self):
+        uptimemon = self._makeOne([], {'foo': 600}, resync=60)
+        uptimemon.react_to_tick()
+        self.now = 1060
+        uptimemon.react_to_tick()
+        self.assertEqual(
+            uptimemon.rpc.supervisor.getAllProcessInfo.call_count, 2)
+
+    def test_roundhouse_once_schedules_running_process(self):
+        uptimemon = self._makeOne([], {}, {'group': 600})
+        uptimemon.stdin = StringIO()
+        uptimemon.stdout = StringIO()
+        payload = 'processname:foo groupname:group from_state:STARTING pid:11'
+        uptimemon.stdin.write('eventname:PROCESS_STATE_RUNNING len:%s\n%s' % (
+            len(payload), payload))
+        uptimemon.stdin.seek(0)
+        uptimemon.roundhouse_once()
+        self.assertEqual(uptimemon.heap, [(1600, 'group:foo')])
+
+    def test_check_process_info_ignores_other_keys(self):
+        uptimemon = self._makeOne([], {'foo': 600})
+        self.now = 1700
+        uptimemon.check_process_info(**self._info('foo', 'group', 1000))
+        uptimemon.restart.assert_called_with(['group:foo'])
+        self.assertEqual(uptimemon.deadlines, {'group:foo': 2300})
+
+    def test_restart_uses_rule_action(self):
+        from superlance.actions import Signal
+        uptimemon = self._makeOne([], {}, {'group': 600},
+                                  actions_per_rule={('group', 'group'):
+                                                    Signal('HUP')})
+        del uptimemon.restart
+        uptimemon.rpc.supervisor.signalProcess.return_value = True
+        uptimemon.restart(['group:foo'])
+        uptimemon.rpc.supervisor.signalProcess.assert_called_with(
+            'group:foo', 'HUP')
+        self.assertEqual(self.log[0]['msg'], 'Running %s on %s')
+        assert not uptimemon.rpc.supervisor.stopProcess.called
+
+    def test_parse_option_action(self):
+        from superlance.uptimemon import parse_option
+        name, uptime, action = parse_option('-p', 'foo=60,signal:HUP')
+        self.assertEqual((name, uptime, str(action)),
+                         ('foo', 60, 'signal:HUP'))
+        self.assertEqual(parse_option('-g', 'foo=60'), ('foo', 60, None))
+
+    def test_jitter_shortens_uptime(self):
+        uptimemon = self._makeOne([], {'foo': 600}, jitter=0.5)
+        uptimemon.random = lambda: 0.5
+        uptimemon.check_process_info(**self._info('foo', 'group', 900))
+        self.assertEqual(uptimemon.deadlines, {'group:foo': 1350})
+        assert not uptimemon.restart.called
+        self.now = 1351
+        uptimemon.check_process_info(**self._info('foo', 'group', 900))
+        uptimemon.restart.assert_called_with(['group:foo'])
+        # drawn again for the new process
+        self.assertEqual(uptimemon.jitters, {'group:foo': 0.75})
+
+    def test_max_restarts_defers(self):
+        uptimemon = self._makeOne([], {}, {'group': 600, 'other': 600},
+                                  max_restarts=1)
+        uptimemon.next_resync = 4600
+        uptimemon.check_process_info(**self._info('foo', 'group', 0))
+        uptimemon.check_process_info(**self._info('bar', 'group', 0))
+        uptimemon.check_process_info(**self._info('baz', 'other', 0))
+        self.assertEqual(uptimemon.restart.call_count, 2)
+        self.assertEqual(uptimemon.deadlines['group:bar'], 1000)
+        self.assertEqual(self.log[-2]['args'][0], 'group:bar')
+        self.failUnless(self.log[-2]['msg'].startswith('Deferring restart'))
+        uptimemon.rpc.supervisor.getProcessInfo.return_value = self._info(
+            'bar', 'group', 0)
+        uptimemon.react_to_tick()
+        uptimemon.restart.assert_called_with(['group:bar'])
+
+    def test_drain_waits_for_running(self):
+        uptimemon = self._makeOne([], {}, {'group': 600}, drain=True)
+        uptimemon.next_resync = 4600
+        self.assertEqual(uptimemon.max_restarts, 1)
+        uptimemon.check_process_info(**self._info('foo', 'group', 0))
+        uptimemon.check_process_info(**self._info('bar', 'group', 0))
+        self.assertEqual(uptimemon.restart.call_count, 1)
+        infos = {'group:foo': self._info('foo', 'group', 1000, 'STARTING'),
+                 'group:bar': self._info('bar', 'group', 0)}
+        uptimemon.rpc.supervisor.getProcessInfo.side_effect = infos.get
+        self.now = 1010
+        uptimemon.react_to_tick()
+        self.assertEqual(uptimemon.restart.call_count, 1)
+        uptimemon.react_to_running(
+            {'processname': 'foo', 'groupname': 'group'})
+        uptimemon.react_to_tick()
+        uptimemon.restart.assert_called_with(['group:bar'])
+
+    def test_drain_timeout(self):
+        uptimemon = self._makeOne([], {}, {'group': 600}, drain=True,
+                                  drain_timeout=60)
+        uptimemon.next_resync = 4600
+        uptimemon.check_process_info(**self._info('foo', 'group', 0))
+        uptimemon.rpc.supervisor.getProcessInfo.return_value = self._info(
+            'foo', 'group', 1000, 'BACKOFF')
+        self.now = 1100
+        uptimemon.react_to_tick()
+        self.assertEqual(uptimemon.restarting, {'group': {}})
+        self.assertEqual(self.log[-1]['args'], ('group:foo', 100))
+
 if __name__ == '__main__':
     unittest.main()
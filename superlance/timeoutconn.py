@@ -1,42 +1,227 @@
+import errno
 import httplib
+import select
 import socket
+import threading
+import time
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+# seconds to wait for a connection attempt before also trying the next
+# address, as recommended by RFC 8305 ("happy eyeballs")
+ATTEMPT_DELAY = 0.25
+
+class Resolver:
+    """Caches getaddrinfo results for ttl seconds.  A lookup which isn't
+    cached is made in a separate thread so that it can be abandoned when
+    the deadline passes."""
+    getaddrinfo = staticmethod(socket.getaddrinfo)
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port, deadline=None):
+        key = (host, port)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.cache.get(key)
+        finally:
+            self.lock.release()
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        result = []
+        def lookup():
+            try:
+                result.append(self.getaddrinfo(host, port, 0,
+                                               socket.SOCK_STREAM))
+            except Exception, why:
+                result.append(why)
+        thread = threading.Thread(target=lookup)
+        thread.setDaemon(True)
+        thread.start()
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(deadline - now, 0))
+        if not result:
+            raise socket.timeout('timed out resolving %s' % host)
+        if isinstance(result[0], Exception):
+            raise result[0]
+
+        self.lock.acquire()
+        try:
+            self.cache[key] = (time.time() + self.ttl, result[0])
+        finally:
+            self.lock.release()
+        return result[0]
+
+resolver = Resolver()
+
+def interleave(addrs):
+    """Reorder getaddrinfo results so that address families alternate,
+    starting with the family of the first one."""
+    families = []
+    byfamily = {}
+    for addr in addrs:
+        af = addr[0]
+        if af not in byfamily:
+            families.append(af)
+            byfamily[af] = []
+        byfamily[af].append(addr)
+    result = []
+    while len(result) < len(addrs):
+        for af in families:
+            if byfamily[af]:
+                result.append(byfamily[af].pop(0))
+    return result
+
+def connect(host, port, timeout=None, deadline=None):
+    """Return a socket connected to host and port, or raise socket.error
+    (socket.timeout if the deadline passed first).  The deadline is an
+    absolute time.time() value; if None, it is timeout seconds from now,
+    and if both are None there is none.
+
+    All of the host's addresses are tried, in alternating address
+    families.  Each attempt is given ATTEMPT_DELAY seconds before the
+    next one is started alongside it, and the first to succeed is used.
+    The socket returned has a timeout set to the time left."""
+    if deadline is None and timeout:
+        deadline = time.time() + timeout
+    addrs = interleave(resolver.resolve(host, port, deadline))
+    if not addrs:
+        raise socket.error('getaddrinfo returns an empty list')
+
+    pending = {}
+    error = None
+    nextattempt = time.time()
+    try:
+        while 1:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('timed out connecting to %s:%s' % (
+                    host, port))
+            if addrs and (now >= nextattempt or not pending):
+                af, socktype, proto, canonname, sa = addrs.pop(0)
+                try:
+                    sock = socket.socket(af, socktype, proto)
+                except socket.error, error:
+                    continue
+                sock.setblocking(0)
+                err = sock.connect_ex(sa)
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending[sock.fileno()] = sock
+                    nextattempt = now + ATTEMPT_DELAY
+                else:
+                    sock.close()
+                    error = socket.error(err, errno.errorcode.get(err, err))
+                continue
+            if not pending:
+                raise error
+
+            wait = None
+            if addrs:
+                wait = max(nextattempt - now, 0)
+            if deadline is not None:
+                left = max(deadline - now, 0)
+                if wait is None or left < wait:
+                    wait = left
+            r, w, x = select.select([], pending.keys(), [], wait)
+            for fd in w:
+                sock = pending.pop(fd)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    sock.close()
+                    error = socket.error(err, errno.errorcode.get(err, err))
+                    continue
+                sock.setblocking(1)
+                if deadline is not None:
+                    sock.settimeout(max(deadline - time.time(), 0.001))
+                return sock
+    finally:
+        for sock in pending.values():
+            sock.close()
+
+class DeadlineSocket:
+    """Wraps a socket so that every operation on it times out at the
+    deadline returned by getdeadline, rather than after a fixed time for
+    each.  A getdeadline which returns None leaves the timeout alone."""
+    def __init__(self, sock, getdeadline):
+        self._sock = sock
+        self._getdeadline = getdeadline
+
+    def _arm(self):
+        deadline = self._getdeadline()
+        if deadline is not None:
+            left = deadline - time.time()
+            if left <= 0:
+                raise socket.timeout('timed out')
+            self._sock.settimeout(left)
+
+    def recv(self, *args):
+        self._arm()
+        return self._sock.recv(*args)
+
+    def send(self, *args):
+        self._arm()
+        return self._sock.send(*args)
+
+    def sendall(self, *args):
+        self._arm()
+        return self._sock.sendall(*args)
+
+    def makefile(self, mode='r', bufsize=-1):
+        return socket._fileobject(self, mode, bufsize)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
 
 class TimeoutHTTPConnection(httplib.HTTPConnection):
     """A customised HTTPConnection allowing a per-connection
-    timeout, specified at construction."""
+    timeout, specified at construction.  If a deadline is set, each
+    request must be over by then instead, however many addresses have
+    to be tried and however many reads it takes."""
     timeout = None
+    deadline = None
+
+    def getdeadline(self):
+        return self.deadline
 
     def connect(self):
         """Override HTTPConnection.connect to connect to
         host/port specified in __init__."""
-
-        msg = "getaddrinfo returns an empty list"
-        for res in socket.getaddrinfo(self.host, self.port,
-                0, socket.SOCK_STREAM):
-            af, socktype, proto, canonname, sa = res
-            try:
-                self.sock = socket.socket(af, socktype, proto)
-                if self.timeout:   # this is the new bit
-                    self.sock.settimeout(self.timeout)
-                self.sock.connect(sa)
-            except socket.error, msg:
-                if self.sock:
-                    self.sock.close()
-                self.sock = None
-                continue
-            break
-        if not self.sock:
-            raise socket.error, msg
+        sock = connect(self.host, self.port, self.timeout, self.deadline)
+        self.sock = DeadlineSocket(sock, self.getdeadline)
 
 class TimeoutHTTPSConnection(httplib.HTTPSConnection):
     timeout = None
-    
+    deadline = None
+
+    def getdeadline(self):
+        return self.deadline
+
     def connect(self):
         "Connect to a host on a given (SSL) port."
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if self.timeout:
-            self.sock.settimeout(self.timeout)
-        sock.connect((self.host, self.port))
-        ssl = socket.ssl(sock, self.key_file, self.cert_file)
-        self.sock = httplib.FakeSocket(sock, ssl)
+        sock = connect(self.host, self.port, self.timeout, self.deadline)
+        if ssl is None:
+            sslobj = socket.ssl(sock, self.key_file, self.cert_file)
+            self.sock = httplib.FakeSocket(sock, sslobj)
+            return
+        # the handshake is bounded by the timeout connect() left on sock
+        if hasattr(ssl, 'SSLContext'):
+            # certificates are not verified, as before, but the host name
+            # is sent for servers with more than one certificate
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            if self.cert_file:
+                context.load_cert_chain(self.cert_file, self.key_file)
+            sock = context.wrap_socket(sock, server_hostname=self.host)
+        else:
+            sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+        self.sock = DeadlineSocket(sock, self.getdeadline)
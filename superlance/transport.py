@@ -0,0 +1,159 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# An XML-RPC transport for talking to supervisord which keeps one
+# connection open for the life of the listener, and helpers which batch
+# several calls into a single system.multicall round trip over it.
+
+import socket
+import httplib
+import xmlrpclib
+
+from supervisor.xmlrpc import SupervisorTransport
+from supervisor.xmlrpc import Faults
+
+# the prefixes of the names of methods which only read, so that sending
+# them twice does no harm
+READ_PREFIXES = ('get', 'read', 'tail', 'list', 'method')
+
+def read_only(request_body):
+    """ Return whether the XML-RPC request only calls methods which don't
+    change anything in supervisord. """
+    try:
+        params, method = xmlrpclib.loads(request_body)
+    except Exception:
+        return False
+    if method == 'system.multicall':
+        try:
+            methods = [ call['methodName'] for call in params[0] ]
+        except (IndexError, KeyError, TypeError):
+            return False
+    else:
+        methods = [method]
+    for method in methods:
+        if not method.split('.')[-1].startswith(READ_PREFIXES):
+            return False
+    return True
+
+class KeepAliveTransport(SupervisorTransport):
+    """ A SupervisorTransport which survives its persistent connection
+    being closed under it (e.g. when supervisord is restarted) by
+    reconnecting and retrying the request once, if it only reads. """
+    reused = False
+
+    def request(self, host, handler, request_body, verbose=0):
+        reused = self.connection is not None and self.reused
+        try:
+            result = SupervisorTransport.request(self, host, handler,
+                                                 request_body, verbose)
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            if not reused or not read_only(request_body):
+                raise
+            # the server closed a connection we had already used.  It
+            # may have done so after carrying out the request, while the
+            # response was on its way, so only a request which changes
+            # nothing (unlike e.g. stopProcess) is sent again
+            result = SupervisorTransport.request(self, host, handler,
+                                                 request_body, verbose)
+        self.reused = True
+        return result
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.reused = False
+
+def getRPCInterface(env):
+    """ Like supervisor.childutils.getRPCInterface, but using a
+    KeepAliveTransport. """
+    transport = KeepAliveTransport(env.get('SUPERVISOR_USERNAME', ''),
+                                   env.get('SUPERVISOR_PASSWORD', ''),
+                                   env['SUPERVISOR_SERVER_URL'])
+    # ServerProxy won't take a non-HTTP url, the transport knows where
+    # to connect to
+    return xmlrpclib.ServerProxy('http://127.0.0.1', transport)
+
+def supports_multicall(rpc):
+    """ Only batch calls for interfaces made by getRPCInterface above,
+    anything else (including test doubles) gets one call at a time. """
+    transport = getattr(rpc, '_ServerProxy__transport', None)
+    return isinstance(transport, KeepAliveTransport)
+
+def multicall(rpc, calls):
+    """ Make calls, a list of (method name, params) pairs, in one round
+    trip.  Returns a list with the result of each call, or an
+    xmlrpclib.Fault instance for calls which failed. """
+    results = rpc.system.multicall(
+        [ {'methodName':name, 'params':list(params)}
+          for name, params in calls ])
+    faulted = []
+    for result in results:
+        if isinstance(result, dict):
+            result = xmlrpclib.Fault(result['faultCode'],
+                                     result['faultString'])
+        else:
+            result = result[0]
+        faulted.append(result)
+    return faulted
+
+def restart(rpc, names, wait=True):
+    """ Stop then start each process in names, in one round trip where
+    possible.  Returns a list of (name, stopfault, startfault) where
+    each fault is an xmlrpclib.Fault or None.  If wait is false, don't
+    wait for the processes to be RUNNING again. """
+    startparams = ()
+    if not wait:
+        startparams = (False,)
+    if not supports_multicall(rpc):
+        return [ (name,) + _restart_one(rpc, name, startparams)
+                 for name in names ]
+
+    calls = []
+    for name in names:
+        calls.append(('supervisor.stopProcess', (name,)))
+        calls.append(('supervisor.startProcess', (name,) + startparams))
+    results = multicall(rpc, calls)
+
+    restarted = []
+    for i in range(len(names)):
+        name = names[i]
+        stopfault = _fault(results[2 * i])
+        startfault = _fault(results[2 * i + 1])
+        if (stopfault is None and startfault is not None and
+            startfault.faultCode == Faults.ALREADY_STARTED):
+            # something else (autorestart, or another client) started it
+            # again between our stop and start: it is running again,
+            # which is all we wanted
+            startfault = None
+        restarted.append((name, stopfault, startfault))
+    return restarted
+
+def _restart_one(rpc, name, startparams=()):
+    stopfault = startfault = None
+    try:
+        rpc.supervisor.stopProcess(name)
+    except xmlrpclib.Fault, what:
+        stopfault = what
+    try:
+        rpc.supervisor.startProcess(name, *startparams)
+    except xmlrpclib.Fault, what:
+        startfault = what
+    return stopfault, startfault
+
+def _fault(result):
+    if isinstance(result, xmlrpclib.Fault):
+        return result
+    return None
@@ -17,17 +17,27 @@
 
 """
 uptimemon.py [-p processname=uptime_seconds]  [-g groupname=uptime_seconds]
+             [--resync=seconds] [--jitter=fraction] [--max-restarts=count]
+             [--drain] [--drain-timeout=seconds] [--action=action]
+             [--action-timeout=seconds] [--snapshot=path]
+             [--snapshot-age=seconds]
 
 An event listener meant to be subscribed to TICK_60 (or TICK_5)
 events, which restarts any processes that are children of
 supervisord that run longer than specified.
 
+uptimemon works out when each process is due to be restarted once, and
+on each tick only looks at the processes which are due.  It learns
+about processes which have (re)started from PROCESS_STATE_RUNNING
+events, and asks supervisord about all processes once in a while (see
+--resync) to catch up with anything it missed.
+
 A supervisor config snippet that tells supervisor to use this script
 as a listener is below.
 
 [eventlistener:uptimemon]
 command=python uptimemon.py [options]
-events=TICK_60
+events=TICK_60,PROCESS_STATE_RUNNING
 
 Options:
 
@@ -39,6 +49,58 @@ Options:
 -g -- specify a group_name=uptime_seconds pair.  Restart any process in this
       group when it runs longer than uptime_seconds.
 
+Either may be followed by a comma and an action to take instead of
+restarting, as for --action, e.g. -p gunicorn=86400,signal:HUP.
+
+--resync -- the number of seconds between checks of all processes.
+      Processes started while uptimemon isn't subscribed to
+      PROCESS_STATE_RUNNING events are only noticed then.  Default is
+      3600; 0 checks every process on every tick.
+
+--jitter -- restart each process after a random part of its uptime, up
+      to this fraction of it, has been taken off, so that processes
+      which were started together aren't restarted together.  For
+      example, 0.1 restarts a process with a limit of 3600 seconds
+      after 3240 to 3600 seconds.  Default is 0.
+
+--max-restarts -- the maximum number of processes of a group restarted
+      at the same time.  Processes which are due while that many are
+      being restarted wait for the next tick.  Default is no limit, or 1
+      with --drain.
+
+--drain -- don't wait for a restarted process to be RUNNING again before
+      acknowledging the event, but count it as being restarted (see
+      --max-restarts) until it is.  So with the default limit of 1, the
+      next process of the group is only restarted once the last one is
+      running again.  Subscribe to PROCESS_STATE_RUNNING events to learn
+      about that as soon as it happens; otherwise it is checked on
+      each tick.
+
+--drain-timeout -- stop waiting for a restarted process to be RUNNING
+      after this many seconds.  Default is 300.
+
+--action -- what to do to a process which has run too long instead of
+      restarting it: "restart" (the default), "signal:NAME" to send it
+      the signal NAME (e.g. "signal:HUP" for processes which recycle
+      their workers on SIGHUP), or "exec:COMMAND" to run COMMAND with
+      the shell, with the name and pid of the process in
+      $SUPERLANCE_PROCESS_NAME and $SUPERLANCE_PROCESS_PID.  Signals are
+      sent by supervisord 3.2 and later, and by uptimemon itself for
+      older versions.
+
+--action-timeout -- wait this many seconds for a process to be RUNNING
+      after acting on it, and log a warning if it isn't.  By default,
+      restarts wait as long as supervisord does, signals don't wait and
+      commands are waited for until they exit.  Ignored with --drain.
+
+--snapshot -- share the process information fetched from supervisord on
+      each tick with other listeners through the file at this path, so
+      that only one of them needs to ask supervisord for it.  Give every
+      listener of the same supervisord the same path.
+
+--snapshot-age -- the number of seconds a snapshot may be reused for.
+      Default is 2.
+
 The -p and -g options may be specified more than once, allowing for
 specification of multiple groups and processes.
 
@@ -49,11 +111,19 @@ uptimemon.py -p program1=600 -p thegroup:theprog=3600 -g thegroup=3600
 
 import os
 import sys
-import xmlrpclib
+import time
+import heapq
+import random
 import logging
+import xmlrpclib
 
 from supervisor import childutils
 
+from superlance import actions
+from superlance import events
+from superlance import snapshot
+from superlance import transport
+
 
 def usage():
     import posix
@@ -62,14 +132,45 @@ def usage():
 
 
 class Uptimemon:
+    clock = time.time
+    random = random.random
 
-    def __init__(self, uptime_per_program, uptime_per_group, rpc):
+    def __init__(self, uptime_per_program, uptime_per_group, rpc,
+            resync=3600, jitter=0, max_restarts=None, drain=False,
+            drain_timeout=300, action=None, action_timeout=None,
+            actions_per_rule=None):
         self.uptime_per_program = uptime_per_program
         self.uptime_per_group = uptime_per_group
         self.rpc = rpc
+        self.resync_interval = resync
+        self.jitter = jitter
+        if drain and max_restarts is None:
+            max_restarts = 1
+        self.max_restarts = max_restarts
+        self.drain = drain
+        self.drain_timeout = drain_timeout
+        if action is None:
+            action = actions.Restart()
+        self.action = action
+        self.action_timeout = action_timeout
+        # ('program', name) or ('group', name) -> the action of that -p or
+        # -g option, if it has one
+        self.actions_per_rule = actions_per_rule or {}
+        # the fraction of its max uptime each process is allowed, drawn
+        # again after each restart
+        self.jitters = {}
+        # group -> {full name: time restarted} of the processes being
+        # restarted
+        self.restarting = {}
         self.stdin = sys.stdin
+        self.events = events.EventReader(['TICK_*', 'PROCESS_STATE_RUNNING'])
         self.stdout = sys.stdout
         self.stderr = sys.stderr
+        # a heap of (deadline, full name) and the current deadline of each
+        # name; heap entries which don't match it are stale and skipped
+        self.heap = []
+        self.deadlines = {}
+        self.next_resync = None
 
     def roundhouse_forever(self):
         while 1:
@@ -78,62 +179,213 @@ class Uptimemon:
     def roundhouse_once(self):
         # we explicitly use self.stdin, self.stdout, and self.stderr
         # instead of sys.* so we can unit test this code
-        headers, payload = childutils.listener.wait(self.stdin, self.stdout)
+        headers, payload = self.events.wait(self.stdin, self.stdout)
 
         logging.info('headers: %s, payload: %s', headers, payload)
-        if headers['eventname'].startswith('TICK'):
+        eventname = headers['eventname']
+        if eventname.startswith('TICK'):
+            snapshot.set_tick(self.rpc, payload)
             self.react_to_tick()
+        elif eventname == 'PROCESS_STATE_RUNNING':
+            self.react_to_running(childutils.get_headers(payload))
 
         childutils.listener.ok(self.stdout)
 
     def react_to_tick(self):
+        now = self.clock()
+        if self.drain:
+            self.check_restarting(now)
+        else:
+            # restarts finished before the last tick was acknowledged
+            self.restarting = {}
+        if self.next_resync is None or now >= self.next_resync:
+            self.resync(now)
+        else:
+            self.expire(now)
+
+        self.stderr.flush()
+
+    def react_to_running(self, payload):
+        name = payload['processname']
+        group = payload['groupname']
+        full_name = '%s:%s' % (group, name)
+        self.restarting.get(group, {}).pop(full_name, None)
+        max_uptime = self.max_uptime(name, group)
+        if max_uptime:
+            self.schedule(full_name,
+                    self.clock() + self.limit(full_name, max_uptime))
+
+    def check_restarting(self, now):
+        """Forget about restarted processes which are RUNNING again, or
+        which we have waited too long for."""
+        for group, started in self.restarting.items():
+            for full_name, when in started.items():
+                if now - when > self.drain_timeout:
+                    logging.warning('Process %s is not running %i seconds '
+                            'after restarting it', full_name, now - when)
+                    del started[full_name]
+                    continue
+                try:
+                    info = self.rpc.supervisor.getProcessInfo(full_name)
+                except xmlrpclib.Fault:
+                    del started[full_name]
+                    continue
+                if info['statename'] == 'RUNNING':
+                    del started[full_name]
+
+    def resync(self, now):
+        """Check every process, and rebuild the deadlines from scratch."""
+        self.heap = []
+        self.deadlines = {}
+        self.next_resync = now + self.resync_interval
+
         infos = self.rpc.supervisor.getAllProcessInfo()
 
+        due = []
         for info in infos:
-            self.check_process_info(**info)
+            self.check_process_info(due=due, **info)
+        if due:
+            self.restart(due)
+
+    def expire(self, now):
+        """Check the processes whose deadlines have passed."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, full_name = heapq.heappop(self.heap)
+            if self.deadlines.get(full_name) != deadline:
+                continue
+            del self.deadlines[full_name]
+            due.append(full_name)
+        # processes held back by --max-restarts are scheduled again for
+        # now, so they are looked at first on the next tick
+        restarts = []
+        for full_name in due:
+            # it may have been restarted or stopped since we scheduled it
+            try:
+                info = self.rpc.supervisor.getProcessInfo(full_name)
+            except xmlrpclib.Fault, why:
+                logging.info('Not checking %s: %s', full_name, why)
+                continue
+            self.check_process_info(due=restarts, **info)
+        if restarts:
+            self.restart(restarts)
+
+    def schedule(self, full_name, deadline):
+        self.deadlines[full_name] = deadline
+        heapq.heappush(self.heap, (deadline, full_name))
+
+    def limit(self, full_name, max_uptime):
+        """Return the uptime after which a process is restarted: its max
+        uptime less its jitter."""
+        if not self.jitter:
+            return max_uptime
+        factor = self.jitters.get(full_name)
+        if factor is None:
+            factor = self.jitters[full_name] = 1 - self.random() * self.jitter
+        return max_uptime * factor
+
+    def max_uptime(self, name, group):
+        full_name = '%s:%s' % (group, name)
+        return (self.uptime_per_program.get(name)
+                or self.uptime_per_program.get(full_name)
+                or self.uptime_per_group.get(group))
 
-        self.stderr.flush()
+    def get_action(self, full_name):
+        group, sep, name = full_name.partition(':')
+        for rule in (('program', name), ('program', full_name),
+                     ('group', group)):
+            if rule in self.actions_per_rule:
+                return self.actions_per_rule[rule]
+        return self.action
 
     def check_process_info(self, name=None, group=None, now=None,
-            start=None, statename=None):
+            start=None, statename=None, due=None, **ignored):
+        """Restart the process if it has been up too long.  With due, a
+        list, its name is added to it for the caller to restart instead."""
         uptime = now - start
         full_name = '%s:%s' % (group, name)
 
         if statename != 'RUNNING':
             return
 
-        max_uptime = (self.uptime_per_program.get(name)
-                or self.uptime_per_program.get(full_name)
-                or self.uptime_per_group.get(group))
+        max_uptime = self.max_uptime(name, group)
 
         if not max_uptime:
             return
 
-        if uptime > max_uptime:
+        limit = self.limit(full_name, max_uptime)
+        if uptime > limit:
             logging.info('Process %s is running since %i seconds, longer than '
-                    'allowed %i', name, uptime, max_uptime)
-            self.restart(full_name)
-
-    def restart(self, name):
-        logging.info('Restarting %s', name)
-
-        try:
-            self.rpc.supervisor.stopProcess(name)
-        except xmlrpclib.Fault, e:
-            logging.warning('Failed to stop process %s: %s', name, e)
-
-        try:
-            self.rpc.supervisor.startProcess(name)
-        except xmlrpclib.Fault, e:
-            logging.warning('Failed to start process %s after stopping it: %s',
-                    name, e)
+                    'allowed %i', name, uptime, limit)
+            restarting = self.restarting.setdefault(group, {})
+            if (self.max_restarts is not None and
+                    len(restarting) >= self.max_restarts):
+                logging.info('Deferring restart of %s, %i processes of group '
+                        '%s are being restarted', full_name, len(restarting),
+                        group)
+                self.schedule(full_name, self.clock())
+                return
+            restarting[full_name] = self.clock()
+            if due is None:
+                self.restart([full_name])
+            else:
+                due.append(full_name)
+            self.jitters.pop(full_name, None)
+            self.schedule(full_name,
+                    self.clock() + self.limit(full_name, max_uptime))
+        else:
+            self.schedule(full_name, self.clock() + limit - uptime)
+
+    def restart(self, names):
+        """Run its action on each of names, with one call to perform for
+        all of those which share an action."""
+        order = []
+        batches = {}
+        for name in names:
+            action = self.get_action(name)
+            if action not in batches:
+                order.append(action)
+                batches[action] = []
+            batches[action].append(name)
+            if isinstance(action, actions.Restart):
+                logging.info('Restarting %s', name)
+            else:
+                logging.info('Running %s on %s', action, name)
+
+        timeout = self.action_timeout
+        if self.drain:
+            # check_restarting does the waiting
+            timeout = 0
+        for action in order:
+            results = action.perform(self.rpc, batches[action], timeout)
+            for name, failures in results:
+                self.report(action, name, failures)
+
+    def report(self, action, name, failures):
+        for stage, error in failures:
+            if stage == 'stop':
+                logging.warning('Failed to stop process %s: %s', name, error)
+            elif stage == 'start':
+                logging.warning('Failed to start process %s after stopping '
+                        'it: %s', name, error)
+            elif stage == 'wait':
+                logging.warning('Process %s is not RUNNING after %s: %s',
+                        name, action, error)
+            else:
+                logging.warning('Failed to run %s on %s: %s', action, name,
+                        error)
 
 
 def parse_option(option, value):
     try:
-        name, uptime = value.split('=')
+        name, uptime = value.split('=', 1)
+        uptime, sep, action = uptime.partition(',')
         uptime = long(uptime)
-        return name, uptime
+        if sep:
+            action = actions.parse_action(action)
+        else:
+            action = None
+        return name, uptime, action
     except ValueError:
         print 'Unparseable value %r for %r' % (value, option)
         usage()
@@ -147,6 +399,15 @@ def main():
         "help",
         "program=",
         "group=",
+        "resync=",
+        "jitter=",
+        "max-restarts=",
+        "drain",
+        "drain-timeout=",
+        "action=",
+        "action-timeout=",
+        "snapshot=",
+        "snapshot-age=",
         ]
     arguments = sys.argv[1:]
     if not arguments:
@@ -158,24 +419,97 @@ def main():
 
     uptime_per_program = {}
     uptime_per_group = {}
+    resync = 3600
+    jitter = 0
+    max_restarts = None
+    drain = False
+    drain_timeout = 300
+    action = None
+    action_timeout = None
+    actions_per_rule = {}
+    snapshotpath = None
+    snapshotage = 2
 
     for option, value in opts:
         if option in ('-h', '--help'):
             usage()
 
         if option in ('-p', '--program'):
-            name, uptime = parse_option(option, value)
+            name, uptime, rule_action = parse_option(option, value)
             uptime_per_program[name] = uptime
+            if rule_action is not None:
+                actions_per_rule[('program', name)] = rule_action
 
         if option in ('-g', '--group'):
-            name, uptime = parse_option(option, value)
+            name, uptime, rule_action = parse_option(option, value)
             uptime_per_group[name] = uptime
+            if rule_action is not None:
+                actions_per_rule[('group', name)] = rule_action
+
+        if option == '--resync':
+            try:
+                resync = int(value)
+            except ValueError:
+                print 'Unparseable value %r for %r' % (value, option)
+                usage()
+
+        if option == '--jitter':
+            try:
+                jitter = float(value)
+            except ValueError:
+                print 'Unparseable value %r for %r' % (value, option)
+                usage()
+
+        if option == '--max-restarts':
+            try:
+                max_restarts = int(value)
+            except ValueError:
+                print 'Unparseable value %r for %r' % (value, option)
+                usage()
+
+        if option == '--drain':
+            drain = True
+
+        if option == '--drain-timeout':
+            try:
+                drain_timeout = int(value)
+            except ValueError:
+                print 'Unparseable value %r for %r' % (value, option)
+                usage()
+
+        if option == '--action':
+            try:
+                action = actions.parse_action(value)
+            except ValueError:
+                print 'Unparseable value %r for %r' % (value, option)
+                usage()
+
+        if option == '--action-timeout':
+            try:
+                action_timeout = int(value)
+            except ValueError:
+                print 'Unparseable value %r for %r' % (value, option)
+                usage()
+
+        if option == '--snapshot':
+            snapshotpath = value
+
+        if option == '--snapshot-age':
+            try:
+                snapshotage = int(value)
+            except ValueError:
+                print 'Unparseable value %r for %r' % (value, option)
+                usage()
 
     logging.basicConfig(
             level=logging.INFO,
             format='%(asctime)s %(levelname)s %(message)s')
-    rpc = childutils.getRPCInterface(os.environ)
-    uptimemon = Uptimemon(uptime_per_program, uptime_per_group, rpc)
+    rpc = transport.getRPCInterface(os.environ)
+    if snapshotpath:
+        rpc = snapshot.wrap(rpc, snapshotpath, snapshotage)
+    uptimemon = Uptimemon(uptime_per_program, uptime_per_group, rpc, resync,
+            jitter, max_restarts, drain, drain_timeout, action,
+            action_timeout, actions_per_rule)
     uptimemon.roundhouse_forever()
 
 if __name__ == '__main__':